@@ -0,0 +1,216 @@
+import os
+import asyncio
+import logging
+import numpy as np
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .catalog_io import read_chunks, default_chunk_size
+from .genesis_metallicity import genesis_metallicity, preload
+from .metallicity.monte_carlo import default_n_samples
+from .parallel import read_catalog, select_rows, measure_chunk
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# the rows of an in-memory catalog measured at a time by the async iterators
+default_async_chunk_size = 64
+
+# the chunks (or objects) in flight per worker, beyond which the callers wait
+pending_per_worker = 2
+
+#######################
+# Worker Measurements #
+#######################
+
+#---- one object, as the genesis_metallicity class (run in the workers) ----#
+
+def measure_object(input_dict, object, settings):
+
+    return genesis_metallicity(input_dict, object=object, **settings)
+
+###################
+# Async Estimator #
+###################
+
+# an asyncio facade of the pipeline: the measurements run on a pool of n_workers processes (or threads, with
+# executor='thread') that keep the kernels and the PyNeb atoms loaded, so that they do not block the event
+# loop; at most max_pending objects or chunks are in flight, beyond which the callers wait (backpressure);
+# the settings are those of the genesis_metallicity class
+class ASYNC_ESTIMATOR:
+
+    def __init__(self, n_workers=None, executor='process', max_pending=None,
+                 correct_extinction=True, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                 uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed'):
+
+        if executor not in ['process', 'thread']:
+            raise ValueError('unknown executor \'%s\'; choose between \'process\' and \'thread\'' %executor)
+
+        self.settings = {}
+        self.settings['correct_extinction'] = correct_extinction
+        self.settings['kernel_engine']      = kernel_engine
+        self.settings['emissivity_engine']  = emissivity_engine
+        self.settings['grid']               = grid
+        self.settings['grid_resolution']    = grid_resolution
+        self.settings['grid_length']        = grid_length
+        self.settings['posterior']          = posterior
+        self.settings['uncertainty']        = uncertainty
+        self.settings['n_samples']          = n_samples
+        self.settings['seed']               = seed
+        self.settings['extinction']         = extinction
+
+        self.n_workers     = n_workers if n_workers is not None else os.cpu_count()
+        self.executor_type = executor
+        self.max_pending   = max_pending if max_pending is not None else pending_per_worker*self.n_workers
+
+        self.executor       = None
+        self.semaphore      = None
+        self.semaphore_loop = None
+
+    #---- the pool (started on first use) ----#
+
+    def start(self):
+
+        if self.executor is None:
+
+            # done here first so that the workers do not build (and save) the same tabulated kernels at once;
+            # the threads share these, the processes load their own
+            preload(self.settings['kernel_engine'], self.settings['emissivity_engine'])
+
+            if self.executor_type == 'process':
+                self.executor = ProcessPoolExecutor(max_workers=self.n_workers, initializer=preload, initargs=(self.settings['kernel_engine'], self.settings['emissivity_engine']))
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=self.n_workers)
+
+        return self
+
+    # the semaphore of the running event loop (a shared estimator can outlive one)
+    def pending_slots(self):
+
+        loop = asyncio.get_running_loop()
+
+        if (self.semaphore is None) or (self.semaphore_loop is not loop):
+            self.semaphore      = asyncio.Semaphore(self.max_pending)
+            self.semaphore_loop = loop
+
+        return self.semaphore
+
+    def close(self):
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def __aenter__(self):
+
+        return self.start()
+
+    async def __aexit__(self, *exc):
+
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    #---- one object ----#
+
+    # returns the genesis_metallicity object of input_dict (its errors are raised here)
+    async def measure(self, input_dict, object='default'):
+
+        self.start()
+
+        async with self.pending_slots():
+            return await asyncio.get_running_loop().run_in_executor(self.executor, measure_object, input_dict, object, self.settings)
+
+    #---- catalogs ----#
+
+    # chunks is an iterator of (objects, columns) with the columns in the read_catalog format; yields the
+    # outputs of each chunk in order (those of measure_catalog, with the 'error' column of run_parallel); the
+    # next chunks are read (in a thread) and measured while the caller handles the outputs
+    async def iterate_chunks(self, chunks):
+
+        self.start()
+
+        loop      = asyncio.get_running_loop()
+        chunks    = iter(chunks)
+        pending   = deque()
+        exhausted = False
+
+        try:
+            while True:
+
+                while (not exhausted) and (len(pending) < self.max_pending):
+                    chunk = await loop.run_in_executor(None, next, chunks, None)
+                    if chunk is None:
+                        exhausted = True
+                        break
+                    pending.append(loop.run_in_executor(self.executor, measure_chunk, chunk[1], chunk[0], self.settings))
+
+                if len(pending) == 0:
+                    return
+
+                output_dict, _ = await pending.popleft()
+                yield output_dict
+
+        # the chunks not started yet are dropped if the caller stops early
+        finally:
+            for future in pending:
+                future.cancel()
+
+    # an in-memory catalog (any format measure_catalog reads)
+    def iterate(self, catalog, objects=None, chunk_size=default_async_chunk_size):
+
+        columns = read_catalog(catalog)
+
+        if len(columns) == 0:
+            raise ImportError('none of the emission lines were found in the catalog')
+
+        size = len(next(iter(columns.values()))[0])
+
+        if objects is None:
+            objects = np.arange(size)
+        objects = np.asarray(objects)
+
+        if len(objects) != size:
+            raise ValueError('objects must have the same length as the catalog')
+
+        def chunks():
+            for lo in range(0, size, chunk_size):
+                yield objects[lo:lo+chunk_size], select_rows(columns, slice(lo, lo+chunk_size))
+
+        return self.iterate_chunks(chunks())
+
+    # a FITS, HDF5 or CSV catalog file (as measure_file reads it)
+    def iterate_file(self, path, columns=None, object_column=None, chunk_size=default_chunk_size, format=None, hdu=1, key=None):
+
+        def chunks():
+            for objects, chunk in read_chunks(path, columns=columns, object_column=object_column, chunk_size=chunk_size, format=format, hdu=hdu, key=key):
+                yield objects, {line: [chunk[line], chunk[line+'_err']] for line in chunk.keys() if not line.endswith('_err')}
+
+        return self.iterate_chunks(chunks())
+
+###########################
+# Shared Async Estimators #
+###########################
+
+# one ASYNC_ESTIMATOR (a process pool) per configuration, started on first use
+shared_estimators = {}
+
+def get_estimator(**settings):
+
+    key = tuple(sorted(settings.items()))
+    if key not in shared_estimators:
+        shared_estimators[key] = ASYNC_ESTIMATOR(**settings)
+    return shared_estimators[key]
+
+#---- await ameasure(input_dict) instead of genesis_metallicity(input_dict) ----#
+
+async def ameasure(input_dict, object='default', **settings):
+
+    return await get_estimator(**settings).measure(input_dict, object=object)
+
+#---- async for output_dict in aiterate(catalog) ----#
+
+def aiterate(catalog, objects=None, chunk_size=default_async_chunk_size, **settings):
+
+    return get_estimator(**settings).iterate(catalog, objects=objects, chunk_size=chunk_size)
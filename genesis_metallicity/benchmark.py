@@ -0,0 +1,461 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from uncertainties import ufloat
+
+from .data.lines import backend_lines
+from .dust.extinction_correction import EMISSION_LINES
+from .metallicity.direct_method import METALLICITY
+from .metallicity.strong_method import measure_metallicity
+from .temperature.temperature_estimator import measure_temperature
+from .genesis_metallicity import genesis_metallicity, measure_catalog, log_ratio, preload
+
+##########
+# Config #
+##########
+
+# bump whenever the layout of the baseline files changes
+benchmark_format_version = 1
+
+# the synthetic catalog sizes (smaller ones for the command line with the exact engines, at ~0.5 s per object)
+default_sizes = (1, 100, 10000)
+exact_sizes   = (1, 10)
+
+# the per-object stages are timed on (at most) the first max_objects objects of each catalog,
+# measure_catalog on the whole catalog
+default_max_objects = 100
+
+# tracemalloc slows python down, so the peak memory is measured in a second pass over (at most) memory_objects objects
+default_memory_objects = 10
+
+# a latency or peak memory above threshold times the baseline is flagged as a regression,
+# unless it is within the noise floor (in s per object and MB) of the baseline
+default_threshold   = 1.25
+default_noise_floor = {'latency': 1e-3, 'peak_memory': 1.0}
+
+# the modules whose import is timed, each in fresh interpreters (the fastest of import_repeat imports is kept)
+import_modules        = ['genesis_metallicity.genesis_metallicity']
+default_import_repeat = 5
+
+# the directory this copy of the package is imported from by the fresh interpreters
+package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+######################
+# Synthetic Catalogs #
+######################
+
+# a typical object of the calibration samples: the median log(OII/Hbeta) and log(O5007/Hbeta) of the calibrations,
+# case-B Balmer decrements (no dust) and Te = 12000 K for O4363 and O7320,30
+reference_lines = {}
+reference_lines['OII']      = [1.90e-18, 3.8e-20]
+reference_lines['Hdelta']   = [2.60e-19, 7.8e-21]
+reference_lines['Hgamma']   = [4.70e-19, 1.4e-20]
+reference_lines['O4363']    = [5.94e-20, 5.9e-21]
+reference_lines['Hbeta']    = [1.00e-18, 2.0e-20]
+reference_lines['O4959']    = [1.58e-18, 1.6e-20]
+reference_lines['O5007']    = [4.70e-18, 4.7e-20]
+reference_lines['O7320']    = [1.88e-20, 3.0e-21]
+reference_lines['O7330']    = [1.04e-20, 3.0e-21]
+reference_lines['Hbeta_EW'] = [150.0, 10.0]
+
+# the lines measured in each scenario
+scenario_lines = {}
+scenario_lines['strong']       = ['OII', 'Hdelta', 'Hgamma', 'Hbeta', 'O4959', 'O5007', 'Hbeta_EW']
+scenario_lines['direct']       = ['OII', 'Hdelta', 'Hgamma', 'O4363', 'Hbeta', 'O4959', 'O5007', 'Hbeta_EW']
+scenario_lines['direct_O7320'] = ['OII', 'Hdelta', 'Hgamma', 'O4363', 'Hbeta', 'O4959', 'O5007', 'O7320', 'O7330', 'Hbeta_EW']
+scenario_lines['no_balmer']    = ['OII', 'Hbeta', 'O4959', 'O5007', 'Hbeta_EW']
+
+#---- a catalog in the [flux_array, err_array] format: the reference lines, scaled by a common brightness and a small scatter per line ----#
+
+def synthetic_catalog(scenario, n_objects, seed=0, brightness=0.5, scatter=0.05):
+
+    if scenario not in scenario_lines:
+        raise ValueError('unknown scenario \'%s\'; choose between %s' %(scenario, ', '.join('\'%s\'' %name for name in scenario_lines)))
+
+    rng    = np.random.default_rng(seed)
+    common = np.power(10, brightness*rng.uniform(-1, 1, n_objects))
+
+    catalog = {}
+    for line in scenario_lines[scenario]:
+        flux, err     = reference_lines[line]
+        factor        = common*np.power(10, scatter*rng.standard_normal(n_objects))
+        catalog[line] = [flux*factor, err*factor]
+
+    # the equivalent width does not scale with the brightness
+    flux, err = reference_lines['Hbeta_EW']
+    factor    = np.power(10, scatter*rng.standard_normal(n_objects))
+    catalog['Hbeta_EW'] = [flux*factor, err*factor]
+
+    return catalog
+
+#---- the input_dict of one object of a catalog ----#
+
+def catalog_row(catalog, index):
+
+    return {line: [column[0][index], column[1][index]] for line, column in catalog.items()}
+
+def select_catalog(catalog, rows):
+
+    return {line: [column[0][rows], column[1][rows]] for line, column in catalog.items()}
+
+#---- the data_dict that genesis_metallicity passes to EMISSION_LINES and METALLICITY ----#
+
+def object_data_dict(input_dict):
+
+    data_dict = {}
+    data_dict['redshift']   = np.nan
+    data_dict['red._corr.'] = False
+
+    for line, (flux, err) in input_dict.items():
+        data_dict[line] = ufloat(flux, err)
+
+    if ('O7320' in data_dict.keys()) and ('O7330' in data_dict.keys()):
+        data_dict['OII7320'] = data_dict['O7320'] + data_dict['O7330']
+
+    for line in backend_lines:
+        if line not in data_dict.keys():
+            data_dict[line] = ufloat(np.nan, np.nan, np.nan)
+
+    return data_dict
+
+##########
+# Stages #
+##########
+
+# each stage is a function of the catalog rows it measures; the per-object stages loop over them,
+# as genesis_metallicity does, measure_catalog measures them at once
+def benchmark_stages(scenario, catalog, kernel_engine='exact', emissivity_engine='exact', grid='full'):
+
+    size  = len(catalog['Hbeta'][0])
+    rows  = [catalog_row(catalog, index) for index in range(size)]
+    dicts = [object_data_dict(row) for row in rows]
+
+    # the strong-line and t2 kernel inputs, from the (uncorrected) line ratios
+    log_O2       = log_ratio(catalog['OII'], catalog['Hbeta'])
+    log_O3       = log_ratio(catalog['O5007'], catalog['Hbeta'])
+    log_Hbeta_EW = log_ratio(catalog['Hbeta_EW'], (np.ones(size), np.zeros(size)))
+
+    def run_emission_lines(indices):
+        for index in indices:
+            EMISSION_LINES(index, dicts[index])
+
+    def run_measure_metallicity(indices):
+        for index in indices:
+            measure_metallicity(log_O2[0][index], log_O2[1][index], log_O3[0][index], log_O3[1][index], log_Hbeta_EW[0][index], log_Hbeta_EW[1][index],
+                                engine=kernel_engine, grid=grid)
+
+    # t3 = 1.2 +/- 0.05 (1e4 K), as the reference object
+    def run_measure_temperature(indices):
+        for index in indices:
+            measure_temperature(log_O2[0][index], log_O2[1][index], log_O3[0][index], log_O3[1][index], 1.2, 0.05,
+                                engine=kernel_engine, grid=grid)
+
+    def run_direct_metallicity(indices):
+        for index in indices:
+            METALLICITY(index, dicts[index], kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid)
+
+    def run_genesis_metallicity(indices):
+        for index in indices:
+            genesis_metallicity(rows[index], object=index, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid)
+
+    def run_measure_catalog(indices):
+        measure_catalog(select_catalog(catalog, np.asarray(indices, dtype=int)), kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid)
+
+    stages = {}
+    stages['EMISSION_LINES']      = run_emission_lines
+    stages['measure_metallicity'] = run_measure_metallicity
+    stages['measure_temperature'] = run_measure_temperature
+    # the direct method needs [OIII]4363
+    if 'O4363' in catalog.keys():
+        stages['METALLICITY']     = run_direct_metallicity
+    stages['genesis_metallicity'] = run_genesis_metallicity
+    stages['measure_catalog']     = run_measure_catalog
+    return stages
+
+#---- the wall time of one pass over the rows, and the peak memory (in MB) traced over a second pass ----#
+
+def time_stage(run, n_timed, n_memory):
+
+    # one untimed object first, so that the lazy imports and caches are not timed
+    run(range(1))
+
+    start   = time.perf_counter()
+    run(range(n_timed))
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        run(range(n_memory))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return elapsed, peak/2**20
+
+#---- the wall time and the peak memory (in MB, traced in another interpreter) of importing a module ----#
+
+# run as python -c import_script <module> <'time' or 'memory'>; prints the import time and the traced peak
+import_script = '''
+import sys, time, tracemalloc
+if sys.argv[2] == 'memory':
+    tracemalloc.start()
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(elapsed, tracemalloc.get_traced_memory()[1])
+'''
+
+def time_import(module, repeat=default_import_repeat):
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_parent] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+
+    def run(mode):
+        output = subprocess.run([sys.executable, '-c', import_script, module, mode], env=env, check=True, capture_output=True, text=True)
+        return [float(value) for value in output.stdout.split()]
+
+    elapsed = min(run('time')[0] for i in range(repeat))
+    peak    = run('memory')[1]
+
+    return elapsed, peak/2**20
+
+#############
+# Benchmark #
+#############
+
+def run_benchmark(sizes=default_sizes, scenarios=tuple(scenario_lines.keys()), max_objects=default_max_objects, memory_objects=default_memory_objects,
+                  kernel_engine='exact', emissivity_engine='exact', grid='full', seed=0, imports=True, print_progress=True):
+
+    results = []
+
+    #---- the imports (as one 'import' scenario of one object per module) ----#
+
+    if imports:
+        for module in import_modules:
+
+            elapsed, peak = time_import(module)
+
+            result = {}
+            result['scenario']    = 'import'
+            result['stage']       = module
+            result['n_objects']   = 1
+            result['n_timed']     = 1
+            result['time']        = elapsed
+            result['latency']     = elapsed
+            result['throughput']  = 1/elapsed
+            result['peak_memory'] = peak
+            results.append(result)
+
+            if print_progress:
+                print_result(result)
+
+    #---- the stages ----#
+
+    # the kernels and the atomic data are loaded once, outside of the timings
+    preload(kernel_engine=kernel_engine, emissivity_engine=emissivity_engine)
+
+    for scenario in scenarios:
+        for size in sizes:
+
+            catalog = synthetic_catalog(scenario, size, seed=seed)
+            stages  = benchmark_stages(scenario, catalog, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid)
+
+            for stage, run in stages.items():
+
+                n_timed  = size if stage == 'measure_catalog' else min(size, max_objects)
+                n_memory = size if stage == 'measure_catalog' else min(size, memory_objects)
+
+                elapsed, peak = time_stage(run, n_timed, n_memory)
+
+                result = {}
+                result['scenario']    = scenario
+                result['stage']       = stage
+                result['n_objects']   = size
+                result['n_timed']     = n_timed
+                result['time']        = elapsed
+                result['latency']     = elapsed/n_timed
+                result['throughput']  = n_timed/elapsed
+                result['peak_memory'] = peak
+                results.append(result)
+
+                if print_progress:
+                    print_result(result)
+
+    return results
+
+def print_result(result):
+
+    print('%-13s %-20s %6i objects: %10.2f ms/object %10.1f objects/s %9.2f MB'
+          %(result['scenario'], result['stage'], result['n_objects'], 1e+3*result['latency'], result['throughput'], result['peak_memory']))
+
+###########################
+# Baselines & Regressions #
+###########################
+
+# the settings that have to match for two benchmarks to be comparable
+def benchmark_metadata(kernel_engine='exact', emissivity_engine='exact', grid='full'):
+
+    import scipy
+
+    metadata = {}
+    metadata['kernel_engine']     = kernel_engine
+    metadata['emissivity_engine'] = emissivity_engine
+    metadata['grid']              = grid
+    metadata['python']            = platform.python_version()
+    metadata['numpy']             = np.__version__
+    metadata['scipy']             = scipy.__version__
+    metadata['machine']           = platform.machine()
+    return metadata
+
+def save_baseline(path, results, metadata):
+
+    with open(path, 'w') as handle:
+        json.dump({'version': benchmark_format_version, 'metadata': metadata, 'results': results}, handle, indent=1)
+
+def load_baseline(path):
+
+    with open(path, 'r') as handle:
+        baseline = json.load(handle)
+
+    if baseline['version'] != benchmark_format_version:
+        raise ValueError('%s was saved with benchmark format version %i, but version %i is expected' %(path, baseline['version'], benchmark_format_version))
+    return baseline
+
+#---- the latencies and peak memories above threshold times the baseline ----#
+
+def compare_benchmark(results, baseline, metadata, threshold=default_threshold, noise_floor=default_noise_floor):
+
+    for setting in ['kernel_engine', 'emissivity_engine', 'grid']:
+        if baseline['metadata'][setting] != metadata[setting]:
+            raise ValueError('the baseline was measured with %s=\'%s\', but the benchmark with %s=\'%s\'' %(setting, baseline['metadata'][setting], setting, metadata[setting]))
+
+    reference = {(result['scenario'], result['stage'], result['n_objects']): result for result in baseline['results']}
+
+    regressions = []
+
+    for result in results:
+
+        key = (result['scenario'], result['stage'], result['n_objects'])
+        if key not in reference:
+            continue
+
+        for quantity in ['latency', 'peak_memory']:
+
+            value, base = result[quantity], reference[key][quantity]
+
+            if (value > threshold*base) and (value-base > noise_floor[quantity]):
+
+                regression = {}
+                regression['scenario']  = result['scenario']
+                regression['stage']     = result['stage']
+                regression['n_objects'] = result['n_objects']
+                regression['quantity']  = quantity
+                regression['value']     = value
+                regression['baseline']  = base
+                regression['ratio']     = value/base
+                regressions.append(regression)
+
+    return regressions
+
+def print_regression(regression):
+
+    print('regression: %-13s %-20s %6i objects: %s %.4g (baseline %.4g, x%.2f)'
+          %(regression['scenario'], regression['stage'], regression['n_objects'], regression['quantity'], regression['value'], regression['baseline'], regression['ratio']))
+
+################
+# Command Line #
+################
+
+usage = '''usage: python -m genesis_metallicity.benchmark <output.json> [<baseline.json>] [options]
+
+benchmarks the pipeline and saves the results as a baseline; given an earlier baseline, prints the regressions
+(and exits with code 1 if there are any)
+
+options:
+  --kernel-engine <engine>      'exact', 'tabulated' or 'truncated' (default: 'tabulated')
+  --emissivity-engine <engine>  'exact' or 'tabulated' (default: 'tabulated')
+  --grid <grid>                 'full' or 'adaptive' (default: 'full')
+  --sizes <n,n,...>             synthetic catalog sizes (default: %s with the tabulated engines, %s otherwise,
+                                as the exact kernels take ~0.5 s per object)''' %(','.join(map(str, default_sizes)), ','.join(map(str, exact_sizes)))
+
+benchmark_options = {'kernel-engine': 'tabulated', 'emissivity-engine': 'tabulated', 'grid': 'full', 'sizes': None}
+
+def parse_arguments(argv):
+
+    paths   = []
+    options = dict(benchmark_options)
+
+    i = 0
+    while i < len(argv):
+
+        argument = argv[i]
+        i       += 1
+
+        if not argument.startswith('--'):
+            paths.append(argument)
+            continue
+
+        name = argument[2:]
+
+        if name not in benchmark_options:
+            raise ValueError('unknown option \'%s\'' %argument)
+        if i == len(argv):
+            raise ValueError('the option \'%s\' needs a value' %argument)
+
+        options[name] = argv[i]
+        i            += 1
+
+    if len(paths) not in [1, 2]:
+        raise ValueError('an output file (and optionally a baseline) is needed')
+
+    # the full catalogs only with the tabulated engines
+    if options['sizes'] is not None:
+        sizes = tuple(int(size) for size in options['sizes'].split(','))
+    elif (options['kernel-engine'] == 'tabulated') and (options['emissivity-engine'] == 'tabulated'):
+        sizes = default_sizes
+    else:
+        sizes = exact_sizes
+
+    settings = {}
+    settings['kernel_engine']     = options['kernel-engine']
+    settings['emissivity_engine'] = options['emissivity-engine']
+    settings['grid']              = options['grid']
+
+    return paths[0], (paths[1] if len(paths) == 2 else None), sizes, settings
+
+# python -m genesis_metallicity.benchmark results.json [baseline.json] [options]
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if (len(argv) == 0) or ('-h' in argv) or ('--help' in argv):
+        print(usage)
+        return 0
+
+    try:
+        output_path, baseline_path, sizes, settings = parse_arguments(argv)
+    except ValueError as error:
+        print('%s\n\n%s' %(error, usage), file=sys.stderr)
+        return 2
+
+    metadata = benchmark_metadata(**settings)
+    results  = run_benchmark(sizes=sizes, **settings)
+    save_baseline(output_path, results, metadata)
+
+    if baseline_path is None:
+        return 0
+
+    regressions = compare_benchmark(results, load_baseline(baseline_path), metadata)
+    for regression in regressions:
+        print_regression(regression)
+
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == '__main__':
+
+    sys.exit(main())
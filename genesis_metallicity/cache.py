@@ -0,0 +1,302 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import numpy as np
+from importlib import metadata
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# bump whenever the layout of the cache changes
+cache_format_version = 1
+
+# the largest a cache grows (in bytes) before the least recently used results are evicted
+default_cache_size = 2**30
+
+# the code the measurements depend on: these modules and subpackages (all their .py files) of the package, and the
+# data files; the command line, the service, the asyncio and parallel runners, the catalog readers and writers and
+# the benchmark are left out, so that editing them does not invalidate the cached results
+fingerprint_code = ['genesis_metallicity.py', 'diagnostics.py', 'posteriors.py', 'dust', 'kernel', 'metallicity', 'temperature']
+fingerprint_data = ['data/kernel_metallicity.npz', 'data/kernel_temperature.npz', 'data/lines.py']
+
+# the packages whose versions are part of the fingerprint
+fingerprint_packages = ['numpy', 'scipy', 'uncertainties', 'PyNeb']
+
+# the most keys in one SQLite query
+query_size = 500
+
+package_path = os.path.dirname(__file__)
+
+###############
+# Fingerprint #
+###############
+
+#---- the code, kernels and atomic-data versions the results depend on ----#
+
+code_fingerprint = None
+
+def get_code_fingerprint():
+
+    global code_fingerprint
+
+    if code_fingerprint is None:
+
+        paths = [os.path.join(package_path, path) for path in fingerprint_data]
+        for path in fingerprint_code:
+            if path.endswith('.py'):
+                paths.append(os.path.join(package_path, path))
+                continue
+            for directory, _, names in os.walk(os.path.join(package_path, path)):
+                paths += [os.path.join(directory, name) for name in names if name.endswith('.py')]
+
+        digest = hashlib.sha256()
+        for path in sorted(paths):
+            digest.update(os.path.relpath(path, package_path).encode())
+            with open(path, 'rb') as handle:
+                digest.update(hashlib.sha256(handle.read()).digest())
+
+        for package in fingerprint_packages:
+            try:
+                version = metadata.version(package)
+            except metadata.PackageNotFoundError:
+                version = None
+            digest.update(('%s=%s;' %(package, version)).encode())
+
+        code_fingerprint = digest.hexdigest()
+
+    return code_fingerprint
+
+#---- the fingerprint of a configuration of measure_catalog ----#
+
+def settings_fingerprint(settings):
+
+    content = {'version': cache_format_version, 'code': get_code_fingerprint(), 'settings': settings}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+###############
+# Cache Class #
+###############
+
+# an on-disk (SQLite) cache of the measure_catalog outputs of each object, keyed on the hash of its input
+# lines and of the configuration, code, kernels and atomic-data versions; the least recently used results
+# are evicted once the cache grows beyond max_size bytes; pass one to measure_catalog, run_parallel,
+# measure_file or run_batch (the hit and miss counts are those of the current process)
+class RESULT_CACHE:
+
+    def __init__(self, path, max_size=default_cache_size):
+
+        self.path     = str(path)
+        self.max_size = int(max_size)
+
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+
+        self.connection = None
+
+    #---- the connection is opened on first use (and not pickled, e.g. to the run_parallel workers) ----#
+
+    def connect(self):
+
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=60)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, method TEXT, value BLOB, size INTEGER, last_used REAL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS layouts (fingerprint TEXT PRIMARY KEY, columns TEXT)')
+            self.connection.commit()
+
+        return self.connection
+
+    def close(self):
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        state['connection'] = None
+        return state
+
+    #---- the key of each object ----#
+
+    # lines maps the backend lines to their (flux, err) arrays; the object names only enter the keys of the
+    # seeded Monte Carlo measurements, whose realizations depend on them
+    def keys(self, settings, lines, objects):
+
+        fingerprint = settings_fingerprint(settings)
+
+        # one canonical nan, and no negative zeros
+        values = np.stack([np.asarray(lines[line][i], dtype=float) for line in sorted(lines.keys()) for i in range(2)], axis=-1) + 0.0
+        values = np.ascontiguousarray(np.where(np.isnan(values), np.nan, values))
+
+        names = [str(object) for object in objects] if settings['uncertainty'] == 'montecarlo' else [''] * len(values)
+
+        keys = []
+        for row, name in zip(values, names):
+            digest = hashlib.sha256(fingerprint.encode())
+            digest.update(row.tobytes())
+            digest.update(name.encode())
+            keys.append(digest.hexdigest())
+
+        return fingerprint, np.array(keys)
+
+    #---- reading the results of the objects in the cache ----#
+
+    # returns a mask of the keys found, and the output columns of those objects (without 'object')
+    def get(self, fingerprint, keys):
+
+        connection = self.connect()
+
+        layout = connection.execute('SELECT columns FROM layouts WHERE fingerprint = ?', (fingerprint,)).fetchone()
+        found  = np.zeros(len(keys), dtype=bool)
+
+        if layout is None:
+            self.misses += len(keys)
+            return found, None
+
+        entries = {}
+        for lo in range(0, len(keys), query_size):
+            batch = list(keys[lo:lo+query_size])
+            query = 'SELECT key, method, value FROM entries WHERE key IN (%s)' %','.join('?'*len(batch))
+            for key, method, value in connection.execute(query, batch):
+                entries[key] = (method, value)
+
+        rows  = [i for i, key in enumerate(keys) if key in entries]
+        found[rows] = True
+
+        self.hits   += len(rows)
+        self.misses += len(keys) - len(rows)
+
+        if len(rows) == 0:
+            return found, None
+
+        # they are now the most recently used
+        with connection:
+            connection.executemany('UPDATE entries SET last_used = ? WHERE key = ?', [(time.time(), keys[i]) for i in rows])
+
+        #---- unpacking the values (one float64 vector per object) ----#
+
+        columns = json.loads(layout[0])
+        values  = np.array([np.frombuffer(entries[keys[i]][1], dtype=float) for i in rows]).reshape(len(rows), -1)
+
+        output_dict = {}
+
+        start = 0
+        for name, width, dtype in columns:
+
+            # the methods are kept as text
+            if name == 'metallicity_method':
+                output_dict[name] = np.array([entries[keys[i]][0] for i in rows], dtype=dtype)
+                continue
+
+            column            = values[:, start:start+width].astype(dtype)
+            output_dict[name] = column[:, 0] if width == 1 else column
+            start            += width
+
+        return found, output_dict
+
+    #---- adding the results of measured objects ----#
+
+    def put(self, fingerprint, keys, output_dict):
+
+        connection = self.connect()
+
+        # the output columns in their order, with their widths and types (the methods are kept as text)
+        layout  = []
+        columns = []
+
+        for name in output_dict.keys():
+
+            if name == 'object':
+                continue
+
+            column = np.asarray(output_dict[name]).reshape(len(keys), -1)
+            layout.append([name, 0 if name == 'metallicity_method' else column.shape[1], column.dtype.str])
+
+            if name != 'metallicity_method':
+                columns.append(column)
+
+        values = np.concatenate(columns, axis=1).astype(float) if len(keys) > 0 else None
+
+        now     = time.time()
+        entries = []
+        for i, key in enumerate(keys):
+            value = values[i].tobytes()
+            entries.append((key, str(output_dict['metallicity_method'][i]), value, len(key)+len(value), now))
+
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO layouts VALUES (?, ?)', (fingerprint, json.dumps(layout)))
+            connection.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', entries)
+
+        self.evict()
+
+    #---- evicting the least recently used results beyond max_size ----#
+
+    def evict(self):
+
+        connection = self.connect()
+
+        excess = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0] - self.max_size
+
+        if excess <= 0:
+            return
+
+        victims = []
+        for key, size in connection.execute('SELECT key, size FROM entries ORDER BY last_used, rowid'):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+
+        with connection:
+            connection.executemany('DELETE FROM entries WHERE key = ?', victims)
+
+        self.evictions += len(victims)
+        logger.debug('evicted %i results from %s', len(victims), self.path)
+
+    def clear(self):
+
+        connection = self.connect()
+
+        with connection:
+            connection.execute('DELETE FROM entries')
+            connection.execute('DELETE FROM layouts')
+
+    #---- statistics ----#
+
+    # the hit, miss and eviction counts, e.g. of a copy of the cache in a worker process, to be added to
+    # those of the parent with add_counts
+    def counts(self):
+
+        return self.hits, self.misses, self.evictions
+
+    def add_counts(self, hits, misses, evictions):
+
+        self.hits      += int(hits)
+        self.misses    += int(misses)
+        self.evictions += int(evictions)
+
+    def stats(self):
+
+        connection = self.connect()
+
+        entries, size = connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+
+        stats = {}
+        stats['hits']      = self.hits
+        stats['misses']    = self.misses
+        stats['hit_rate']  = self.hits/(self.hits+self.misses) if (self.hits+self.misses) > 0 else np.nan
+        stats['evictions'] = self.evictions
+        stats['entries']   = entries
+        stats['size']      = size
+        stats['max_size']  = self.max_size
+        return stats
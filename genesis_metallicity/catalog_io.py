@@ -0,0 +1,403 @@
+import os
+import csv
+import logging
+import numpy as np
+
+from .data.lines import lines_dict
+from .genesis_metallicity import measure_catalog
+from .metallicity.monte_carlo import default_n_samples
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# the number of catalog rows read, measured and written at a time
+default_chunk_size = 4096
+
+# the file extensions of each catalog format
+catalog_formats = {}
+catalog_formats['fits'] = ['.fits', '.fit', '.fts', '.fits.gz']
+catalog_formats['csv']  = ['.csv']
+catalog_formats['hdf5'] = ['.h5', '.hdf5', '.he5']
+
+# the extensions of compressed catalogs, which are read but not written (FITS_WRITER goes back to the header on close)
+compressed_extensions = ['.gz']
+
+# the width of the string columns of the FITS tables, unless the first chunk needs more
+default_string_width = 32
+
+##################
+# Column Mapping #
+##################
+
+#---- the format of a catalog, from its extension ----#
+
+def catalog_format(path, format=None):
+
+    if format is None:
+        for name, extensions in catalog_formats.items():
+            if any(str(path).lower().endswith(extension) for extension in extensions):
+                format = name
+
+    if format not in catalog_formats:
+        raise ValueError('unknown catalog format \'%s\' of %s; choose between \'fits\', \'csv\' and \'hdf5\'' %(format, path))
+    return format
+
+#---- the format of an output catalog, which cannot be compressed ----#
+
+def check_output_path(path, format=None):
+
+    if any(str(path).lower().endswith(extension) for extension in compressed_extensions):
+        raise ValueError('cannot write the compressed catalog %s; write it uncompressed and compress it afterwards' %path)
+    return catalog_format(path, format)
+
+#---- which columns hold the flux and error of each line ----#
+
+# columns maps the keys of lines_dict (e.g. 'O5007') to the (flux, error) column names of the catalog;
+# without it, every line with a '<line>' and a '<line>_err' column is read
+def line_columns(names, columns=None):
+
+    names = list(names)
+
+    if columns is None:
+        return {line: (line, line+'_err') for line in lines_dict.keys() if (line in names) and (line+'_err' in names)}
+
+    for line, (flux, err) in columns.items():
+        if line not in lines_dict:
+            raise ValueError('unknown line \'%s\' in the column mapping; see print_lines() for the accepted keys' %line)
+        for column in [flux, err]:
+            if column not in names:
+                raise ValueError('the column \'%s\' (of \'%s\') is not in the catalog' %(column, line))
+
+    return dict(columns)
+
+###########
+# Readers #
+###########
+
+# each reader yields (objects, chunk) for every chunk_size rows, where chunk maps the lines to their
+# flux arrays and '<line>_err' to their errors (the format measure_catalog reads); the objects are the
+# object_column, or the row numbers without one
+
+#---- FITS binary tables (memory-mapped, so only the rows of a chunk are read) ----#
+
+def fits_chunks(path, columns=None, object_column=None, chunk_size=default_chunk_size, hdu=1):
+
+    from astropy.io import fits
+
+    with fits.open(path, memmap=True) as handle:
+
+        data    = handle[hdu].data
+        mapping = line_columns(handle[hdu].columns.names, columns)
+        size    = 0 if data is None else len(data)
+
+        for lo in range(0, size, chunk_size):
+
+            rows  = data[lo:lo+chunk_size]
+            chunk = {}
+            for line, (flux, err) in mapping.items():
+                chunk[line]        = np.array(rows[flux], dtype=float)
+                chunk[line+'_err'] = np.array(rows[err], dtype=float)
+
+            objects = np.arange(lo, lo+len(rows)) if object_column is None else np.array(rows[object_column])
+            yield objects, chunk
+
+#---- HDF5 files: a group of 1D datasets (one per column) or a table (compound dataset) ----#
+
+def hdf5_chunks(path, columns=None, object_column=None, chunk_size=default_chunk_size, key=None):
+
+    import h5py
+
+    with h5py.File(path, 'r') as handle:
+
+        node = handle if key is None else handle[key]
+
+        if isinstance(node, h5py.Dataset):
+            names  = node.dtype.names
+            size   = len(node)
+            column = lambda name, lo, hi: node.fields(name)[lo:hi]
+        else:
+            names  = [name for name in node.keys() if isinstance(node[name], h5py.Dataset)]
+            size   = min([len(node[name]) for name in names]) if len(names) > 0 else 0
+            column = lambda name, lo, hi: node[name][lo:hi]
+
+        mapping = line_columns(names, columns)
+
+        for lo in range(0, size, chunk_size):
+
+            hi    = min(lo+chunk_size, size)
+            chunk = {}
+            for line, (flux, err) in mapping.items():
+                chunk[line]        = np.asarray(column(flux, lo, hi), dtype=float)
+                chunk[line+'_err'] = np.asarray(column(err, lo, hi), dtype=float)
+
+            if object_column is None:
+                objects = np.arange(lo, hi)
+            else:
+                objects = np.asarray(column(object_column, lo, hi))
+                if objects.dtype.kind == 'O':
+                    objects = np.array([name.decode() if isinstance(name, bytes) else name for name in objects], dtype=str)
+
+            yield objects, chunk
+
+#---- CSV files (empty fields are nan) ----#
+
+def csv_chunks(path, columns=None, object_column=None, chunk_size=default_chunk_size):
+
+    with open(path, 'r', newline='') as handle:
+
+        reader  = csv.reader(handle)
+        names   = [name.strip() for name in next(reader)]
+        mapping = line_columns(names, columns)
+        index   = {name: i for i, name in enumerate(names)}
+
+        def read_chunk(rows, lo):
+
+            chunk = {}
+            for line, (flux, err) in mapping.items():
+                chunk[line]        = np.array([row[index[flux]] or 'nan' for row in rows], dtype=float)
+                chunk[line+'_err'] = np.array([row[index[err]] or 'nan' for row in rows], dtype=float)
+
+            objects = np.arange(lo, lo+len(rows)) if object_column is None else np.array([row[index[object_column]] for row in rows])
+            return objects, chunk
+
+        rows = []
+        lo   = 0
+
+        for row in reader:
+            if len(row) == 0:
+                continue
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield read_chunk(rows, lo)
+                lo  += len(rows)
+                rows = []
+
+        if len(rows) > 0:
+            yield read_chunk(rows, lo)
+
+#---- any of the above, by format ----#
+
+def read_chunks(path, columns=None, object_column=None, chunk_size=default_chunk_size, format=None, hdu=1, key=None):
+
+    format = catalog_format(path, format)
+
+    if format == 'fits':
+        return fits_chunks(path, columns=columns, object_column=object_column, chunk_size=chunk_size, hdu=hdu)
+    if format == 'hdf5':
+        return hdf5_chunks(path, columns=columns, object_column=object_column, chunk_size=chunk_size, key=key)
+    return csv_chunks(path, columns=columns, object_column=object_column, chunk_size=chunk_size)
+
+###########
+# Writers #
+###########
+
+# each writer appends the output_dict of measure_catalog chunk by chunk, laying out its columns on the
+# first one; close() (or leaving a with block) finishes the file
+
+#---- CSV files (the 2D '<name>_pdf' columns are left out; see save_posteriors) ----#
+
+class CSV_WRITER:
+
+    def __init__(self, path):
+
+        self.path   = path
+        self.handle = open(path, 'w', newline='')
+        self.writer = csv.writer(self.handle)
+        self.names  = None
+        self.rows   = 0
+
+    def write(self, output_dict):
+
+        if self.names is None:
+            self.names = [name for name, column in output_dict.items() if np.ndim(column) == 1]
+            if len(self.names) < len(output_dict):
+                logger.warning('%s: the 2D columns (%s) are not written to CSV files', self.path, ', '.join(name for name in output_dict if name not in self.names))
+            self.writer.writerow(self.names)
+
+        self.writer.writerows(zip(*[np.asarray(output_dict[name]).tolist() for name in self.names]))
+        self.rows += len(output_dict[self.names[0]])
+
+    def close(self):
+
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#---- HDF5 files: one resizable dataset per column, in the root or in a group ----#
+
+class HDF5_WRITER:
+
+    def __init__(self, path, key=None, compression='gzip'):
+
+        import h5py
+
+        self.path        = path
+        self.handle      = h5py.File(path, 'w')
+        self.group       = self.handle if key is None else self.handle.create_group(key)
+        self.compression = compression
+        self.rows        = 0
+
+    def write(self, output_dict):
+
+        import h5py
+
+        size = len(next(iter(output_dict.values())))
+
+        for name, column in output_dict.items():
+
+            column = np.asarray(column)
+            string = column.dtype.kind in 'UO'
+
+            if name not in self.group:
+                dtype = h5py.string_dtype() if string else column.dtype
+                self.group.create_dataset(name, shape=(0,)+column.shape[1:], maxshape=(None,)+column.shape[1:], dtype=dtype,
+                                          chunks=(max(1, min(size, 1024)),)+column.shape[1:], compression=self.compression)
+
+            dataset = self.group[name]
+            dataset.resize(self.rows+size, axis=0)
+            dataset[self.rows:] = column.astype(str).astype(object) if string else column
+
+        self.rows += size
+
+    def close(self):
+
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#---- FITS binary tables, written row by row (the number of rows goes into the header on close) ----#
+
+class FITS_WRITER:
+
+    def __init__(self, path, string_width=default_string_width):
+
+        self.path         = path
+        self.handle       = open(path, 'wb')
+        self.string_width = string_width
+        self.dtype        = None
+        self.rows         = 0
+
+    def layout(self, output_dict):
+
+        from astropy.io import fits
+
+        fits_columns = []
+
+        for name, column in output_dict.items():
+
+            column = np.asarray(column)
+            shape  = column.shape[1:]
+            repeat = int(np.prod(shape)) if len(shape) > 0 else 1
+
+            if column.dtype.kind in 'UOS':
+                width = max([self.string_width] + [len(str(value)) for value in column])
+                fits_columns.append(fits.Column(name=name, format='%iA' %width))
+            elif column.dtype.kind in 'iub':
+                fits_columns.append(fits.Column(name=name, format='%iK' %repeat))
+            else:
+                fits_columns.append(fits.Column(name=name, format='%iD' %repeat, dim='(%s)' %','.join(str(n) for n in shape[::-1]) if len(shape) > 1 else None))
+
+        table = fits.BinTableHDU.from_columns(fits.ColDefs(fits_columns), nrows=0)
+
+        # the big-endian records of the table, and where its NAXIS2 card is
+        self.dtype  = np.dtype([(name, table.columns.dtype.fields[name][0].newbyteorder('>')) for name in table.columns.names])
+        self.widths = {name: self.dtype[name].itemsize for name in table.columns.names if self.dtype[name].kind == 'S'}
+
+        self.handle.write(fits.PrimaryHDU().header.tostring().encode('ascii'))
+        header            = table.header.tostring()
+        self.naxis2_start = self.handle.tell() + header.index('NAXIS2  =')
+        self.handle.write(header.encode('ascii'))
+
+    def write(self, output_dict):
+
+        if self.dtype is None:
+            self.layout(output_dict)
+
+        size    = len(next(iter(output_dict.values())))
+        records = np.zeros(size, dtype=self.dtype)
+
+        for name in self.dtype.names:
+
+            column = np.asarray(output_dict[name])
+
+            if name in self.widths:
+                column = column.astype(str)
+                if np.any(np.char.str_len(column) > self.widths[name]):
+                    raise ValueError('the \'%s\' column has values longer than the %i characters of the FITS table; pass a larger string_width' %(name, self.widths[name]))
+                column = np.char.encode(column, 'ascii')
+
+            records[name] = column.reshape(records[name].shape)
+
+        self.handle.write(records.tobytes())
+        self.rows += size
+
+    def close(self):
+
+        from astropy.io import fits
+
+        if self.handle.closed:
+            return
+
+        if self.dtype is None:
+            self.layout({})
+
+        # padding the data to the FITS block size, and writing the final number of rows
+        self.handle.write(b'\0' * (-self.handle.tell() % 2880))
+        self.handle.seek(self.naxis2_start)
+        self.handle.write(fits.Card('NAXIS2', self.rows, 'length of dimension 2').image.encode('ascii'))
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#---- any of the above, by format ----#
+
+def open_writer(path, format=None, key=None):
+
+    format = check_output_path(path, format)
+
+    if format == 'fits':
+        return FITS_WRITER(path)
+    if format == 'hdf5':
+        return HDF5_WRITER(path, key=key)
+    return CSV_WRITER(path)
+
+#########################
+# Streaming Measurement #
+#########################
+
+# reads the catalog at input_path chunk by chunk (see read_chunks), measures every chunk with measure_catalog
+# and appends its outputs to output_path, so that only one chunk is in memory at a time; returns the number
+# of objects written
+def measure_file(input_path, output_path, columns=None, object_column=None, chunk_size=default_chunk_size, input_format=None, output_format=None, hdu=1, input_key=None, output_key=None,
+                 correct_extinction=True, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                 uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', profiler=None, cache=None):
+
+    chunks = read_chunks(input_path, columns=columns, object_column=object_column, chunk_size=chunk_size, format=input_format, hdu=hdu, key=input_key)
+
+    with open_writer(output_path, format=output_format, key=output_key) as writer:
+
+        for objects, chunk in chunks:
+
+            output_dict = measure_catalog(chunk, objects=objects, correct_extinction=correct_extinction, t2_calibration=t2_calibration, global_den=global_den,
+                                          kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid, grid_resolution=grid_resolution, grid_length=grid_length,
+                                          posterior=posterior, uncertainty=uncertainty, n_samples=n_samples, seed=seed, extinction=extinction, profiler=profiler, cache=cache)
+            writer.write(output_dict)
+
+            logger.info('%s: measured %i objects', os.path.basename(str(input_path)), writer.rows)
+
+        return writer.rows
@@ -0,0 +1,409 @@
+import os
+import sys
+import json
+import shutil
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .cache import RESULT_CACHE, default_cache_size
+from .catalog_io import read_chunks, open_writer, check_output_path, default_chunk_size
+from .genesis_metallicity import preload
+from .metallicity.monte_carlo import default_n_samples
+from .parallel import measure_chunk
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# bump whenever the layout of the checkpoints changes
+checkpoint_format_version = 1
+
+# the command-line options and their defaults (the options with a boolean default are flags)
+cli_options = {}
+cli_options['columns']                  = None
+cli_options['object-column']            = None
+cli_options['chunk-size']               = default_chunk_size
+cli_options['workers']                  = 1
+cli_options['input-format']             = None
+cli_options['output-format']            = None
+cli_options['hdu']                      = 1
+cli_options['input-key']                = None
+cli_options['output-key']               = None
+cli_options['kernel-engine']            = 'exact'
+cli_options['emissivity-engine']        = 'exact'
+cli_options['grid']                     = 'full'
+cli_options['uncertainty']              = 'linear'
+cli_options['n-samples']                = default_n_samples
+cli_options['seed']                     = None
+cli_options['extinction']               = 'fixed'
+cli_options['cache']                    = None
+cli_options['cache-size']               = default_cache_size
+cli_options['posterior']                = False
+cli_options['no-extinction-correction'] = False
+cli_options['keep-checkpoint']          = False
+
+usage = '''usage: genesis-metallicity <input catalog> <output catalog> [options]
+
+measures the metallicities of a FITS, HDF5 or CSV line-flux catalog chunk by chunk; every chunk is
+checkpointed, and an interrupted run started again with the same arguments resumes where it stopped
+
+options:
+  --columns <json file or string>  mapping of the lines onto their (flux, error) columns, e.g.
+                                   '{"O5007": ["F_OIII_5007", "E_OIII_5007"]}' (default: <line>, <line>_err)
+  --object-column <name>           column of the object IDs (default: the row numbers)
+  --chunk-size <n>                 rows measured (and checkpointed) at a time (default: %i)
+  --workers <n>                    processes measuring the chunks (default: 1)
+  --input-format, --output-format  'fits', 'hdf5' or 'csv' (default: from the extension)
+  --hdu <n>                        HDU of a FITS input (default: 1)
+  --input-key, --output-key        HDF5 group (or table) of the input, and group of the output
+  --kernel-engine <engine>         'exact', 'tabulated' or 'truncated' (default: 'exact')
+  --emissivity-engine <engine>     'exact' or 'tabulated' (default: 'exact')
+  --grid <grid>                    'full' or 'adaptive' (default: 'full')
+  --uncertainty <engine>           'linear' or 'montecarlo' (default: 'linear')
+  --n-samples <n>                  Monte Carlo realizations per object (default: %i)
+  --seed <n>                       seed of the Monte Carlo realizations
+  --extinction <mode>              'fixed' or 'marginal', to integrate the metallicity over the uncertainty
+                                   of Av (default: 'fixed')
+  --cache <path>                   SQLite file of a result cache, so that the objects measured before (with
+                                   the same inputs and settings) are not measured again
+  --cache-size <bytes>             size of the cache beyond which the least recently used results are evicted
+                                   (default: %i)
+  --posterior                      also write the marginal posteriors (FITS and HDF5 outputs)
+  --no-extinction-correction       the line fluxes are already dereddened
+  --keep-checkpoint                keep the checkpoint directory once the output is written''' %(default_chunk_size, default_n_samples, default_cache_size)
+
+###############
+# Checkpoints #
+###############
+
+# the checkpoint of an output is a directory next to it, with a manifest and one .npz part per measured chunk
+# (named after the first catalog row it holds); both are written to temporary files and renamed, so a run
+# that is killed leaves either a complete part or none
+
+def checkpoint_path(output_path):
+
+    return str(output_path) + '.checkpoint'
+
+def write_json(path, content):
+
+    with open(path+'.tmp', 'w') as handle:
+        json.dump(content, handle, indent=1)
+    os.replace(path+'.tmp', path)
+
+def save_part(directory, first_row, output_dict):
+
+    name = 'rows_%012i.npz' %first_row
+    path = os.path.join(directory, name)
+
+    # no object arrays, so that the parts load without pickle
+    columns = {column: (np.asarray(values).astype(str) if np.asarray(values).dtype.kind == 'O' else np.asarray(values)) for column, values in output_dict.items()}
+
+    with open(path+'.tmp', 'wb') as handle:
+        np.savez(handle, **columns)
+    os.replace(path+'.tmp', path)
+
+    return name
+
+def load_part(directory, name):
+
+    with np.load(os.path.join(directory, name)) as part:
+        return {column: part[column] for column in part.files}
+
+#---- the manifest of a run: its input, settings and parts ----#
+
+def input_identity(input_path):
+
+    stat = os.stat(input_path)
+    return {'path': os.path.abspath(input_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+# returns the manifest to continue from (a new one if there is no checkpoint)
+def open_checkpoint(directory, input_path, settings):
+
+    manifest_path = os.path.join(directory, 'manifest.json')
+
+    manifest = {}
+    manifest['version']  = checkpoint_format_version
+    manifest['input']    = input_identity(input_path)
+    manifest['settings'] = settings
+    manifest['parts']    = []
+
+    # as it reads back (tuples become lists)
+    manifest = json.loads(json.dumps(manifest))
+
+    if not os.path.exists(manifest_path):
+        os.makedirs(directory, exist_ok=True)
+        write_json(manifest_path, manifest)
+        return manifest
+
+    with open(manifest_path, 'r') as handle:
+        previous = json.load(handle)
+
+    for key in ['version', 'input', 'settings']:
+        if previous[key] != manifest[key]:
+            raise ValueError('the checkpoint in %s was made with a different %s; remove it to start over' %(directory, key))
+
+    return previous
+
+#---- the objects already measured are recognized by their IDs, so these must be unique ----#
+
+# only the object column is read (an empty column mapping reads no line)
+def check_unique_objects(input_path, object_column=None, chunk_size=default_chunk_size, format=None, hdu=1, key=None):
+
+    # the row numbers are unique
+    if object_column is None:
+        return
+
+    objects = [chunk_objects for chunk_objects, chunk in read_chunks(input_path, columns={}, object_column=object_column, chunk_size=chunk_size, format=format, hdu=hdu, key=key)]
+    objects = np.concatenate(objects) if len(objects) > 0 else np.array([])
+
+    names, counts = np.unique(objects, return_counts=True)
+
+    if np.any(counts > 1):
+        raise ValueError('the object IDs of column \'%s\' in %s are not unique (e.g. \'%s\'); a checkpointed run needs unique IDs' %(object_column, input_path, names[counts > 1][0]))
+
+####################
+# Checkpointed Run #
+####################
+
+#---- measure_chunk in a worker, with what its copy of the cache counted (None without a cache) ----#
+
+def measure_counted_chunk(chunk, objects, settings):
+
+    cache = settings['cache']
+
+    if cache is None:
+        return measure_chunk(chunk, objects, settings)[0], None
+
+    before      = cache.counts()
+    output_dict = measure_chunk(chunk, objects, settings)[0]
+
+    return output_dict, tuple(after-start for after, start in zip(cache.counts(), before))
+
+# measures the catalog at input_path chunk by chunk (on n_workers processes), checkpointing every chunk; the
+# objects of the parts already in the checkpoint are skipped, so a run started again with the same arguments
+# resumes where it stopped (duplicate object IDs are rejected up front); once all the chunks are measured, the parts are
+# written to output_path in the catalog order, with the 'error' column of run_parallel; returns the number of
+# objects written
+def run_batch(input_path, output_path, columns=None, object_column=None, chunk_size=default_chunk_size, n_workers=1, input_format=None, output_format=None, hdu=1, input_key=None, output_key=None,
+              correct_extinction=True, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+              uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', cache=None, keep_checkpoint=False):
+
+    settings = {}
+    settings['correct_extinction'] = correct_extinction
+    settings['t2_calibration']     = t2_calibration
+    settings['global_den']         = global_den
+    settings['kernel_engine']      = kernel_engine
+    settings['emissivity_engine']  = emissivity_engine
+    settings['grid']               = grid
+    settings['grid_resolution']    = grid_resolution
+    settings['grid_length']        = grid_length
+    settings['posterior']          = posterior
+    settings['uncertainty']        = uncertainty
+    settings['n_samples']          = n_samples
+    settings['seed']               = seed
+    settings['extinction']         = extinction
+
+    # the settings that change the outputs (not the chunking, the number of workers or the cache)
+    run_settings = dict(settings, columns=columns, object_column=object_column, hdu=hdu, input_key=input_key)
+
+    settings['cache'] = cache
+
+    # the output is only written at the end, so that a path it cannot be written to fails before the run
+    check_output_path(output_path, output_format)
+
+    directory = checkpoint_path(output_path)
+
+    # a checkpoint is only resumed with the same input, whose object IDs were checked when it was made
+    if not os.path.exists(os.path.join(directory, 'manifest.json')):
+        check_unique_objects(input_path, object_column=object_column, chunk_size=chunk_size, format=input_format, hdu=hdu, key=input_key)
+
+    manifest = open_checkpoint(directory, input_path, run_settings)
+
+    #---- the objects that are already measured ----#
+
+    done = [load_part(directory, part['file'])['object'] for part in manifest['parts']]
+    done = np.concatenate(done) if len(done) > 0 else np.array([])
+
+    if len(done) > 0:
+        logger.info('resuming from %s: %i objects already measured', directory, len(done))
+
+    #---- the chunks that are left ----#
+
+    def todo_chunks():
+
+        first_row = 0
+
+        for objects, chunk in read_chunks(input_path, columns=columns, object_column=object_column, chunk_size=chunk_size, format=input_format, hdu=hdu, key=input_key):
+
+            rows       = np.where(~np.isin(objects, done))[0] if len(done) > 0 else np.arange(len(objects))
+            chunk_rows = first_row + rows
+            first_row += len(objects)
+
+            if len(rows) > 0:
+                yield int(chunk_rows[0]), objects[rows], {line: [chunk[line][rows], chunk[line+'_err'][rows]] for line in chunk.keys() if not line.endswith('_err')}
+
+    # counts are those of the cache of a worker (None in this process)
+    def finish(first_row, output_dict, counts=None):
+
+        if counts is not None:
+            cache.add_counts(*counts)
+
+        manifest['parts'].append({'file': save_part(directory, first_row, output_dict), 'first_row': first_row, 'objects': len(output_dict['object']),
+                                  'failed': int(np.sum(output_dict['error'] != ''))})
+        write_json(os.path.join(directory, 'manifest.json'), manifest)
+
+        logger.info('measured %i objects', sum(part['objects'] for part in manifest['parts']))
+
+    #---- measuring the chunks ----#
+
+    preload(kernel_engine, emissivity_engine, global_den)
+
+    if n_workers <= 1:
+        for first_row, objects, chunk in todo_chunks():
+            finish(first_row, measure_chunk(chunk, objects, settings)[0])
+
+    else:
+        # at most two chunks per worker are read ahead, so that the memory stays bounded
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=preload, initargs=(kernel_engine, emissivity_engine, global_den)) as executor:
+
+            pending = {}
+
+            for first_row, objects, chunk in todo_chunks():
+
+                pending[executor.submit(measure_counted_chunk, chunk, objects, settings)] = first_row
+
+                while len(pending) >= 2*n_workers:
+                    completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        finish(pending.pop(future), *future.result())
+
+            for future in list(pending):
+                finish(pending.pop(future), *future.result())
+
+    #---- writing the output in the catalog order ----#
+
+    parts = sorted(manifest['parts'], key=lambda part: part['first_row'])
+
+    with open_writer(output_path, format=output_format, key=output_key) as writer:
+        for part in parts:
+            writer.write(load_part(directory, part['file']))
+        size = writer.rows
+
+    failed = sum(part['failed'] for part in parts)
+    if failed > 0:
+        logger.warning('%i objects failed; see the \'error\' column', failed)
+
+    if not keep_checkpoint:
+        shutil.rmtree(directory)
+
+    return size
+
+################
+# Command Line #
+################
+
+#---- the options of the command line as keyword arguments of run_batch ----#
+
+def parse_arguments(argv):
+
+    paths   = []
+    options = dict(cli_options)
+
+    i = 0
+    while i < len(argv):
+
+        argument = argv[i]
+        i       += 1
+
+        if not argument.startswith('--'):
+            paths.append(argument)
+            continue
+
+        name = argument[2:]
+
+        if name not in cli_options:
+            raise ValueError('unknown option \'%s\'' %argument)
+
+        if isinstance(cli_options[name], bool):
+            options[name] = True
+            continue
+
+        if i == len(argv):
+            raise ValueError('the option \'%s\' needs a value' %argument)
+
+        value = argv[i]
+        i    += 1
+
+        if isinstance(cli_options[name], int) or (name == 'seed'):
+            value = int(value)
+        options[name] = value
+
+    if len(paths) != 2:
+        raise ValueError('an input and an output catalog are needed')
+
+    # a mapping given as a file, or as a json string
+    columns = options['columns']
+    if columns is not None:
+        if os.path.exists(columns):
+            with open(columns, 'r') as handle:
+                columns = json.load(handle)
+        else:
+            columns = json.loads(columns)
+        columns = {line: tuple(pair) for line, pair in columns.items()}
+
+    kwargs = {}
+    kwargs['columns']            = columns
+    kwargs['object_column']      = options['object-column']
+    kwargs['chunk_size']         = options['chunk-size']
+    kwargs['n_workers']          = options['workers']
+    kwargs['input_format']       = options['input-format']
+    kwargs['output_format']      = options['output-format']
+    kwargs['hdu']                = options['hdu']
+    kwargs['input_key']          = options['input-key']
+    kwargs['output_key']         = options['output-key']
+    kwargs['kernel_engine']      = options['kernel-engine']
+    kwargs['emissivity_engine']  = options['emissivity-engine']
+    kwargs['grid']               = options['grid']
+    kwargs['uncertainty']        = options['uncertainty']
+    kwargs['n_samples']          = options['n-samples']
+    kwargs['seed']               = options['seed']
+    kwargs['extinction']         = options['extinction']
+    kwargs['cache']              = RESULT_CACHE(options['cache'], options['cache-size']) if options['cache'] is not None else None
+    kwargs['posterior']          = options['posterior']
+    kwargs['correct_extinction'] = not options['no-extinction-correction']
+    kwargs['keep_checkpoint']    = options['keep-checkpoint']
+
+    return paths[0], paths[1], kwargs
+
+#---- the genesis-metallicity console script ----#
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if (len(argv) == 0) or ('-h' in argv) or ('--help' in argv):
+        print(usage)
+        return 0
+
+    try:
+        input_path, output_path, kwargs = parse_arguments(argv)
+    except ValueError as error:
+        print('%s\n\n%s' %(error, usage), file=sys.stderr)
+        return 2
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    size = run_batch(input_path, output_path, **kwargs)
+    logger.info('wrote %i objects to %s', size, output_path)
+
+    if kwargs['cache'] is not None:
+        stats = kwargs['cache'].stats()
+        logger.info('cache: %i hits, %i misses, %i entries, %.1f MB', stats['hits'], stats['misses'], stats['entries'], stats['size']/1e+6)
+    return 0
+
+if __name__ == '__main__':
+
+    sys.exit(main())
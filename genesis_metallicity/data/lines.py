@@ -126,26 +126,25 @@ description_dict['O4959']   = ': can accept as \'OIII\' if not resolved from \'O
 description_dict['O5007']   = ': can accept as \'OIII\' if not resolved from \'O4959\''
 description_dict['OII7320'] = ': sum of the \'O7320\' and \'O7330\' lines (can accept the components separately)'
 
-def print_lines():
+# the table of the required and optional lines, as printed by print_lines (and logged when a required line is missing)
+def lines_table():
 
-    print('------------------------------------------------------------------------------------------')
-    print(' -> these are the required lines:')
-    print('(missing any of these lines will raise errors)')
-    print('..............................................')
+    table  = ['------------------------------------------------------------------------------------------']
+    table += [' -> these are the required lines:']
+    table += ['(missing any of these lines will raise errors)']
+    table += ['..............................................']
     for line in required_lines:
-        try:
-            description = description_dict[line]
-        except:
-            description = ' '
-        print('    %s %s' %(line, description))
-
-    print('------------------------------------------------------------------------------------------')
-    print(' -> these are the optional lines:')
-    print('(code can function without them)')
-    print('..............................................')
+        table += ['    %s %s' %(line, description_dict.get(line, ' '))]
+
+    table += ['------------------------------------------------------------------------------------------']
+    table += [' -> these are the optional lines:']
+    table += ['(code can function without them)']
+    table += ['..............................................']
     for line in optional_lines:
-        try:
-            description = description_dict[line]
-        except:
-            description = ' '
-        print('    %s %s' %(line, description))
+        table += ['    %s %s' %(line, description_dict.get(line, ' '))]
+
+    return '\n'.join(table)
+
+def print_lines():
+
+    print(lines_table())
@@ -0,0 +1,42 @@
+import numpy as np
+
+##########
+# Config #
+##########
+
+# the status of a measurement is the bitwise or of these flags (0 when nothing happened)
+status_flags = {}
+status_flags['missing_line']    = 1    # a line needed by the metallicity method is missing (or not finite)
+status_flags['no_extinction']   = 2    # Av could not be fit (fewer than two Balmer lines), so the lines were not dereddened
+status_flags['invalid_lines']   = 4    # zero [OIII]5007 or Hbeta, or an undefined Te([OIII]), so there is no direct-method measurement
+status_flags['t2_grid_failed']  = 8    # the grid of the Langeroodi+2024 t2 could not be built (zero or non-finite inputs)
+status_flags['grid_failed']     = 16   # the grid of the strong-line metallicity could not be built (zero or non-finite inputs)
+status_flags['Te_OIII_clipped'] = 32   # the upper error of Te([OIII]) clipped at 3e4 K
+status_flags['Te_OII_clipped']  = 64   # Te([OII]) or its upper error clipped at 3e4 K
+status_flags['branch_unc']      = 128  # the branch is only consistent within the metallicity uncertainty
+status_flags['branch_max']      = 256  # the branch is only consistent within the maximum tolerance (0.15 dex)
+status_flags['no_branch']       = 512  # no branch is consistent with its metallicity
+status_flags['error']           = 1024 # an unexpected error (logged, or in the 'error' column of run_parallel)
+status_flags['few_samples']     = 2048 # fewer than 95% of the Monte Carlo realizations have a metallicity (the others are dropped)
+
+# the flag of the tolerance level a branch was accepted at
+tolerance_flags = {'no': 0, 'unc': status_flags['branch_unc'], 'max': status_flags['branch_max']}
+
+###############
+# Status Code #
+###############
+
+#---- the names of the flags set in a status code ----#
+
+def status_names(status):
+
+    return [name for name, flag in status_flags.items() if int(status) & flag]
+
+#---- a boolean mask of the objects (status codes) with a flag set ----#
+
+def has_flag(status, name):
+
+    if name not in status_flags:
+        raise ValueError('unknown status flag \'%s\'; choose between %s' %(name, ', '.join('\'%s\'' %flag for flag in status_flags)))
+
+    return (np.asarray(status) & status_flags[name]) != 0
@@ -6,6 +6,9 @@ import numpy as np
 
 def KC13(lambda_array, Av, delta=None, Eb=None, Rv=4.05, return_AxAv=False):
 
+    # lambda_array can be a scalar or an array of any shape (in AA)
+    lambda_array = np.asarray(lambda_array, dtype=float)
+
     #---- converting between delta & Eb if one is not provided (eq 3) ----#
 
     if Eb is None:
@@ -17,20 +20,20 @@ def KC13(lambda_array, Av, delta=None, Eb=None, Rv=4.05, return_AxAv=False):
 
     #---- calzetti ----#
 
-    k_lambda = np.zeros(len(lambda_array))
-
     transition_lambda = 6300 # AA
-    transition_index  = np.argmin(np.abs(lambda_array-transition_lambda))
+    lambda_micron     = lambda_array*1e-4
 
     # 0.12 - 0.63 micron
-    k_lambda[:transition_index] = 2.659 * (-2.156
-                                        + 1.509/(lambda_array[:transition_index]*1e-4)
-                                        - 0.198/np.power(lambda_array[:transition_index]*1e-4,2)
-                                        + 0.011/np.power(lambda_array[:transition_index]*1e-4,3)) + Rv
+    k_lambda_blue = 2.659 * (-2.156
+                             + 1.509/lambda_micron
+                             - 0.198/np.power(lambda_micron,2)
+                             + 0.011/np.power(lambda_micron,3)) + Rv
 
     # 0.63 - 2.20 micron
-    k_lambda[transition_index:] = 2.659 * (-1.857
-                                        + 1.040/(lambda_array[transition_index:]*1e-4)) + Rv
+    k_lambda_red  = 2.659 * (-1.857
+                             + 1.040/lambda_micron) + Rv
+
+    k_lambda = np.where(lambda_array < transition_lambda, k_lambda_blue, k_lambda_red)
 
     #---- druid ----#
 
@@ -40,12 +43,14 @@ def KC13(lambda_array, Av, delta=None, Eb=None, Rv=4.05, return_AxAv=False):
 
     #---- kriek & conroy ----#
 
-    # calculating A_lambda
+    # calculating A_lambda/Av (so that it is defined for Av=0 too) and A_lambda
     lambda_v = 5500 # AA
-    A_lambda = (Av/Rv) * (k_lambda + D_lambda) * np.power(lambda_array/lambda_v,delta)
+    AxAv     = (1/Rv) * (k_lambda + D_lambda) * np.power(lambda_array/lambda_v,delta)
 
     if return_AxAv:
-        return A_lambda/Av
+        return AxAv
+
+    A_lambda = Av * AxAv
 
     #---- outputing extinguish/fraction ----#
 
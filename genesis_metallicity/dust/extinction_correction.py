@@ -1,17 +1,19 @@
+import logging
 import warnings
 import numpy as np
 from copy import deepcopy
-from scipy.optimize import curve_fit
-from scipy.optimize import OptimizeWarning
 from uncertainties import ufloat
 from uncertainties import unumpy as unp
 
 from ..data.lines import lines_dict
+from ..diagnostics import status_flags
+from ..profiler import profile_stage
 from .attenuation import KC13
 
 warnings.filterwarnings('ignore', category=RuntimeWarning, message='divide by zero encountered in double_scalars')
 warnings.filterwarnings('ignore', category=RuntimeWarning, message='invalid value encountered in double_scalars')
-warnings.filterwarnings('ignore', category=OptimizeWarning)
+
+logger = logging.getLogger(__name__)
 
 ##############
 # Line Class #
@@ -33,179 +35,223 @@ class EMISSION_LINES:
     #---- initiating the class ----#
 
     # line_flux is array of ufloat
-    def __init__(self, object, data_dict, ignore_Ha=False, print_progress=False):
+    def __init__(self, object, data_dict, ignore_Ha=False, print_progress=False, profiler=None):
 
         self.object = object
 
-        if print_progress:
-            print('--------------------------')
-            print('object: %s' %object)
-            print('--------------------------')
-
-        try:
-            self.Hd = LINE(data_dict['Hdelta'], lines_dict['Hdelta']['lambda'])
-        except:
-            self.Hd = LINE(ufloat(np.nan, np.nan), lines_dict['Hdelta']['lambda'])
+        # the print_progress messages are logged at the info level, and at the debug level otherwise
+        level = logging.INFO if print_progress else logging.DEBUG
 
+        self.Hd = LINE(data_dict.get('Hdelta', ufloat(np.nan, np.nan)), lines_dict['Hdelta']['lambda'])
         self.Hg = LINE(data_dict['Hgamma'], lines_dict['Hgamma']['lambda'])
         self.Hb = LINE(data_dict['Hbeta'], lines_dict['Hbeta']['lambda'])
         self.Ha = LINE(data_dict['Halpha'], lines_dict['Halpha']['lambda'])
 
+        #---- fitting Av to the Balmer decrements ----#
+
         if ignore_Ha:
             self.Ha = LINE(ufloat(np.nan, np.nan), lines_dict['Halpha']['lambda'])
 
-        #---- setting up the flux and fluxerr arrays ----#
+        balmer_flux    = np.array([self.Hd.line_flux.n, self.Hg.line_flux.n, self.Hb.line_flux.n, self.Ha.line_flux.n])
+        balmer_fluxerr = np.array([self.Hd.line_flux.s, self.Hg.line_flux.s, self.Hb.line_flux.s, self.Ha.line_flux.s])
 
-        # normalizing the Balmer lines to Hb
-        try:
-            norm_Hd_flux = self.Hd.line_flux/self.Hb.line_flux
-        except:
-            norm_Hd_flux = ufloat(np.nan, np.nan)
+        with profile_stage(profiler, 'dust_fit'):
+            Av, Av_sigma = measure_extinction(balmer_flux, balmer_fluxerr)
+        self.Av       = Av[0]
+        self.Av_sigma = Av_sigma[0]
 
-        try:
-            norm_Hg_flux = self.Hg.line_flux/self.Hb.line_flux
-        except:
-            norm_Hg_flux = ufloat(np.nan, np.nan)
+        if logger.isEnabledFor(level):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                logger.log(level, 'object %s: Balmer fluxes %s +/- %s, HbHd (3.86) = %.3g, HbHg (2.14) = %.3g, HaHb (2.86) = %.3g, Av = %.3g',
+                           object, balmer_flux, balmer_fluxerr, balmer_flux[2]/balmer_flux[0], balmer_flux[2]/balmer_flux[1], balmer_flux[3]/balmer_flux[2], self.Av)
 
-        try:
-            norm_Hb_flux = self.Hb.line_flux/self.Hb.line_flux
-        except:
-            norm_Hb_flux = ufloat(np.nan, np.nan)
+        #---- the status flags (see diagnostics.status_flags) ----#
 
-        try:
-            norm_Ha_flux = self.Ha.line_flux/self.Hb.line_flux
-        except:
-            norm_Ha_flux = ufloat(np.nan, np.nan)
+        correct = not data_dict.get('red._corr.', False)
 
-        # making the arrays
-        flux_array    = np.array([norm_Hd_flux.n, norm_Hg_flux.n, norm_Hb_flux.n, norm_Ha_flux.n])
+        # Av is nan when fewer than two Balmer lines are measured
+        self.status = 0
+        if correct and np.isnan(self.Av):
+            self.status |= status_flags['no_extinction']
 
-        fluxerr_array = np.array([norm_Hd_flux.s,
-                                  norm_Hg_flux.s,
-                                  norm_Hb_flux.s,
-                                  norm_Ha_flux.s])
+        #---- function for dereddening ----#
 
-        mask          = np.where(~((flux_array == 0) | (np.isnan(flux_array))))[0]
+        def deredden(line_flux, line, Av):
 
-        flux_array    = flux_array[mask]
-        fluxerr_array = fluxerr_array[mask]
+            ext = 10**(-0.4*extinction_coefficient(line)*Av)
+            line_flux = line_flux / ext
 
-        # flooring the errors
-        for i in range(len(flux_array)):
-            if fluxerr_array[i] == 0:
-                fluxerr_array[i] = flux_array[i] * 0.05
+            return line_flux
 
-        #---- function for reddening ----#
+        #---- dereddening all the lines ----#
 
-        def redden(line_flux, line_lambda, Av):
+        self.corrected_dict = {}
 
-            lambda_array = np.linspace(line_lambda, 1e+4, 1000)
-            ext = KC13(lambda_array, Av, delta=0, Eb=0, return_AxAv=True)
-            ext = 10**(-0.4*ext*Av)
-            line_flux = line_flux * ext[0]
+        correct = correct and (self.Av > 0.01)
 
-            return line_flux
+        with profile_stage(profiler, 'dereddening'):
+            for line in data_dict.keys():
+                if line not in ['redshift', 'metallicity', 'red._corr.']:
 
-        #---- function for dereddening ----#
+                    line_flux = deepcopy(data_dict[line])
 
-        def deredden(line_flux, line_lambda, Av):
+                    # the keys that are not lines (with no wavelength) cannot be dereddened
+                    if correct and (line not in lines_dict):
+                        line_flux = np.nan
+                    elif correct:
+                        line_flux = deredden(line_flux, line, self.Av)
 
-            lambda_array = np.linspace(line_lambda, 1e+4, 1000)
-            ext = KC13(lambda_array, Av, delta=0, Eb=0, return_AxAv=True)
-            ext = 10**(-0.4*ext*Av)
-            line_flux = line_flux / ext[0]
+                    self.corrected_dict[line] = line_flux
 
-            return line_flux
+#############################################
+# Extinction Correction for Arrays of Lines #
+#############################################
 
-        #---- function that models the observed lines ----#
+#---- built-in Balmer decrements (same as EMISSION_LINES) ----#
 
-        def model_lines(x, Av):
+balmer_lines      = np.array(['Hdelta', 'Hgamma', 'Hbeta', 'Halpha'])
+balmer_decrements = np.array([1.00/3.86, 1.00/2.14, 1.00, 1.00*2.86])
 
-            # built-in EMISSION_LINESs
-            HbHd = 3.86
-            HbHg = 2.14
-            HaHb = 2.86
+#---- A_lambda/Av of the lines in lines_dict (calculated once per line and attenuation curve) ----#
 
-            # line fluxes
-            Hd_flux = 1.00/HbHd
-            Hg_flux = 1.00/HbHg
-            Hb_flux = 1.00
-            Ha_flux = 1.00*HaHb
+AxAv_cache = {}
 
-            # reddening
-            Hd_flux = redden(Hd_flux, self.Hd.line_lambda, Av)
-            Hg_flux = redden(Hg_flux, self.Hg.line_lambda, Av)
-            Hb_flux = redden(Hb_flux, self.Hb.line_lambda, Av)
-            Ha_flux = redden(Ha_flux, self.Ha.line_lambda, Av)
+def extinction_coefficient(line, Rv=4.05, delta=0, Eb=0):
 
-            # output
-            if Av < 0:
-                output_array = np.array([np.inf, np.inf, np.inf, np.inf])
-            else:
-                output_array = np.array([Hd_flux, Hg_flux, Hb_flux, Ha_flux])/Hb_flux
-            output_array = output_array[mask]
+    key = (line, Rv, delta, Eb)
 
-            if False:
-                try:
-                    print(Av, ';', output_array[1]/output_array[0], output_array[2]/output_array[1])
-                except:
-                    try:
-                        print(Av, ';', output_array[1]/output_array[0])
-                    except:
-                        print(Av, ';', output_array[2]/output_array[1])
+    if key not in AxAv_cache:
+        AxAv_cache[key] = float(KC13(lines_dict[line]['lambda'], 1, delta=delta, Eb=Eb, Rv=Rv, return_AxAv=True))
+    return AxAv_cache[key]
 
-            return output_array
+#---- A_lambda/Av of several lines as an array (for dereddening whole catalogs at once) ----#
 
-        #---- fitting ----#
+def extinction_table(lines, Rv=4.05, delta=0, Eb=0):
 
-        if len(mask) > 1:
+    return np.array([extinction_coefficient(line, Rv=Rv, delta=delta, Eb=Eb) for line in lines])
 
-            if print_progress:
-                print('flux', flux_array)
-                print('fluxerr', fluxerr_array)
+#---- fitting Av to the Balmer decrements of many objects at once ----#
 
-            popt, pcov = curve_fit(model_lines, np.array([0,0,0]), flux_array, sigma=fluxerr_array, absolute_sigma=True)
+# flux and fluxerr have shape (N, 4) and follow the order of balmer_lines;
+# fit='flux' minimises the same chi2 as the former curve_fit in EMISSION_LINES, while fit='magnitude'
+# returns the closed-form solution of the fit linearised in magnitudes (only reliable for well-detected lines)
+def measure_extinction(flux, fluxerr, fit='flux', max_iterations=100, tolerance=1e-10):
 
-            Av       = popt[0]
-            Av_sigma = np.sqrt(np.diag(pcov))
+    if fit not in ['flux', 'magnitude']:
+        raise ValueError('unknown extinction fit \'%s\'; choose between \'flux\' and \'magnitude\'' %fit)
 
-            self.Av  = Av
+    flux    = np.atleast_2d(np.asarray(flux, dtype=float))
+    fluxerr = np.atleast_2d(np.asarray(fluxerr, dtype=float))
 
-        if len(mask) <= 1:
-            self.Av = np.nan
+    # normalizing the Balmer lines to Hb
+    Hb_index = 2
+    Hb       = flux[:, [Hb_index]]
+    Hb_err   = fluxerr[:, [Hb_index]]
 
-        try:
-            if print_progress: print('HbHd (3.86) = ', self.Hb.line_flux/self.Hd.line_flux)
-        except: a = 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_flux    = flux/Hb
+        norm_fluxerr = np.sqrt(np.power(fluxerr/Hb, 2) + np.power(flux*Hb_err/np.power(Hb, 2), 2))
 
-        try:
-            if print_progress: print('HbHg (2.14) = ', self.Hb.line_flux/self.Hg.line_flux)
-        except: a = 1
+    # Hb/Hb is exactly one with no uncertainty
+    norm_fluxerr[:, Hb_index] = 0.0
 
-        try:
-            if print_progress: print('HaHb (2.86) = ', self.Ha.line_flux/self.Hb.line_flux)
-        except: a = 1
+    mask = ~((norm_flux == 0) | np.isnan(norm_flux))
 
-        if print_progress: print('Av          = ', self.Av)
+    # flooring the errors
+    norm_fluxerr = np.where(norm_fluxerr == 0, norm_flux*0.05, norm_fluxerr)
 
-        #---- dereddening all the lines ----#
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(mask, 1/np.power(norm_fluxerr, 2), 0.0)
+    norm_flux = np.where(mask, norm_flux, 0.0)
 
-        self.corrected_dict = {}
+    #---- the reddened model decrements are R*exp(-c*Av) ----#
 
-        for line in data_dict.keys():
-            if line not in ['redshift', 'metallicity', 'red._corr.']:
+    AxAv = extinction_table(balmer_lines)
+    c    = 0.4*np.log(10)*(AxAv-AxAv[Hb_index])
 
-                try:
-                    line_flux   = deepcopy(data_dict[line])
-                    line_lambda = lines_dict[line]['lambda']
+    def chi2(Av, rows=slice(None)):
+        model = balmer_decrements * np.exp(-c*Av[:, None])
+        return np.sum(weight[rows]*np.power(norm_flux[rows]-model, 2), axis=1)
 
-                    if (not data_dict['red._corr.']) and (self.Av > 0.01):
-                        line_flux   = deredden(line_flux, line_lambda, self.Av)
+    insufficient = np.sum(mask, axis=1) <= 1
 
-                    self.corrected_dict[line] = line_flux
+    #---- closed-form solution in magnitudes: ln(flux/R) = -c*Av, with ln-space uncertainties fluxerr/flux ----#
+
+    if fit == 'magnitude':
+
+        linear_weight = np.where(norm_flux > 0, weight*np.power(norm_flux, 2), 0.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_decrement = np.where(linear_weight > 0, np.log(norm_flux/balmer_decrements), 0.0)
+            Av            = np.maximum(-np.sum(linear_weight*c*log_decrement, axis=1)/np.sum(linear_weight*np.power(c, 2), axis=1), 0.0)
+            Av_sigma      = np.sqrt(1/np.sum(linear_weight*np.power(c, 2), axis=1))
+
+        Av[insufficient]       = np.nan
+        Av_sigma[insufficient] = np.nan
+        return Av, Av_sigma
+
+    #---- Gauss-Newton with backtracking, starting from Av=1 as curve_fit does ----#
+
+    # (not from the closed-form solution: the chi2 can have several minima, and the one curve_fit finds is kept)
+    Av        = np.ones(len(flux))
+    Av_chi2   = chi2(Av)
+    converged = np.zeros(len(flux), dtype=bool)
+
+    for i in range(max_iterations):
+
+        model    = balmer_decrements * np.exp(-c*Av[:, None])
+        jacobian = -c*model
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.sum(weight*jacobian*(norm_flux-model), axis=1) / np.sum(weight*np.power(jacobian, 2), axis=1)
+        step = np.where(np.isfinite(step) & ~converged, step, 0.0)
+
+        # the Av >= 0 constraint
+        new_Av   = np.maximum(Av+step, 0.0)
+        new_chi2 = chi2(new_Av)
+
+        for j in range(30):
+            worse = new_chi2 > Av_chi2
+            if not np.any(worse):
+                break
+            new_Av[worse]   = (Av[worse]+new_Av[worse])/2
+            new_chi2[worse] = chi2(new_Av[worse], worse)
+
+        converged = converged | (np.abs(new_Av-Av) < tolerance)
+        Av, Av_chi2 = new_Av, np.minimum(new_chi2, Av_chi2)
+
+        if np.all(converged):
+            break
+
+    #---- Av uncertainty (as in the curve_fit covariance with absolute_sigma) ----#
+
+    model    = balmer_decrements * np.exp(-c*Av[:, None])
+    jacobian = -c*model
+    with np.errstate(divide='ignore'):
+        Av_sigma = np.sqrt(1/np.sum(weight*np.power(jacobian, 2), axis=1))
+
+    Av[insufficient]       = np.nan
+    Av_sigma[insufficient] = np.nan
+
+    return Av, Av_sigma
+
+############
+# Av Nodes #
+############
+
+# the number of Av values the joint Av-metallicity inference (extinction='marginal') dereddens the lines at
+default_av_nodes = 5
+
+#---- the Av values spanning the uncertainty of the Balmer fit, and their prior weights ----#
+
+# Gauss-Hermite nodes of the gaussian Av posterior, clipped at Av = 0 (the negative nodes stand for the mass the
+# constrained fit puts at zero); returns the (N, n_nodes) Av values and the n_nodes weights, which sum to one
+def extinction_nodes(Av, Av_sigma, n_nodes=default_av_nodes):
+
+    nodes, weights = np.polynomial.hermite_e.hermegauss(n_nodes)
 
-                except:
-                    self.corrected_dict[line] = np.nan
+    Av_nodes = np.maximum(np.asarray(Av, dtype=float)[:, None] + np.asarray(Av_sigma, dtype=float)[:, None]*nodes, 0.0)
+    return Av_nodes, weights/np.sum(weights)
 
 ########
 # Test #
@@ -1,12 +1,32 @@
+import time
+import logging
 import numpy as np
 from copy import deepcopy
 from uncertainties import ufloat
 from uncertainties import unumpy as unp
 
-from .data.lines import lines_dict, backend_lines, print_lines
-from .dust.extinction_correction import EMISSION_LINES
-from .metallicity.direct_method import METALLICITY
-from .metallicity.strong_method import measure_metallicity
+from .data.lines import lines_dict, backend_lines, lines_table
+from .dust.extinction_correction import EMISSION_LINES, measure_extinction, extinction_table, extinction_nodes, balmer_lines
+from .metallicity.atomic_data import get_engine_atom
+from .metallicity.direct_method import METALLICITY, measure_direct_batch
+from .metallicity.strong_method import measure_metallicity, measure_metallicity_batch, measure_metallicity_joint, get_kernel_metallicity, metallicity_axis
+from .temperature.temperature_estimator import get_kernel_temperature, temperature_axis
+from .metallicity.monte_carlo import object_rng, draw_lines, sample_ufloat, finite_fraction, direct_samples, default_n_samples, default_min_valid_fraction
+from .posteriors import POSTERIOR, posterior_percentiles
+from .kernel.posterior_grid import valid_grid_inputs
+from .diagnostics import status_flags
+from .profiler import profile_stage
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# the lines each metallicity method needs (the object is flagged 'missing_line' without them)
+method_lines = {}
+method_lines['direct'] = ['OII', 'O4363', 'O5007', 'Hbeta']
+method_lines['strong'] = ['OII', 'O5007', 'Hbeta', 'Hbeta_EW']
 
 #######################
 # genesis-metallicity #
@@ -14,7 +34,16 @@ from .metallicity.strong_method import measure_metallicity
 
 class genesis_metallicity:
 
-    def __init__(self, input_dict, object='default', correct_extinction=True):
+    def __init__(self, input_dict, object='default', correct_extinction=True, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                 uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', profiler=None):
+
+        check_uncertainty(uncertainty)
+        check_extinction(extinction)
+
+        if profiler is not None:
+            profiler.count_objects(1)
+
+        start = time.perf_counter()
 
         #----------------------------------------#
         #---- verifying the input dictionary ----#
@@ -28,10 +57,9 @@ class genesis_metallicity:
         self.object = object
 
         # reading the redshift if it is provided
-        try:
+        data_dict['redshift'] = np.nan
+        if 'redshift' in input_dict.keys():
             data_dict['redshift'] = input_dict['redshift']
-        except:
-            data_dict['redshift'] = np.nan
 
         # deciding if extinction correction has to be done
         data_dict['red._corr.'] = True
@@ -48,7 +76,7 @@ class genesis_metallicity:
 
         if 'OII' not in data_dict.keys():
             if ('O3727' not in data_dict.keys()) or ('O3729' not in data_dict.keys()):
-                print_lines()
+                logger.error(lines_table())
                 raise ImportError('[OII]3727,29 flux is required! please provide it under the \'OII\' key (or alternatively under the \'O3727\' and \'O3729\' keys) in the input dictionary')
             else:
                 data_dict['OII'] = data_dict['O3727'] + data_dict['O3729']
@@ -57,7 +85,7 @@ class genesis_metallicity:
 
         if ('O4959' not in data_dict.keys()) or ('O5007' not in data_dict.keys()):
             if 'OIII' not in data_dict.keys():
-                print_lines()
+                logger.error(lines_table())
                 raise ImportError('[OIII]4959,5007 flux is required! please provide it under the \'OIII\' key (or alternatively under the \'O4959\' and \'O5007\' keys) in the input dictionary')
             else:
                 data_dict['O4959'] = data_dict['OIII']/(1+2.98)
@@ -66,13 +94,13 @@ class genesis_metallicity:
         #---- Hbeta ----#
 
         if 'Hbeta' not in data_dict.keys():
-            print_lines()
+            logger.error(lines_table())
             raise ImportError('Hbeta flux is required! please provide it under the \'Hbeta\' key in the input dictionary')
 
         #---- EWHb ----#
 
         if 'Hbeta_EW' not in data_dict.keys():
-            print_lines()
+            logger.error(lines_table())
             raise ImportError('Hbeta equivalent width is required! please provide it under the \'Hbeta_EW\' key in the input dictionary')
 
         #---- O7320 and O7330 ----#
@@ -86,14 +114,21 @@ class genesis_metallicity:
             if line not in data_dict.keys():
                 data_dict[line] = ufloat(np.nan, np.nan, np.nan)
 
+        if profiler is not None:
+            profiler.add('input_validation', time.perf_counter()-start)
+
         #-------------------------------#
         #---- extinction correction ----#
         #-------------------------------#
 
-        emission_lines                 = EMISSION_LINES(object, data_dict)
+        emission_lines                 = EMISSION_LINES(object, data_dict, profiler=profiler)
         self.Av                        = emission_lines.Av
+        self.Av_sigma                  = emission_lines.Av_sigma
         self.reddening_corrected_lines = emission_lines.corrected_dict
 
+        # the status flags of the measurement (see diagnostics.status_flags)
+        self.status = emission_lines.status
+
         #---------------------#
         #---- metallicity ----#
         #---------------------#
@@ -102,22 +137,93 @@ class genesis_metallicity:
 
         metallicity_method = 'strong'
 
-        try:
-            if (data_dict['O4363'].n/data_dict['O4363'].s) > 1.0:
-                metallicity_method = 'direct'
-        except:
-            metallicity_method = 'strong'
+        # a [OIII]4363 detection (S/N > 1) is needed for the direct method
+        O4363 = data_dict['O4363']
+        if (O4363.s != 0) and (O4363.n/O4363.s > 1.0):
+            metallicity_method = 'direct'
 
         self.metallicity_method = metallicity_method
 
+        if any(np.isnan(self.reddening_corrected_lines[line].n) for line in method_lines[metallicity_method]):
+            self.status |= status_flags['missing_line']
+
+        # the marginal posteriors (POSTERIOR objects, if posterior=True) of the metallicity and t2 measured on a grid:
+        # the strong-line metallicity and the Langeroodi+2024 t2, when it is the one used by the direct method
+        self.metallicity_posterior = None
+        self.t2_posterior          = None
+
+        # the realizations of the Monte Carlo measurements (if uncertainty='montecarlo')
+        self.Av_samples          = None
+        self.metallicity_samples = None
+        self.t2_samples          = None
+        self.t3_samples          = None
+
+        # the fraction of the Monte Carlo realizations with a metallicity (see measure_monte_carlo)
+        self.valid_fraction = None
+
+        #---- Monte Carlo metallicity ----#
+
+        if uncertainty == 'montecarlo':
+
+            lines = {line: (data_dict[line].n, data_dict[line].s) for line in backend_lines}
+
+            with profile_stage(profiler, 'monte_carlo'):
+                monte_carlo = measure_monte_carlo(object, lines, self.metallicity_method, correct_extinction=correct_extinction, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine,
+                                                  grid=grid, grid_resolution=grid_resolution, grid_length=grid_length, posterior=posterior, n_samples=n_samples, seed=seed)
+
+            self.metallicity           = monte_carlo['metallicity']
+            self.metallicity_posterior = monte_carlo['metallicity_posterior']
+            self.Av_samples            = monte_carlo['Av_samples']
+            self.valid_fraction        = monte_carlo['valid_fraction']
+            self.status               |= monte_carlo['status']
+
+            if self.metallicity_method == 'direct':
+                self.t2                  = monte_carlo['t2']
+                self.t3                  = monte_carlo['t3']
+                self.metallicity_samples = monte_carlo['metallicity_samples']
+                self.t2_samples          = monte_carlo['t2_samples']
+                self.t3_samples          = monte_carlo['t3_samples']
+
+        #---- joint Av-metallicity inference ----#
+
+        # with extinction='marginal', the metallicity is integrated over the Av nodes (see measure_catalog)
+        joint = (extinction == 'marginal') and correct_extinction and (uncertainty == 'linear')
+
+        if joint:
+
+            lines = {line: ([data_dict[line].n], [data_dict[line].s]) for line in backend_lines}
+
+            with profile_stage(profiler, 'direct_method' if self.metallicity_method == 'direct' else 'strong_line_kde'):
+                output = measure_catalog(lines, objects=[object], correct_extinction=correct_extinction, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine,
+                                         grid=grid, grid_resolution=grid_resolution, grid_length=grid_length, posterior=posterior, extinction=extinction)
+
+            self.metallicity  = ufloat(output['metallicity'][0], output['metallicity_err'][0])
+            self.status      |= output['status'][0]
+
+            if self.metallicity_method == 'direct':
+                self.t2 = ufloat(output['t2'][0], output['t2_err'][0])
+                self.t3 = ufloat(output['t3'][0], output['t3_err'][0])
+
+            # the posteriors the fixed-Av measurement would have (nan where there is none)
+            if posterior:
+                axes = posterior_axes(grid_resolution)
+                name = 't2' if self.metallicity_method == 'direct' else 'metallicity'
+                if np.all(np.isfinite(output[name+'_pdf'][0])):
+                    setattr(self, name+'_posterior', POSTERIOR(axes[name], output[name+'_pdf'][0]))
+
         #---- direct-method metallicity ----#
 
-        if self.metallicity_method == 'direct':
+        if (self.metallicity_method == 'direct') and (uncertainty == 'linear') and not joint:
+
+            with profile_stage(profiler, 'direct_method'):
+                direct_metallicity = METALLICITY(object, self.reddening_corrected_lines, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine,
+                                                 grid=grid, grid_resolution=grid_resolution, grid_length=grid_length, posterior=posterior, profiler=profiler)
 
-            direct_metallicity = METALLICITY(object, self.reddening_corrected_lines)
             self.metallicity   = direct_metallicity.metallicity
             self.t2            = direct_metallicity.Te_OII
             self.t3            = direct_metallicity.Te_OIII
+            self.t2_posterior  = t2_posterior(direct_metallicity)
+            self.status       |= direct_metallicity.status
 
         #---- strong-line metallicity ----#
 
@@ -141,14 +247,600 @@ class genesis_metallicity:
             line_ratio = (self.reddening_corrected_lines['OII']+self.reddening_corrected_lines['O4959']+self.reddening_corrected_lines['O5007'])/self.reddening_corrected_lines['Hbeta']
             return line_ratio
 
-        if self.metallicity_method == 'strong':
+        if (self.metallicity_method == 'strong') and (uncertainty == 'linear') and not joint:
 
             log_O2       = unp.log10([calculate_O2()])[0]
             log_O3       = unp.log10([calculate_O3()])[0]
             log_Hbeta_EW = unp.log10([self.reddening_corrected_lines['Hbeta_EW']])[0]
 
-            strong_metallicity = measure_metallicity(log_O2.n, log_O2.s,
-                                                     log_O3.n, log_O3.s,
-                                                     log_Hbeta_EW.n, log_Hbeta_EW.s)
+            inputs = (log_O2.n, log_O2.s, log_O3.n, log_O3.s, log_Hbeta_EW.n, log_Hbeta_EW.s)
+
+            # without a grid (missing lines, zero uncertainties) there is no strong-line metallicity
+            self.metallicity = ufloat(np.nan, np.nan)
+
+            if not valid_grid_inputs(*inputs, length=grid_length):
+                self.status |= status_flags['grid_failed']
+
+            else:
+                with profile_stage(profiler, 'strong_line_kde'):
+                    strong_metallicity = measure_metallicity(*inputs, length=grid_length, engine=kernel_engine,
+                                                             grid=grid, resolution=grid_resolution, posterior=posterior)
+
+                if posterior:
+                    strong_metallicity, self.metallicity_posterior = strong_metallicity
+
+                self.metallicity = strong_metallicity
+
+#---- the posterior of the direct-method t2, if it is the Langeroodi+2024 one ----#
+
+def t2_posterior(direct_metallicity):
+
+    Te_OII            = direct_metallicity.Te_OII
+    Te_OII_Langeroodi = direct_metallicity.Te_OII_Langeroodi
+
+    if (Te_OII.n == Te_OII_Langeroodi.n) and (Te_OII.s == Te_OII_Langeroodi.s):
+        return direct_metallicity.Te_OII_Langeroodi_posterior
+    return None
+
+#---- Monte Carlo measurement of one object ----#
+
+def check_uncertainty(uncertainty):
+
+    if uncertainty not in ['linear', 'montecarlo']:
+        raise ValueError('unknown uncertainty engine \'%s\'; choose between \'linear\' and \'montecarlo\'' %uncertainty)
+
+def check_extinction(extinction):
+
+    if extinction not in ['fixed', 'marginal']:
+        raise ValueError('unknown extinction mode \'%s\'; choose between \'fixed\' and \'marginal\'' %extinction)
+
+# lines maps the backend lines to their (flux, err) before the extinction correction; every realization is
+# dereddened with its own Av, and the direct-method metallicity, t2 and t3 are the medians of their realizations,
+# with half their 16th-84th percentile range as uncertainty; the strong-line metallicity is measured on the
+# percentiles of the realizations of its line ratios; the realizations without a metallicity are dropped, and
+# 'valid_fraction' is the fraction of those that are kept; the 'status' output holds the flags of the measurement
+# itself (the missing lines and the Av fit are flagged by the callers)
+def measure_monte_carlo(object, lines, metallicity_method, correct_extinction=True, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact',
+                        grid='full', grid_resolution=0.01, grid_length=3, posterior=False, n_samples=default_n_samples, seed=None):
+
+    rng     = object_rng(seed, object)
+    samples = draw_lines(lines, n_samples, rng)
+
+    output = {}
+    output['metallicity_posterior'] = None
+    output['status']                = 0
+
+    #---- the Av of each realization ----#
+
+    balmer_flux    = np.stack([samples[line] for line in balmer_lines], axis=-1)
+    balmer_fluxerr = np.broadcast_to([lines[line][1] for line in balmer_lines], balmer_flux.shape)
+
+    Av, Av_sigma         = measure_extinction(balmer_flux, balmer_fluxerr)
+    output['Av_samples'] = Av
+
+    if correct_extinction:
+        deredden   = Av > 0.01
+        correction = np.power(10, 0.4*np.where(deredden, Av, 0)[:, None]*extinction_table(backend_lines))
+        samples    = {line: samples[line]*correction[:, i] for i, line in enumerate(backend_lines)}
+
+    #---- direct-method metallicity ----#
+
+    if metallicity_method == 'direct':
+
+        Z, Te_OII, Te_OIII, output['status'] = direct_samples(samples, rng, t2_calibration=t2_calibration, global_den=global_den, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine,
+                                                              grid=grid, grid_resolution=grid_resolution, grid_length=grid_length)
+
+        output['metallicity_samples'], output['metallicity'] = Z, sample_ufloat(Z)
+        output['valid_fraction']                             = finite_fraction(Z)
+        output['t2_samples'], output['t2']                   = Te_OII, sample_ufloat(Te_OII)
+        output['t3_samples'], output['t3']                   = Te_OIII, sample_ufloat(Te_OIII)
+
+    #---- strong-line metallicity ----#
+
+    if metallicity_method == 'strong':
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = [np.log10(samples['OII']/samples['Hbeta']), np.log10(samples['O5007']/samples['Hbeta']), np.log10(samples['Hbeta_EW'])]
+
+        log_O2, log_O3, log_Hbeta_EW = [sample_ufloat(values) for values in ratios]
+        output['valid_fraction']     = finite_fraction(*ratios)
+
+        inputs = (log_O2.n, log_O2.s, log_O3.n, log_O3.s, log_Hbeta_EW.n, log_Hbeta_EW.s)
+
+        output['metallicity'] = ufloat(np.nan, np.nan)
+
+        if not valid_grid_inputs(*inputs, length=grid_length):
+            output['status'] = status_flags['grid_failed']
+
+        else:
+            strong_metallicity = measure_metallicity(*inputs, length=grid_length, engine=kernel_engine,
+                                                     grid=grid, resolution=grid_resolution, posterior=posterior)
+
+            if posterior:
+                strong_metallicity, output['metallicity_posterior'] = strong_metallicity
+
+            output['metallicity'] = strong_metallicity
+
+    #---- too many realizations dropped ----#
+
+    if np.isfinite(output['metallicity'].n) and (output['valid_fraction'] < default_min_valid_fraction):
+        output['status'] |= status_flags['few_samples']
+
+    return output
+
+##########################################
+# genesis-metallicity for whole catalogs #
+##########################################
+
+#---- reading a flux and flux-error column from a catalog ----#
+
+def catalog_columns(catalog):
+
+    if hasattr(catalog, 'colnames'):
+        return list(catalog.colnames)
+    if getattr(getattr(catalog, 'dtype', None), 'names', None) is not None:
+        return list(catalog.dtype.names)
+    return list(catalog.keys())
+
+def read_line(catalog, line):
+
+    columns = catalog_columns(catalog)
+
+    if line not in columns:
+        return None
+
+    # flux and error in separate columns: catalog['O5007'] & catalog['O5007_err']
+    if (line+'_err') in columns:
+        flux    = np.asarray(catalog[line], dtype=float).reshape(-1)
+        fluxerr = np.asarray(catalog[line+'_err'], dtype=float).reshape(-1)
+        return flux, fluxerr
+
+    column = np.asarray(catalog[line], dtype=float)
+    table  = not isinstance(catalog, dict)
+
+    # a single object given in the input_dict format: [flux, err]
+    if column.shape == (2,):
+        return column[[0]], column[[1]]
+
+    # table rows of [flux, err]: shape (N, 2)
+    if table and (column.ndim == 2) and (column.shape[1] == 2):
+        return column[:, 0], column[:, 1]
+
+    # input_dict format with arrays: [flux_array, err_array]
+    if (column.ndim == 2) and (column.shape[0] == 2):
+        return column[0], column[1]
+
+    # dictionary of [flux, err] rows: shape (N, 2)
+    if (column.ndim == 2) and (column.shape[1] == 2):
+        return column[:, 0], column[:, 1]
+
+    raise ValueError('could not read the flux and flux uncertainty of \'%s\'; provide them as [flux, err] or as \'%s\' and \'%s_err\' columns' %(line, line, line))
+
+#---- adding two lines with independent uncertainties ----#
+
+def add_lines(line_a, line_b):
+
+    return line_a[0]+line_b[0], np.sqrt(np.power(line_a[1], 2)+np.power(line_b[1], 2))
+
+#---- log10 of a ratio of two lines with independent uncertainties ----#
+
+def log_ratio(line_a, line_b):
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio     = line_a[0]/line_b[0]
+        ratio_unc = np.sqrt(np.power(line_a[1]/line_b[0], 2) + np.power(line_a[0]*line_b[1]/np.power(line_b[0], 2), 2))
+        log_ratio = np.log10(ratio)
+        log_unc   = ratio_unc/(np.abs(ratio)*np.log(10))
+
+    return log_ratio, log_unc
+
+#---- combining the Av nodes of the direct method (extinction='marginal') ----#
+
+# the mean and standard deviation of the mixture of the gaussians (values, errors), of shape (N, nodes), with the
+# node weights, over the nodes where they are finite (nan where there are none)
+def node_mixture(values, errors, weights):
+
+    finite = np.isfinite(values) & np.isfinite(errors)
+    values = np.where(finite, values, 0.0)
+    errors = np.where(finite, errors, 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights  = np.where(finite, weights, 0.0)
+        weights /= np.sum(weights, axis=1, keepdims=True)
+
+        mean     = np.sum(weights*values, axis=1)
+        variance = np.sum(weights*(np.power(errors, 2) + np.power(values-mean[:, None], 2)), axis=1)
+
+    return mean, np.sqrt(variance)
+
+# output is the measure_direct_batch output of the (object, node) rows; the status of an object is that of the
+# nodes with a metallicity (of all its nodes if none has one), and the t2 posterior the weighted sum of its nodes'
+def combine_nodes(output, weights):
+
+    n_nodes  = len(weights)
+    combined = {}
+
+    for value, error in [('metallicity', 'metallicity_err'), ('Te_OII', 'Te_OII_err'), ('Te_OIII', 'Te_OIII_err')]:
+        combined[value], combined[error] = node_mixture(output[value].reshape(-1, n_nodes), output[error].reshape(-1, n_nodes), weights)
+
+    status  = output['status'].reshape(-1, n_nodes)
+    measured = np.isfinite(output['metallicity'].reshape(-1, n_nodes))
+    combined['status'] = np.where(np.any(measured, axis=1), np.bitwise_or.reduce(np.where(measured, status, 0), axis=1), np.bitwise_or.reduce(status, axis=1))
+
+    if 't2_pdf' in output.keys():
+        pdf    = output['t2_pdf'].reshape(-1, n_nodes, output['t2_pdf'].shape[-1])
+        finite = np.all(np.isfinite(pdf), axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pdf = np.sum(np.where(finite[..., None], weights[:, None]*pdf, 0.0), axis=1)
+            combined['t2_pdf'] = pdf/np.sum(pdf, axis=-1, keepdims=True)
+
+    return combined
+
+#---- the catalog version of the genesis_metallicity class ----#
+
+def measure_catalog(catalog, objects=None, correct_extinction=True, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                    uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', profiler=None, cache=None):
+
+    check_uncertainty(uncertainty)
+    check_extinction(extinction)
+
+    start = time.perf_counter()
+
+    #----------------------------------#
+    #---- reading the line columns ----#
+    #----------------------------------#
+
+    data_dict = {}
+    size      = None
+
+    for line in lines_dict.keys():
+        column = read_line(catalog, line)
+        if column is not None:
+            data_dict[line] = column
+            size            = len(column[0])
+
+    if size is None:
+        logger.error(lines_table())
+        raise ImportError('none of the emission lines were found in the catalog')
+
+    for line in data_dict.keys():
+        if len(data_dict[line][0]) != size:
+            raise ValueError('all the catalog columns must have the same length')
+
+    if objects is None:
+        objects = np.arange(size)
+    objects = np.asarray(objects)
+
+    missing = (np.full(size, np.nan), np.full(size, np.nan))
+
+    #---- OII ----#
+
+    components = ('O3727' in data_dict.keys()) and ('O3729' in data_dict.keys())
+
+    if ('OII' not in data_dict.keys()) and (not components):
+        logger.error(lines_table())
+        raise ImportError('[OII]3727,29 flux is required! please provide it under the \'OII\' key (or alternatively under the \'O3727\' and \'O3729\' keys) in the catalog')
+
+    if components:
+        OII = add_lines(data_dict['O3727'], data_dict['O3729'])
+        if 'OII' in data_dict.keys():
+            fill = np.isnan(data_dict['OII'][0])
+            OII  = (np.where(fill, OII[0], data_dict['OII'][0]), np.where(fill, OII[1], data_dict['OII'][1]))
+        data_dict['OII'] = OII
+
+    #---- O4959 and O5007 ----#
+
+    resolved = ('O4959' in data_dict.keys()) and ('O5007' in data_dict.keys())
+
+    if (not resolved) and ('OIII' not in data_dict.keys()):
+        logger.error(lines_table())
+        raise ImportError('[OIII]4959,5007 flux is required! please provide it under the \'OIII\' key (or alternatively under the \'O4959\' and \'O5007\' keys) in the catalog')
+
+    if 'OIII' in data_dict.keys():
+        OIII  = data_dict['OIII']
+        O4959 = data_dict.get('O4959', missing)
+        O5007 = data_dict.get('O5007', missing)
+        fill  = np.isnan(O4959[0]) | np.isnan(O5007[0])
+        data_dict['O4959'] = (np.where(fill, OIII[0]/(1+2.98), O4959[0]), np.where(fill, OIII[1]/(1+2.98), O4959[1]))
+        data_dict['O5007'] = (np.where(fill, OIII[0]/(1+2.98)*2.98, O5007[0]), np.where(fill, OIII[1]/(1+2.98)*2.98, O5007[1]))
+
+    #---- Hbeta ----#
+
+    if 'Hbeta' not in data_dict.keys():
+        logger.error(lines_table())
+        raise ImportError('Hbeta flux is required! please provide it under the \'Hbeta\' key in the catalog')
+
+    #---- EWHb ----#
+
+    if 'Hbeta_EW' not in data_dict.keys():
+        logger.error(lines_table())
+        raise ImportError('Hbeta equivalent width is required! please provide it under the \'Hbeta_EW\' key in the catalog')
+
+    #---- O7320 and O7330 ----#
+
+    if ('O7320' in data_dict.keys()) and ('O7330' in data_dict.keys()):
+        OII7320 = add_lines(data_dict['O7320'], data_dict['O7330'])
+        if 'OII7320' in data_dict.keys():
+            fill    = np.isnan(OII7320[0])
+            OII7320 = (np.where(fill, data_dict['OII7320'][0], OII7320[0]), np.where(fill, data_dict['OII7320'][1], OII7320[1]))
+        data_dict['OII7320'] = OII7320
+
+    #---- making sure all the backend lines have some input ----#
+
+    for line in backend_lines:
+        if line not in data_dict.keys():
+            data_dict[line] = missing
+
+    #---- the objects already in the cache (a RESULT_CACHE) ----#
+
+    # unseeded Monte Carlo realizations are not reproducible, so they are never cached
+    if (cache is not None) and not ((uncertainty == 'montecarlo') and (seed is None)):
+
+        settings = {}
+        settings['correct_extinction'] = correct_extinction
+        settings['t2_calibration']     = t2_calibration
+        settings['global_den']         = global_den
+        settings['kernel_engine']      = kernel_engine
+        settings['emissivity_engine']  = emissivity_engine
+        settings['grid']               = grid
+        settings['grid_resolution']    = grid_resolution
+        settings['grid_length']        = grid_length
+        settings['posterior']          = posterior
+        settings['uncertainty']        = uncertainty
+        settings['n_samples']          = n_samples
+        settings['seed']               = seed
+        settings['extinction']         = extinction
+
+        lines = {line: data_dict[line] for line in backend_lines}
+
+        with profile_stage(profiler, 'cache'):
+            fingerprint, keys = cache.keys(settings, lines, objects)
+            found, cached     = cache.get(fingerprint, keys)
+
+        if np.all(found):
+            return dict(object=objects, **cached)
+
+        # the objects that are not in the cache are measured (and added to it)
+        measured = measure_catalog({line: (flux[~found], fluxerr[~found]) for line, (flux, fluxerr) in lines.items()}, objects=objects[~found], profiler=profiler, **settings)
+
+        with profile_stage(profiler, 'cache'):
+            cache.put(fingerprint, keys[~found], measured)
+
+        if not np.any(found):
+            return measured
+
+        output_dict = {}
+        for column, values in measured.items():
+            output_dict[column]         = np.empty((size,)+values.shape[1:], dtype=values.dtype if column != 'object' else objects.dtype)
+            output_dict[column][~found] = values
+            if column != 'object':
+                output_dict[column][found] = cached[column]
+        output_dict['object'] = objects
+
+        return output_dict
+
+    if profiler is not None:
+        profiler.count_objects(size)
+        profiler.add('input_validation', time.perf_counter()-start)
+
+    #-------------------------------#
+    #---- extinction correction ----#
+    #-------------------------------#
+
+    balmer_flux    = np.stack([data_dict[line][0] for line in balmer_lines], axis=-1)
+    balmer_fluxerr = np.stack([data_dict[line][1] for line in balmer_lines], axis=-1)
+
+    with profile_stage(profiler, 'dust_fit'):
+        Av, Av_sigma = measure_extinction(balmer_flux, balmer_fluxerr)
+
+    with profile_stage(profiler, 'dereddening'):
+
+        # one (objects, lines) array of correction factors
+        correction = np.ones((size, len(backend_lines)))
+
+        if correct_extinction:
+            deredden   = Av > 0.01
+            correction = np.where(deredden[:, None], np.power(10, 0.4*np.where(deredden, Av, 0)[:, None]*extinction_table(backend_lines)), 1.0)
+
+        corrected_dict = {}
+
+        for i, line in enumerate(backend_lines):
+            corrected_dict[line] = (data_dict[line][0]*correction[:, i], data_dict[line][1]*correction[:, i])
+
+    #---- the lines dereddened at each Av node (joint Av-metallicity inference) ----#
+
+    # with extinction='marginal', the lines are also dereddened at the Av nodes spanning the uncertainty of the
+    # Balmer fit (one row per object and node, object after object), and the metallicity stages integrate over them
+    marginal = (extinction == 'marginal') and correct_extinction and (uncertainty == 'linear')
+
+    if marginal:
+
+        with profile_stage(profiler, 'dereddening'):
+
+            Av_nodes, node_weights = extinction_nodes(Av, Av_sigma)
+            n_nodes                = Av_nodes.shape[1]
+
+            node_Av         = Av_nodes.reshape(-1)
+            deredden        = node_Av > 0.01
+            node_correction = np.where(deredden[:, None], np.power(10, 0.4*np.where(deredden, node_Av, 0)[:, None]*extinction_table(backend_lines)), 1.0)
+
+            node_dict = {}
+
+            for i, line in enumerate(backend_lines):
+                node_dict[line] = (np.repeat(data_dict[line][0], n_nodes)*node_correction[:, i], np.repeat(data_dict[line][1], n_nodes)*node_correction[:, i])
+
+    #---------------------#
+    #---- metallicity ----#
+    #---------------------#
+
+    #---- deciding on the metallicity measurement approach ----#
+
+    O4363 = data_dict['O4363']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        direct = (O4363[1] != 0) & (O4363[0]/O4363[1] > 1.0)
+
+    metallicity_method = np.where(direct, 'direct', 'strong')
+
+    # the status flags of each object (see diagnostics.status_flags)
+    status = np.zeros(size, dtype=int)
+
+    if correct_extinction:
+        status[np.isnan(Av)] |= status_flags['no_extinction']
+
+    for method, lines in method_lines.items():
+        missing_line = np.any([np.isnan(corrected_dict[line][0]) for line in lines], axis=0)
+        status[(metallicity_method == method) & missing_line] |= status_flags['missing_line']
+
+    metallicity     = np.full(size, np.nan)
+    metallicity_err = np.full(size, np.nan)
+    t2              = np.full(size, np.nan)
+    t2_err          = np.full(size, np.nan)
+    t3              = np.full(size, np.nan)
+    t3_err          = np.full(size, np.nan)
+    valid_fraction  = np.full(size, np.nan)
+
+    if posterior:
+        axes = posterior_axes(grid_resolution)
+        pdfs = {name: np.full((size, len(axis)), np.nan) for name, axis in axes.items()}
+
+    # with uncertainty='montecarlo', all the objects are measured by measure_monte_carlo instead
+    monte_carlo = np.full(size, uncertainty == 'montecarlo')
+
+    #---- direct-method metallicity ----#
+
+    rows = direct & ~monte_carlo
+
+    # all the Av nodes of the objects at once, if extinction='marginal'
+    if marginal:
+        direct_lines = {line: (node_dict[line][0][np.repeat(rows, n_nodes)], node_dict[line][1][np.repeat(rows, n_nodes)]) for line in ['OII', 'OII7320', 'O4363', 'O5007', 'Hbeta']}
+    else:
+        direct_lines = {line: (corrected_dict[line][0][rows], corrected_dict[line][1][rows]) for line in ['OII', 'OII7320', 'O4363', 'O5007', 'Hbeta']}
+
+    with profile_stage(profiler, 'direct_method'):
+        direct_metallicity = measure_direct_batch(direct_lines, t2_calibration=t2_calibration, global_den=global_den, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine,
+                                                  grid=grid, grid_resolution=grid_resolution, grid_length=grid_length, posterior=posterior, profiler=profiler)
+
+    if marginal:
+        direct_metallicity = combine_nodes(direct_metallicity, node_weights)
+
+    metallicity[rows], metallicity_err[rows] = direct_metallicity['metallicity'], direct_metallicity['metallicity_err']
+    t2[rows], t2_err[rows]                   = direct_metallicity['Te_OII'], direct_metallicity['Te_OII_err']
+    t3[rows], t3_err[rows]                   = direct_metallicity['Te_OIII'], direct_metallicity['Te_OIII_err']
+    status[rows]                            |= direct_metallicity['status']
+
+    if posterior:
+        pdfs['t2'][rows] = direct_metallicity['t2_pdf']
+
+    #---- strong-line metallicity ----#
+
+    strong = ~direct & ~monte_carlo
+
+    log_O2       = log_ratio(corrected_dict['OII'], corrected_dict['Hbeta'])
+    log_O3       = log_ratio(corrected_dict['O5007'], corrected_dict['Hbeta'])
+    log_Hbeta_EW = log_ratio(corrected_dict['Hbeta_EW'], (np.ones(size), np.zeros(size)))
+
+    # the grid inputs at each Av node, if extinction='marginal'
+    if marginal:
+        node_inputs = np.stack([*log_ratio(node_dict['OII'], node_dict['Hbeta']),
+                                *log_ratio(node_dict['O5007'], node_dict['Hbeta']),
+                                *log_ratio(node_dict['Hbeta_EW'], (np.ones(size*n_nodes), np.zeros(size*n_nodes)))], axis=-1).reshape(size, n_nodes, 6)
+        valid_grid  = np.any(valid_grid_inputs(*np.moveaxis(node_inputs, -1, 0), length=grid_length), axis=1)
+    else:
+        valid_grid  = valid_grid_inputs(*log_O2, *log_O3, *log_Hbeta_EW, length=grid_length)
+
+    # measure_metallicity_batch leaves nan where the grid cannot be built
+    status[strong & ~valid_grid] |= status_flags['grid_failed']
+
+    with profile_stage(profiler, 'strong_line_kde'):
+        if marginal:
+            strong_metallicity = measure_metallicity_joint(node_inputs[strong], np.broadcast_to(node_weights, (np.sum(strong), n_nodes)),
+                                                           length=grid_length, engine=kernel_engine,
+                                                           grid=grid, resolution=grid_resolution, posterior=posterior)
+        else:
+            strong_metallicity = measure_metallicity_batch(log_O2[0][strong], log_O2[1][strong],
+                                                           log_O3[0][strong], log_O3[1][strong],
+                                                           log_Hbeta_EW[0][strong], log_Hbeta_EW[1][strong],
+                                                           length=grid_length, engine=kernel_engine,
+                                                           grid=grid, resolution=grid_resolution, posterior=posterior)
+
+    if posterior:
+        metallicity[strong], metallicity_err[strong], pdfs['metallicity'][strong] = strong_metallicity
+    else:
+        metallicity[strong], metallicity_err[strong] = strong_metallicity
+
+    #---- Monte Carlo metallicity ----#
+
+    for index in np.where(monte_carlo)[0]:
+
+        lines = {line: (data_dict[line][0][index], data_dict[line][1][index]) for line in backend_lines}
+
+        with profile_stage(profiler, 'monte_carlo'):
+            output = measure_monte_carlo(objects[index], lines, metallicity_method[index], correct_extinction=correct_extinction, t2_calibration=t2_calibration, global_den=global_den,
+                                         kernel_engine=kernel_engine, emissivity_engine=emissivity_engine, grid=grid, grid_resolution=grid_resolution, grid_length=grid_length,
+                                         posterior=posterior, n_samples=n_samples, seed=seed)
+
+        metallicity[index], metallicity_err[index] = output['metallicity'].n, output['metallicity'].s
+        valid_fraction[index]                      = output['valid_fraction']
+        status[index]                             |= output['status']
+
+        if metallicity_method[index] == 'direct':
+            t2[index], t2_err[index] = output['t2'].n, output['t2'].s
+            t3[index], t3_err[index] = output['t3'].n, output['t3'].s
+
+        if output['metallicity_posterior'] is not None:
+            pdfs['metallicity'][index] = output['metallicity_posterior'].pdf
+
+    #-----------------#
+    #---- outputs ----#
+    #-----------------#
+
+    output_dict = {}
+    output_dict['object']             = objects
+    output_dict['Av']                 = Av
+    output_dict['metallicity_method'] = metallicity_method
+    output_dict['metallicity']        = metallicity
+    output_dict['metallicity_err']    = metallicity_err
+    output_dict['t2']                 = t2
+    output_dict['t2_err']             = t2_err
+    output_dict['t3']                 = t3
+    output_dict['t3_err']             = t3_err
+    output_dict['status']             = status
 
-            self.metallicity = strong_metallicity
+    # the fraction of the Monte Carlo realizations with a metallicity
+    if uncertainty == 'montecarlo':
+        output_dict['valid_fraction'] = valid_fraction
+
+    # the marginal posteriors on the posterior_axes grids (nan where there is none), and their percentiles
+    if posterior:
+        for name, axis in axes.items():
+            output_dict[name+'_pdf'] = pdfs[name]
+            output_dict[name+'_p16'], output_dict[name+'_median'], output_dict[name+'_p84'] = np.moveaxis(posterior_percentiles(axis, pdfs[name]), -1, 0)
+
+    return output_dict
+
+#---- the shared grid axes of the '<name>_pdf' columns (t2 in K) ----#
+
+def posterior_axes(grid_resolution=0.01):
+
+    axes = {}
+    axes['metallicity'] = metallicity_axis(grid_resolution)
+    axes['t2']          = 1e+4 * temperature_axis(grid_resolution)
+    return axes
+
+###########
+# Preload #
+###########
+
+# the kernels, the PyNeb atomic data and scipy.stats are loaded the first time they are needed;
+# long-running processes can load them up front instead
+def preload(kernel_engine='exact', emissivity_engine='exact', global_den=100):
+
+    # imported by the posterior grids the first time they are built (about 0.4 s)
+    import scipy.stats
+
+    get_kernel_metallicity(kernel_engine)
+    get_kernel_temperature(kernel_engine)
+
+    get_engine_atom('O', '2', global_den, engine=emissivity_engine)
+    get_engine_atom('O', '3', global_den, engine=emissivity_engine)
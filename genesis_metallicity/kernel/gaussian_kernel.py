@@ -0,0 +1,191 @@
+import sys
+import struct
+import pickle
+import zipfile
+import numpy as np
+
+##########
+# Config #
+##########
+
+# bump whenever the layout of the kernel files changes
+kernel_format_version = 1
+
+# number of (query point, training point) pairs evaluated at once
+default_block_pairs = 2**16
+
+##################
+# Dense Gaussian #
+##################
+
+# sum_j weights_j exp(-|p-x_j|^2/2) at each point p, for whitened (d, m) points and (d, n) dataset
+def gaussian_sum(points, dataset, weights, block_pairs=default_block_pairs):
+
+    half_norm = 0.5*np.sum(np.square(dataset), axis=0)
+    pdf       = np.zeros(points.shape[1])
+    chunk     = max(1, block_pairs//max(1, dataset.shape[1]))
+
+    for start in range(0, points.shape[1], chunk):
+
+        # -|p-x|^2/2 = p.x - |p|^2/2 - |x|^2/2, so that the distances come out of a single matrix product
+        block  = points[:, start:start+chunk]
+        arg    = np.dot(block.T, dataset)
+        arg   -= half_norm[None, :]
+        arg   -= 0.5*np.sum(np.square(block), axis=0)[:, None]
+        np.exp(arg, out=arg)
+
+        pdf[start:start+chunk] = np.dot(arg, weights)
+
+    return pdf
+
+#########################
+# Gaussian Kernel Class #
+#########################
+
+# the same density as scipy's gaussian_kde, rebuilt from plain arrays:
+# dataset is (d, n), weights is (n,) and sums to one, covariance is the (d, d) kernel covariance
+class GAUSSIAN_KERNEL:
+
+    def __init__(self, dataset, weights, covariance, factor=None):
+
+        self.dataset    = dataset
+        self.weights    = weights
+        self.covariance = np.asarray(covariance, dtype=float)
+        self.factor     = factor
+
+        self.d, self.n  = self.dataset.shape
+        self.inv_cov    = np.linalg.inv(self.covariance)
+        self.neff       = 1/np.sum(np.square(self.weights))
+
+        # whitening as in scipy: |L.T (x-y)|^2 = (x-y).T inv_cov (x-y), with L the cholesky factor of inv_cov
+        self.whitening  = np.linalg.cholesky(self.inv_cov)
+        self.norm       = np.power(2*np.pi, -self.d/2) * np.prod(np.diag(self.whitening))
+
+    #---- same call signature as scipy's gaussian_kde ----#
+
+    def evaluate(self, points, block_pairs=default_block_pairs):
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+
+        if points.shape[0] != self.d:
+            if points.shape == (1, self.d):
+                points = points.reshape(self.d, 1)
+            else:
+                raise ValueError('points have dimension %i, dataset has dimension %i' %(points.shape[0], self.d))
+
+        return gaussian_sum(self.whiten(points), self.whiten(self.dataset), self.weights, block_pairs=block_pairs) * self.norm
+
+    __call__ = evaluate
+
+    # whitened coordinates, centred on the training data to limit the round-off of gaussian_sum
+    def whiten(self, points):
+
+        return np.dot(self.whitening.T, points-np.mean(self.dataset, axis=1)[:, None])
+
+    # whitened coordinates of the cartesian product of the grid axes, as a (d, n0*n1*...) array
+    def whiten_grid(self, *grid_axes):
+
+        center = np.mean(self.dataset, axis=1)
+        shape  = tuple(len(values) for values in grid_axes)
+        points = np.zeros((self.d,) + shape)
+
+        for axis, values in enumerate(grid_axes):
+            along       = [1]*len(shape)
+            along[axis] = len(values)
+            points     += np.multiply.outer(self.whitening.T[:, axis], np.asarray(values, dtype=float)-center[axis]).reshape([self.d]+along)
+
+        return points.reshape(self.d, -1)
+
+    #---- evaluating on the cartesian product of the grid axes: returns an (n0, n1, ...) array ----#
+
+    # one slice of the first axis at a time, so that the grid points are never all in memory
+    def evaluate_grid(self, *grid_axes):
+
+        dataset = self.whiten(self.dataset)
+        pdf     = np.empty(tuple(len(values) for values in grid_axes))
+
+        for i, value in enumerate(grid_axes[0]):
+            pdf[i] = gaussian_sum(self.whiten_grid([value], *grid_axes[1:]), dataset, self.weights).reshape(pdf.shape[1:])
+
+        return pdf * self.norm
+
+####################
+# Saving & Loading #
+####################
+
+# the arrays are stored uncompressed, so that they can be memory-mapped and shared between processes
+def save_kernel(kernel, path):
+
+    np.savez(path,
+             dataset=np.asarray(kernel.dataset, dtype=float), weights=np.asarray(kernel.weights, dtype=float),
+             covariance=np.asarray(kernel.covariance, dtype=float), factor=float(kernel.factor),
+             version=kernel_format_version)
+
+#---- reading the members of an uncompressed .npz in place (np.load does not memory-map .npz files) ----#
+
+def load_npz(path, mmap_mode='r'):
+
+    arrays = {}
+
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as handle:
+
+        for info in archive.infolist():
+
+            name = info.filename[:-len('.npy')]
+
+            if (mmap_mode is None) or (info.compress_type != zipfile.ZIP_STORED):
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            # skipping the local file header and the .npy header to find where the data starts
+            handle.seek(info.header_offset)
+            header = handle.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            handle.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(handle)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+
+            if (dtype.hasobject) or (np.prod(shape) == 0):
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+
+            arrays[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape,
+                                     order='F' if fortran_order else 'C', offset=handle.tell())
+    return arrays
+
+def load_kernel(path, mmap_mode='r'):
+
+    arrays = load_npz(path, mmap_mode=mmap_mode)
+
+    if int(arrays['version']) != kernel_format_version:
+        raise ValueError('%s was saved with kernel format version %i, but version %i is expected; please convert it again' %(path, int(arrays['version']), kernel_format_version))
+
+    return GAUSSIAN_KERNEL(arrays['dataset'], arrays['weights'], arrays['covariance'], factor=float(arrays['factor']))
+
+##############################
+# Converting Pickled Kernels #
+##############################
+
+# works for any pickled scipy gaussian_kde (unpickling it needs a compatible scipy version)
+def convert_pickle(pkl_path, npz_path):
+
+    with open(pkl_path, 'rb') as handle:
+        kde = pickle.load(handle)
+
+    kernel = GAUSSIAN_KERNEL(np.asarray(kde.dataset, dtype=float), np.asarray(kde.weights, dtype=float), kde.covariance, factor=kde.factor)
+    save_kernel(kernel, npz_path)
+    return kernel
+
+# python -m genesis_metallicity.kernel.gaussian_kernel kernel.pkl kernel.npz
+if __name__ == '__main__':
+
+    if len(sys.argv) != 3:
+        sys.exit('usage: python -m genesis_metallicity.kernel.gaussian_kernel <input.pkl> <output.npz>')
+
+    convert_pickle(sys.argv[1], sys.argv[2])
@@ -0,0 +1,152 @@
+import numpy as np
+
+##########
+# Config #
+##########
+
+# adaptive grids: the posterior is first evaluated every coarse_spacing kernel bandwidths along the last axis and
+# on every coarse_stride-th point of the nuisance axes (which keeps their ends); the last axis is then kept at full
+# resolution only where the coarse marginal posterior is above tolerance times its peak (plus one coarse step)
+default_coarse_spacing = 1.0
+default_coarse_stride  = 2
+default_tolerance      = 1e-4
+
+##################################
+# Ordering of the Posterior Grid #
+##################################
+
+# the posterior grids are (nuisance axes..., last axis) arrays, the last axis being the measured quantity (Z or t2);
+# their points are ordered along it with the same argsort as the flattened meshgrid it replaces, which only depends
+# on the last axis and the number of nuisance points, so it is computed once and reused
+sort_order_cache = {}
+
+def sort_order(last_axis, n_nuisance):
+
+    key = (n_nuisance, np.asarray(last_axis, dtype=float).tobytes())
+
+    if key not in sort_order_cache:
+        sort_order_cache[key] = np.argsort(np.tile(last_axis, n_nuisance)).astype(np.int32)
+    return sort_order_cache[key]
+
+# the sort order of a full grid restricted to the window (a slice) of its last axis, so that a refined
+# grid orders its points exactly as the full grid does
+def window_order(last_axis, n_nuisance, window):
+
+    order  = sort_order(last_axis, n_nuisance)
+    index  = order % len(last_axis)
+    inside = (index >= window.start) & (index < window.stop)
+    order  = order[inside]
+
+    return (order//len(last_axis))*(window.stop-window.start) + index[inside] - window.start
+
+###############
+# Grid Inputs #
+###############
+
+# the axes of a grid (temperature_axes, metallicity_axes) are only defined where each value and uncertainty is finite,
+# and the uncertainty moves the value by a resolvable step (np.unique collapses the axis otherwise, e.g. for zero ones);
+# inputs alternate value and uncertainty, as scalars or arrays
+def valid_grid_inputs(*inputs, length=3):
+
+    values = np.asarray(inputs[0::2], dtype=float)
+    steps  = np.asarray(inputs[1::2], dtype=float)/(length-1)
+
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(values) & np.isfinite(steps) & (values+steps != values) & (values-steps != values)
+
+    return np.all(valid, axis=0)
+
+###################
+# Marginalization #
+###################
+
+# the same index as np.argmin(np.abs(cdf-value)), i.e. the first of the closest, without the temporary arrays
+def nearest_index(cdf, value):
+
+    # the cumulative sum of a non-negative pdf never decreases, unless it is nan
+    if np.isnan(cdf[-1]):
+        return np.argmin(np.abs(cdf-value))
+
+    index = np.searchsorted(cdf, value)
+
+    if index == 0:
+        return 0
+    if (index == len(cdf)) or (value-cdf[index-1] <= cdf[index]-value):
+        return np.searchsorted(cdf, cdf[index-1])
+    return index
+
+# returns the last-axis values at the lower end, the maximum likelihood and the upper end of the interval
+# that contains the given cdf percentile around the maximum likelihood
+def marginalize_grid(last_axis, pdf, percentile, window=None):
+
+    last_axis = np.asarray(last_axis)
+
+    # the pdf of a refined grid only covers the window of the last axis
+    if window is None:
+        order = sort_order(last_axis, pdf.size//len(last_axis))
+    else:
+        order     = window_order(last_axis, pdf.size//(window.stop-window.start), window)
+        last_axis = last_axis[window]
+
+    pdf_normalized  = pdf.reshape(-1)[order]
+    pdf_normalized /= np.sum(pdf_normalized)
+
+    #---- maximum likelihood value ----#
+
+    ml_index = np.argmax(pdf_normalized)
+
+    #---- percentile values (the cdf overwrites the pdf) ----#
+
+    cdf    = np.cumsum(pdf_normalized, out=pdf_normalized)
+    ml_cdf = cdf[ml_index]
+
+    lo_index = nearest_index(cdf, ml_cdf-percentile/2)
+    up_index = nearest_index(cdf, ml_cdf+percentile/2)
+
+    return last_axis[order[[lo_index, ml_index, up_index]] % len(last_axis)]
+
+##################
+# Adaptive Grids #
+##################
+
+# returns the slice of the last axis where the posterior has mass; coarse_step is in the units of the
+# last axis (e.g. default_coarse_spacing times the kernel bandwidth along it)
+def refine_window(kernel, grid_axes, weight_array, coarse_step, coarse_stride=default_coarse_stride, tolerance=default_tolerance):
+
+    last_axis = grid_axes[-1]
+    stride    = max(1, int(coarse_step/(last_axis[1]-last_axis[0]))) if len(last_axis) > 1 else 1
+    coarse    = last_axis[::stride]
+    nuisance  = tuple(slice(None, None, coarse_stride) for axis in grid_axes[:-1])
+
+    #---- coarse marginal posterior ----#
+
+    pdf      = kernel.evaluate_grid(*[axis[index] for axis, index in zip(grid_axes[:-1], nuisance)], coarse)
+    pdf     *= weight_array[nuisance][..., None]
+    marginal = np.sum(pdf.reshape(-1, len(coarse)), axis=0)
+
+    # no mass anywhere (or nan): nothing to refine around
+    if not (np.max(marginal) > 0):
+        return slice(0, len(last_axis))
+
+    #---- between the first and last coarse points with mass, plus one coarse step ----#
+
+    keep = np.where(marginal >= tolerance*np.max(marginal))[0]
+    lo   = max(keep[0]-1, 0)*stride
+    hi   = min((keep[-1]+1)*stride, len(last_axis)-1)
+
+    return slice(lo, hi+1)
+
+#---- the part of the last axis where the posterior has mass (None for the full grid) ----#
+
+# shared by the metallicity and t2 grids; load_exact returns the exact kernel of the calibration, whose bandwidth
+# along the last axis sets the coarse step (only loaded for adaptive grids)
+def grid_window(kernel, grid_axes, weight_array, load_exact, grid='full'):
+
+    if grid == 'adaptive':
+        coarse_step = default_coarse_spacing*np.sqrt(load_exact().covariance[-1, -1])
+        return refine_window(kernel, grid_axes, weight_array, coarse_step)
+
+    if grid != 'full':
+        raise ValueError('unknown posterior grid \'%s\'; choose between \'full\' and \'adaptive\'' %grid)
+
+    return None
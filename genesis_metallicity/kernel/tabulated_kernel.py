@@ -0,0 +1,398 @@
+import os
+import sys
+import zipfile
+import hashlib
+import logging
+import itertools
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+# bump whenever the table layout or the build recipe changes
+table_version = 1
+
+# default build settings; spacing and cutoff are in units of the kernel bandwidth along each axis
+default_spacing    = 0.5
+default_cutoff     = 5.0
+default_block_size = 4
+default_threshold  = 1e-6
+
+# grids whose interpolated densities all stay below this fraction of the table peak are in the sparse tails of the
+# calibration, where the interpolation errors (~1% of the peak) exceed the densities; they go to the exact kernel
+default_fallback = 1e-4
+
+# where the tables are kept when the package's data directory is not writable (e.g. a read-only or shared install);
+# the GENESIS_METALLICITY_CACHE environment variable overrides it
+cache_directory = os.environ.get('GENESIS_METALLICITY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'genesis_metallicity'))
+
+###################################
+# Cubic Convolution Interpolation #
+###################################
+
+# Keys (1981) cubic convolution kernel with a = -0.5
+def cubic_weights(t):
+
+    t = np.abs(t)
+    a = -0.5
+
+    weights = np.where(t <= 1, (a+2)*t**3 - (a+3)*t**2 + 1,
+                       np.where(t < 2, a*t**3 - 5*a*t**2 + 8*a*t - 4*a, 0.0))
+    return weights
+
+# node indices and weights of the 4 nodes around each query value
+def axis_weights(values, axis_start, axis_step):
+
+    u       = (np.asarray(values, dtype=float)-axis_start)/axis_step
+    index   = np.floor(u).astype(int)
+    frac    = u - index
+    offsets = np.arange(-1, 3)
+
+    nodes   = index[..., None] + offsets
+    weights = cubic_weights(frac[..., None] - offsets)
+    return nodes, weights
+
+#########################
+# Kernel Fingerprinting #
+#########################
+
+def kernel_fingerprint(kernel):
+
+    digest = hashlib.sha256()
+    for array in [kernel.dataset, kernel.covariance, kernel.weights]:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+##########################
+# Tabulated Kernel Class #
+##########################
+
+class TABULATED_KERNEL:
+
+    def __init__(self, axis_start, axis_step, axis_length, block_index, blocks, exact_kernel=None, metadata=None):
+
+        self.axis_start  = np.asarray(axis_start, dtype=float)
+        self.axis_step   = np.asarray(axis_step, dtype=float)
+        self.axis_length = np.asarray(axis_length, dtype=int)
+        self.block_index = block_index
+        self.blocks      = blocks
+        self.block_size  = blocks.shape[-1]
+        self.d           = len(self.axis_start)
+
+        self.exact_kernel = exact_kernel
+        self.metadata     = {} if metadata is None else metadata
+
+        self.peak     = float(np.max(blocks)) if blocks.size > 0 else 0.0
+        self.fallback = default_fallback
+
+    #---- table values at integer node indices (zero in the empty blocks) ----#
+
+    def lookup(self, *nodes):
+
+        b        = self.block_size
+        block_id = self.block_index[tuple(node//b for node in nodes)]
+        values   = self.blocks[(np.maximum(block_id, 0),) + tuple(node % b for node in nodes)]
+        return np.where(block_id >= 0, values, 0.0)
+
+    #---- making sure the queries stay inside the tabulated domain ----#
+
+    def in_domain(self, nodes, axis):
+
+        return (nodes[..., 0] >= 0) & (nodes[..., -1] < self.axis_length[axis])
+
+    #---- evaluating at arbitrary points, same call signature as scipy's gaussian_kde ----#
+
+    def evaluate(self, points, chunk_size=20000):
+
+        points = np.atleast_2d(np.asarray(points, dtype=float))
+        pdf    = np.zeros(points.shape[1])
+
+        for start in range(0, points.shape[1], chunk_size):
+
+            chunk   = points[:, start:start+chunk_size]
+            weights = []
+            nodes   = []
+            inside  = np.ones(chunk.shape[1], dtype=bool)
+
+            for axis in range(self.d):
+                axis_nodes, axis_weight = axis_weights(chunk[axis], self.axis_start[axis], self.axis_step[axis])
+                inside = inside & self.in_domain(axis_nodes, axis)
+                nodes.append(np.clip(axis_nodes, 0, self.axis_length[axis]-1))
+                weights.append(axis_weight)
+
+            values = np.zeros(chunk.shape[1])
+            for corner in itertools.product(range(4), repeat=self.d):
+                weight  = np.prod([weights[axis][:, corner[axis]] for axis in range(self.d)], axis=0)
+                values += weight * self.lookup(*[nodes[axis][:, corner[axis]] for axis in range(self.d)])
+
+            # the cubic convolution rings below zero next to steep edges; a density is never negative
+            np.maximum(values, 0, out=values)
+
+            # anything outside the table goes to the exact kernel
+            if (not np.all(inside)) and (self.exact_kernel is not None):
+                values[~inside] = self.exact_kernel.evaluate(chunk[:, ~inside])
+
+            pdf[start:start+chunk_size] = values
+
+        return pdf
+
+    #---- evaluating on the cartesian product of four axes: returns an (n0, n1, n2, n3) array ----#
+
+    def evaluate_grid(self, *grid_axes):
+
+        matrices = []
+        slices   = []
+
+        for axis, values in enumerate(grid_axes):
+
+            axis_nodes, axis_weight = axis_weights(values, self.axis_start[axis], self.axis_step[axis])
+
+            if not np.all(self.in_domain(axis_nodes, axis)):
+                return self.evaluate_exact_grid(*grid_axes)
+
+            first  = axis_nodes.min()
+            last   = axis_nodes.max()
+            matrix = np.zeros((len(values), last-first+1))
+            np.add.at(matrix, (np.arange(len(values))[:, None], axis_nodes-first), axis_weight)
+
+            matrices.append(matrix)
+            slices.append(np.arange(first, last+1))
+
+        # the part of the table that the grid touches
+        sub_table = self.lookup(*np.ix_(*slices))
+
+        # contracting one axis at a time
+        pdf = sub_table
+        for matrix in matrices:
+            pdf = np.tensordot(pdf, matrix, axes=([0], [1]))
+
+        # clipped as in evaluate, so that the cumulative sums of the posteriors never decrease (see posterior_grid)
+        np.maximum(pdf, 0, out=pdf)
+
+        # empty, or too sparse for the table
+        if not (np.max(pdf) > self.fallback*self.peak):
+            return self.evaluate_exact_grid(*grid_axes)
+
+        return pdf
+
+    def evaluate_exact_grid(self, *grid_axes):
+
+        return self.exact_kernel.evaluate_grid(*grid_axes)
+
+#######################
+# Building the Tables #
+#######################
+
+# kernel is a gaussian kde; last_axis_range fixes the range of the quantity being measured (e.g. Z or t2)
+def build_table(kernel, last_axis_range=None, spacing=default_spacing, cutoff=default_cutoff,
+                block_size=default_block_size, threshold=default_threshold):
+
+    dataset    = np.asarray(kernel.dataset, dtype=float)
+    covariance = np.asarray(kernel.covariance, dtype=float)
+    weights    = np.asarray(kernel.weights, dtype=float)
+
+    d          = dataset.shape[0]
+    bandwidth  = np.sqrt(np.diag(covariance))
+    precision  = np.linalg.inv(covariance)
+    norm       = 1/np.sqrt(np.power(2*np.pi, d)*np.linalg.det(covariance))
+
+    #---- the table axes (two nodes of margin for the cubic interpolation) ----#
+
+    axis_step  = spacing*bandwidth
+    axis_lo    = dataset.min(axis=1) - cutoff*bandwidth
+    axis_hi    = dataset.max(axis=1) + cutoff*bandwidth
+
+    if last_axis_range is not None:
+        axis_lo[-1], axis_hi[-1] = last_axis_range
+
+    axis_lo     = axis_lo - 2*axis_step
+    axis_hi     = axis_hi + 2*axis_step
+    axis_length = np.ceil((axis_hi-axis_lo)/axis_step).astype(int) + 1
+    axes        = [axis_lo[axis] + axis_step[axis]*np.arange(axis_length[axis]) for axis in range(d)]
+
+    #---- adding the kernels one by one, each only within cutoff bandwidths ----#
+
+    table = np.zeros(axis_length)
+
+    for j in range(dataset.shape[1]):
+
+        sub_slices = []
+        offsets    = []
+
+        for axis in range(d):
+            first = max(0, int(np.ceil((dataset[axis, j]-cutoff*bandwidth[axis]-axis_lo[axis])/axis_step[axis])))
+            last  = min(axis_length[axis], int(np.floor((dataset[axis, j]+cutoff*bandwidth[axis]-axis_lo[axis])/axis_step[axis]))+1)
+            sub_slices.append(slice(first, last))
+            offsets.append(axes[axis][first:last]-dataset[axis, j])
+
+        offsets = np.ix_(*offsets)
+        exponent = 0
+        for a in range(d):
+            for b in range(d):
+                exponent = exponent + precision[a, b]*offsets[a]*offsets[b]
+
+        table[tuple(sub_slices)] += weights[j]*np.exp(-0.5*exponent)
+
+    table = table*norm
+
+    #---- storing only the non-empty blocks ----#
+
+    n_blocks = np.ceil(axis_length/block_size).astype(int)
+    padded   = np.zeros(n_blocks*block_size)
+    padded[tuple(slice(0, n) for n in axis_length)] = table
+
+    shape = []
+    for n in n_blocks:
+        shape += [n, block_size]
+    blocked = padded.reshape(shape).transpose(list(range(0, 2*d, 2)) + list(range(1, 2*d, 2)))
+
+    non_empty   = blocked.max(axis=tuple(range(d, 2*d))) > threshold*table.max()
+    block_index = np.full(n_blocks, -1, dtype=np.int32)
+    block_index[non_empty] = np.arange(np.sum(non_empty))
+    blocks      = blocked[non_empty].astype(np.float32)
+
+    metadata = {}
+    metadata['version']     = table_version
+    metadata['fingerprint'] = kernel_fingerprint(kernel)
+    metadata['spacing']     = spacing
+    metadata['cutoff']      = cutoff
+    metadata['threshold']   = threshold
+
+    return TABULATED_KERNEL(axis_lo, axis_step, axis_length, block_index, blocks, exact_kernel=kernel, metadata=metadata)
+
+####################
+# Saving & Loading #
+####################
+
+# written to a temporary file (of this process) and renamed, so that a killed build or two processes building
+# the same table at once never leave a truncated file behind
+def save_table(table, path):
+
+    temporary = '%s.%i.tmp' %(path, os.getpid())
+
+    try:
+        with open(temporary, 'wb') as handle:
+            np.savez_compressed(handle,
+                                axis_start=table.axis_start, axis_step=table.axis_step, axis_length=table.axis_length,
+                                block_index=table.block_index, blocks=table.blocks,
+                                version=table.metadata['version'], fingerprint=table.metadata['fingerprint'],
+                                spacing=table.metadata['spacing'], cutoff=table.metadata['cutoff'],
+                                threshold=table.metadata['threshold'])
+        os.replace(temporary, path)
+
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+def load_table(path, exact_kernel=None):
+
+    with np.load(path) as handle:
+
+        metadata = {}
+        metadata['version']     = int(handle['version'])
+        metadata['fingerprint'] = str(handle['fingerprint'])
+        metadata['spacing']     = float(handle['spacing'])
+        metadata['cutoff']      = float(handle['cutoff'])
+        metadata['threshold']   = float(handle['threshold'])
+
+        if metadata['version'] != table_version:
+            raise ValueError('%s was built with table version %i, but version %i is expected; please rebuild it' %(path, metadata['version'], table_version))
+
+        if (exact_kernel is not None) and (metadata['fingerprint'] != kernel_fingerprint(exact_kernel)):
+            raise ValueError('%s was not built from the current kernel; please rebuild it' %path)
+
+        table = TABULATED_KERNEL(handle['axis_start'], handle['axis_step'], handle['axis_length'],
+                                 handle['block_index'], handle['blocks'],
+                                 exact_kernel=exact_kernel, metadata=metadata)
+    return table
+
+# the places a table is looked for, in order: path (next to the kernel), then the cache directory
+def table_paths(path):
+
+    return [path, os.path.join(cache_directory, os.path.basename(path))]
+
+# loads the table from the first of its table_paths where it is readable and up to date, or builds it and saves it
+# to the first where it can be saved (a truncated file, e.g. from a build killed before the saves were atomic, is
+# rebuilt); metadata['path'] is where the table was loaded from or saved to (None if it could not be saved)
+def get_table(path, exact_kernel, last_axis_range=None):
+
+    for table_path in table_paths(path):
+        if os.path.exists(table_path):
+            try:
+                table = load_table(table_path, exact_kernel=exact_kernel)
+                table.metadata['path'] = table_path
+                return table
+            except (ValueError, KeyError, EOFError, OSError, zipfile.BadZipFile):
+                pass
+
+    logger.info('building %s (about ten seconds)', os.path.basename(path))
+
+    table = build_table(exact_kernel, last_axis_range=last_axis_range)
+    table.metadata['path'] = None
+
+    errors = []
+    for table_path in table_paths(path):
+        try:
+            os.makedirs(os.path.dirname(table_path), exist_ok=True)
+            save_table(table, table_path)
+            table.metadata['path'] = table_path
+            return table
+        except OSError as error:
+            errors.append('%s: %s' %(table_path, error))
+
+    logger.warning('the tabulated kernel could not be saved (%s), so every process will rebuild it; build it once with '
+                   '\'python -m genesis_metallicity.kernel.tabulated_kernel build\' or set GENESIS_METALLICITY_CACHE '
+                   'to a writable directory', '; '.join(errors))
+    return table
+
+##################################
+# Accuracy against the Exact KDE #
+##################################
+
+# compares the table to the exact kernel at random points scattered (by one bandwidth) around the training data
+def verify_table(table, n_points=20000, seed=0):
+
+    kernel    = table.exact_kernel
+    rng       = np.random.default_rng(seed)
+    bandwidth = np.sqrt(np.diag(kernel.covariance))
+
+    index  = rng.integers(0, kernel.dataset.shape[1], n_points)
+    points = kernel.dataset[:, index] + rng.normal(0, 1, (kernel.dataset.shape[0], n_points))*bandwidth[:, None]
+
+    exact     = kernel.evaluate(points)
+    tabulated = table.evaluate(points)
+    peak      = kernel.evaluate(kernel.dataset).max()
+
+    error = np.abs(tabulated-exact)/peak
+
+    report = {}
+    report['max_error']    = error.max()
+    report['p99_error']    = np.percentile(error, 99)
+    report['median_error'] = np.median(error)
+    return report
+
+#################
+# Build Command #
+#################
+
+# builds (or checks) the metallicity and temperature tables ahead of time, e.g. once for a shared install
+if __name__ == '__main__':
+
+    if (len(sys.argv) != 2) or (sys.argv[1] != 'build'):
+        sys.exit('usage: python -m genesis_metallicity.kernel.tabulated_kernel build')
+
+    from ..metallicity.strong_method import get_kernel_metallicity
+    from ..temperature.temperature_estimator import get_kernel_temperature
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    for name, get_kernel in [('metallicity', get_kernel_metallicity), ('temperature', get_kernel_temperature)]:
+
+        table = get_kernel('tabulated')
+        if table.metadata['path'] is None:
+            sys.exit('the %s table could not be saved' %name)
+
+        logger.info('%s table: %s', name, table.metadata['path'])
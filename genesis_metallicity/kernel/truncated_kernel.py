@@ -0,0 +1,150 @@
+import time
+import numpy as np
+
+from .gaussian_kernel import gaussian_sum
+
+##########
+# Config #
+##########
+
+# cutoff radius and cell size are in units of the kernel bandwidth (i.e. in whitened coordinates)
+default_cutoff    = 5.0
+default_cell_size = 1.0
+
+##########################
+# Truncated Kernel Class #
+##########################
+
+# sums, for each query point, only the training points within cutoff bandwidths of it:
+# the query points are binned into cells and the neighbours of each cell are found with a KD-tree
+class TRUNCATED_KERNEL:
+
+    def __init__(self, exact_kernel, cutoff=default_cutoff, cell_size=default_cell_size):
+
+        from scipy.spatial import cKDTree
+
+        self.exact_kernel = exact_kernel
+        self.cutoff       = cutoff
+        self.cell_size    = cell_size
+        self.d            = exact_kernel.d
+
+        self.dataset = exact_kernel.whiten(exact_kernel.dataset)
+        self.weights = np.asarray(exact_kernel.weights)
+        self.tree    = cKDTree(self.dataset.T)
+
+        # each dropped training point contributes less than weight*norm*exp(-cutoff^2/2);
+        # max_error is the sum of these bounds relative to the peak density of the kernel
+        self.peak      = exact_kernel.evaluate(exact_kernel.dataset).max()
+        self.max_error = exact_kernel.norm*np.exp(-0.5*cutoff**2)/self.peak
+
+    #---- evaluating at arbitrary points, same call signature as scipy's gaussian_kde ----#
+
+    def evaluate(self, points):
+
+        return self.evaluate_whitened(self.exact_kernel.whiten(np.atleast_2d(np.asarray(points, dtype=float))))
+
+    __call__ = evaluate
+
+    #---- evaluating on the cartesian product of the grid axes: returns an (n0, n1, ...) array ----#
+
+    def evaluate_grid(self, *grid_axes):
+
+        pdf = self.evaluate_whitened(self.exact_kernel.whiten_grid(*grid_axes))
+
+        # a grid far from all the training points goes to the exact kernel, as with the tabulated kernel
+        if not np.any(pdf):
+            return self.exact_kernel.evaluate_grid(*grid_axes)
+
+        return pdf.reshape(tuple(len(values) for values in grid_axes))
+
+    #---- the truncated sum, for points that are already whitened ----#
+
+    def evaluate_whitened(self, points):
+
+        # nan for non-finite points, as with the exact kernel
+        finite = np.all(np.isfinite(points), axis=0)
+        pdf    = np.where(finite, 0.0, np.nan)
+        points = points[:, finite]
+
+        if points.shape[1] == 0:
+            return pdf
+        values = np.zeros(points.shape[1])
+
+        #---- binning the query points ----#
+
+        coords = np.floor(points/self.cell_size).astype(np.int64)
+        lo     = coords.min(axis=1)[:, None]
+        shape  = tuple(coords.max(axis=1) - lo[:, 0] + 1)
+
+        # one integer key per cell is much faster to sort than the cell coordinates themselves
+        if np.prod(shape, dtype=float) < 2**62:
+            keys, members = np.unique(np.ravel_multi_index(tuple(coords-lo), shape), return_inverse=True)
+            cells         = np.array(np.unravel_index(keys, shape)) + lo
+        else:
+            cells, members = np.unique(coords, axis=1, return_inverse=True)
+
+        members = members.reshape(-1)
+        order   = np.argsort(members, kind='stable')
+        edges   = np.searchsorted(members[order], np.arange(cells.shape[1]+1))
+
+        # the neighbours of a cell are those within cutoff of any point of it
+        centers    = (cells+0.5)*self.cell_size
+        radius     = self.cutoff + 0.5*self.cell_size*np.sqrt(self.d)
+        neighbours = self.tree.query_ball_point(centers.T, radius)
+
+        #---- dense sum over the neighbours of each cell ----#
+
+        for cell in range(cells.shape[1]):
+
+            index = np.asarray(neighbours[cell], dtype=int)
+            if len(index) == 0:
+                continue
+
+            query         = order[edges[cell]:edges[cell+1]]
+            values[query] = gaussian_sum(points[:, query], self.dataset[:, index], self.weights[index])
+
+        pdf[finite] = values * self.exact_kernel.norm
+        return pdf
+
+#############
+# Benchmark #
+#############
+
+# compares the truncated to the exact kernel on the posterior grids of n_objects random calibration objects;
+# axes_function(*args) returns (grid_axes, weight_array), as metallicity_axes and temperature_axes do
+def benchmark_truncated(truncated_kernel, axes_function, n_objects=20, uncertainty=0.05, seed=0):
+
+    exact_kernel = truncated_kernel.exact_kernel
+    rng          = np.random.default_rng(seed)
+
+    exact_time     = 0
+    truncated_time = 0
+    errors         = []
+    grid_errors    = []
+
+    for j in rng.integers(0, exact_kernel.n, n_objects):
+
+        args = []
+        for value in np.asarray(exact_kernel.dataset[:-1, j]):
+            args += [value, uncertainty]
+        grid_axes, weight_array = axes_function(*args)
+
+        start          = time.time()
+        exact          = exact_kernel.evaluate_grid(*grid_axes).reshape(-1)
+        exact_time    += time.time() - start
+
+        start          = time.time()
+        truncated      = truncated_kernel.evaluate_grid(*grid_axes).reshape(-1)
+        truncated_time += time.time() - start
+
+        errors.append(np.max(np.abs(truncated-exact))/truncated_kernel.peak)
+        grid_errors.append(np.max(np.abs(truncated-exact))/np.max(exact))
+
+    report = {}
+    report['exact_time']     = exact_time/n_objects
+    report['truncated_time'] = truncated_time/n_objects
+    report['speedup']        = exact_time/truncated_time
+    report['max_error']      = np.max(errors)
+    report['max_grid_error'] = np.max(grid_errors)
+    report['error_bound']    = truncated_kernel.max_error
+    return report
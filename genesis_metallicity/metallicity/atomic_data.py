@@ -0,0 +1,178 @@
+import numpy as np
+
+##########
+# Config #
+##########
+
+# log-temperature spacing of the emissivity tables (in dex)
+default_log_tem_step = 5e-4
+
+# temperature range [K] over which the emissivities are tabulated for the ionic abundances;
+# PyNeb's H I recombination data (and hence the abundances) end at 3e4 K
+default_tem_range = (1e+3, 3e+4)
+
+# atomic data files selected when PyNeb is loaded
+default_data_files = ['o_iii_coll_Pal12-AK99.dat']
+
+#########
+# PyNeb #
+#########
+
+# PyNeb (and matplotlib, astropy, ... which it imports) is only loaded the first time it is needed
+pn = None
+
+def load_pyneb():
+
+    global pn
+
+    if pn is None:
+        import pyneb
+        for data_file in default_data_files:
+            pyneb.atomicData.setDataFile(data_file)
+        pn = pyneb
+    return pn
+
+################
+# PyNeb Caches #
+################
+
+atom_cache  = {}
+table_cache = {}
+
+#---- the atomic data files currently selected for an ion (set with pn.atomicData.setDataFile) ----#
+
+def data_files(elem, spec):
+
+    pn = load_pyneb()
+    return (pn.atomicData.getDataFile(elem+spec, 'atom'), pn.atomicData.getDataFile(elem+spec, 'coll'))
+
+#---- one pn.Atom per ion and set of atomic data files ----#
+
+def get_atom(elem, spec):
+
+    key = (elem, spec, data_files(elem, spec))
+
+    if key not in atom_cache:
+        atom_cache[key] = load_pyneb().Atom(elem, spec)
+    return atom_cache[key]
+
+#---- one emissivity table per ion, set of atomic data files and density ----#
+
+def get_tabulated_atom(elem, spec, den):
+
+    key = (elem, spec, data_files(elem, spec), float(den))
+
+    if key not in table_cache:
+        table_cache[key] = TABULATED_ATOM(get_atom(elem, spec), den)
+    return table_cache[key]
+
+#---- the atom used by the direct method for a given engine ----#
+
+def get_engine_atom(elem, spec, den, engine='exact'):
+
+    if engine == 'exact':
+        return get_atom(elem, spec)
+
+    if engine == 'tabulated':
+        return get_tabulated_atom(elem, spec, den)
+
+    raise ValueError('unknown emissivity engine \'%s\'; choose between \'exact\' and \'tabulated\'' %engine)
+
+########################
+# Tabulated Atom Class #
+########################
+
+class TABULATED_ATOM:
+
+    def __init__(self, atom, den, log_tem_step=default_log_tem_step, tem_range=default_tem_range):
+
+        self.atom = atom
+        self.den  = float(den)
+
+        self.log_tem_step = log_tem_step
+        self.tem_range    = tem_range
+
+        # emissivities are tabulated per wavelength the first time they are needed
+        self.emissivity = {}
+        self.ratio      = {}
+
+        #---- Hbeta emissivity on the abundance grid ----#
+
+        self.log_tem   = self.tem_grid(*np.log10(tem_range))
+        tem            = np.power(10, self.log_tem)
+        self.log_Hbeta = np.log10(load_pyneb().getRecEmissivity(tem, np.full(len(tem), self.den), 4, 2, atom='H1', product=False))
+
+    #---- log-temperature grid with the table spacing ----#
+
+    def tem_grid(self, log_tem_lo, log_tem_hi):
+
+        n = int(np.ceil((log_tem_hi-log_tem_lo)/self.log_tem_step)) + 1
+        return np.linspace(log_tem_lo, log_tem_hi, n)
+
+    def get_emissivity(self, log_tem, wave):
+
+        tem = np.power(10, log_tem)
+        return self.atom.getEmissivity(tem, np.full(len(tem), self.den), wave=wave, product=False)
+
+    #---- same call signature as pn.Atom.getTemDen, for the temperature at the tabulated density ----#
+
+    def getTemDen(self, int_ratio, wave1, wave2, den):
+
+        if float(den) != self.den:
+            return self.atom.getTemDen(int_ratio, wave1=wave1, wave2=wave2, den=den)
+
+        if (wave1, wave2) not in self.ratio:
+
+            # the same temperature range as PyNeb's root finder: that of the collision strengths
+            tem_array = self.atom.getTemArray(keep_unit=False)
+            log_tem   = self.tem_grid(np.log10(np.min(tem_array)), np.log10(np.max(tem_array)))
+            log_ratio = np.log10(self.get_emissivity(log_tem, wave1) / self.get_emissivity(log_tem, wave2))
+
+            # only a monotonic ratio can be inverted by interpolation
+            steps = np.diff(log_ratio)
+            if np.all(np.isfinite(log_ratio)) and (np.all(steps > 0) or np.all(steps < 0)):
+                order = np.argsort(log_ratio)
+                self.ratio[(wave1, wave2)] = (log_ratio[order], log_tem[order])
+            else:
+                self.ratio[(wave1, wave2)] = None
+
+        table = self.ratio[(wave1, wave2)]
+        if table is None:
+            return self.atom.getTemDen(int_ratio, wave1=wave1, wave2=wave2, den=den)
+
+        int_ratio = np.asarray(int_ratio, dtype=float)
+        log_ratio = np.log10(np.where(int_ratio > 0, int_ratio, np.nan))
+        tem       = np.power(10, np.interp(log_ratio, *table))
+
+        # finite ratios outside the tabulated range go to PyNeb (which returns nan for the others too);
+        # only those are solved for, which matters for the arrays of whole catalogs
+        outside = np.isfinite(log_ratio) & ((log_ratio < table[0][0]) | (log_ratio > table[0][-1]))
+        if np.any(outside):
+            tem          = np.where(outside, np.nan, tem)
+            tem[outside] = self.atom.getTemDen(int_ratio[outside], wave1=wave1, wave2=wave2, den=den)
+        return tem
+
+    #---- same call signature as pn.Atom.getIonAbundance, for the abundance at the tabulated density ----#
+
+    def getIonAbundance(self, int_ratio, tem, den, wave, Hbeta=100.):
+
+        tem = np.asarray(tem, dtype=float)
+        den = np.asarray(den, dtype=float)
+
+        if np.any(den != self.den):
+            return self.atom.getIonAbundance(int_ratio, tem=tem, den=den, wave=wave, Hbeta=Hbeta)
+
+        if wave not in self.emissivity:
+            self.emissivity[wave] = np.log10(self.get_emissivity(self.log_tem, wave))
+
+        log_tem   = np.log10(np.where(tem > 0, tem, np.nan))
+        log_emis  = np.interp(log_tem, self.log_tem, self.emissivity[wave])
+        log_Hbeta = np.interp(log_tem, self.log_tem, self.log_Hbeta)
+
+        abundance = (np.asarray(int_ratio, dtype=float) / Hbeta) * np.power(10, log_Hbeta-log_emis)
+
+        # finite temperatures outside the tabulated range go to PyNeb (which returns nan for the others too)
+        outside = np.isfinite(log_tem) & ((log_tem < self.log_tem[0]) | (log_tem > self.log_tem[-1]))
+        if np.any(outside):
+            abundance = np.where(outside, self.atom.getIonAbundance(int_ratio, tem=np.where(outside, tem, 1e+4), den=den, wave=wave, Hbeta=Hbeta), abundance)
+        return abundance
@@ -1,17 +1,78 @@
+import logging
 import warnings
 import numpy as np
 from copy import deepcopy
 from numpy.ma.core import maximum
-import pyneb as pn
 from uncertainties import ufloat
 from uncertainties import unumpy as unp
 
-from ..temperature.temperature_estimator import measure_temperature
+from ..temperature.temperature_estimator import measure_temperature, temperature_axis
+from ..kernel.posterior_grid import valid_grid_inputs
+from ..diagnostics import status_flags, tolerance_flags
+from ..profiler import profile_stage
+from .atomic_data import get_engine_atom
 
 warnings.filterwarnings('ignore', category=RuntimeWarning, message='invalid value encountered in log10')
 warnings.filterwarnings('ignore', category=RuntimeWarning, message='invalid value encountered in sqrt')
 
-pn.atomicData.setDataFile('o_iii_coll_Pal12-AK99.dat')
+logger = logging.getLogger(__name__)
+
+#################################
+# Branch-dependent Calculations #
+#################################
+
+#---- Te(OII) from Te(OIII) (Izotov+2006), for ufloats as well as arrays ----#
+
+# t(OII) = a + t*(b + c*t), with t = 1e-4*Te(OIII)
+izotov_coefficients = {}
+izotov_coefficients['low_Z']          = (-0.577, 2.065, -0.498)
+izotov_coefficients['intermediate_Z'] = (-0.744, 2.338, -0.610)
+izotov_coefficients['high_Z']         = (2.967, -4.797, 2.827)
+
+def izotov_Te_OII(Te_OIII, branch):
+
+    a, b, c = izotov_coefficients[branch]
+
+    t      = 1e-4 * Te_OIII
+    t_OII  = a + t * (b + c*t)
+    Te_OII = 1e+4 * t_OII
+    return Te_OII
+
+# dTe(OII)/dTe(OIII), for the linear uncertainties of arrays
+def izotov_slope(Te_OIII, branch):
+
+    a, b, c = izotov_coefficients[branch]
+    return b + 2*c*(1e-4*Te_OIII)
+
+#---- whether a metallicity Z +/- Z_unc is consistent with the branch it was measured with (scalars or arrays) ----#
+
+def consistent_branch(Z, Z_unc, branch, tolerate='no'):
+
+    #---- do NOT account for Z uncertainties in determining the branch ----#
+
+    Z_lo = Z
+    Z_hi = Z
+
+    #---- account for Z uncertainties in determining the branch ----#
+
+    if tolerate in ['unc', 'max']:
+
+        Z_tolerance = np.minimum(Z_unc, 0.15)
+        if tolerate == 'max': Z_tolerance = 0.15
+
+        Z_lo = Z - Z_tolerance
+        Z_hi = Z + Z_tolerance
+
+    if branch == 'low_Z':
+        return Z_lo < 7.4
+
+    if branch == 'intermediate_Z':
+        return ((7.4 <= Z_lo) & (Z_lo < 7.9)) | ((7.4 <= Z_hi) & (Z_hi < 7.9))
+
+    if branch == 'high_Z':
+        return 7.9 <= Z_hi
+
+    return False
 
 #####################
 # Metallicity Class #
@@ -19,7 +80,8 @@ pn.atomicData.setDataFile('o_iii_coll_Pal12-AK99.dat')
 
 class METALLICITY:
 
-    def __init__(self, object, data_dict, t2_calibration='L24', global_den=100, print_progress=False):
+    def __init__(self, object, data_dict, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False, print_progress=False,
+                 profiler=None):
 
         #---------------------------------#
         #---- reading the line fluxes ----#
@@ -27,75 +89,74 @@ class METALLICITY:
 
         self.object = object
 
-        try:
-            self.O3727  = data_dict['OII']/2
-        except:
-            self.O3727  = ufloat(np.nan, np.nan)
+        missing = ufloat(np.nan, np.nan)
 
-        try:
-            self.O3729  = data_dict['OII']/2
-        except:
-            self.O3729  = ufloat(np.nan, np.nan)
+        self.O3727  = data_dict.get('OII', missing)/2
+        self.O3729  = data_dict.get('OII', missing)/2
+        self.O4363  = data_dict.get('O4363', missing)
+        self.Hb     = data_dict.get('Hbeta', missing)
+        self.O4959  = data_dict.get('O4959', missing)
+        self.O5007  = data_dict.get('O5007', missing)
+        self.O7320  = data_dict.get('OII7320', missing)
 
-        try:
-            self.O4363  = data_dict['O4363']
-        except:
-            self.O4363  = ufloat(np.nan, np.nan)
+        # the status flags of the measurement (see diagnostics.status_flags)
+        self.status = 0
 
-        try:
-            self.Hb     = data_dict['Hbeta']
-        except:
-            self.Hb     = ufloat(np.nan, np.nan)
+        if np.isnan(self.O3727.n) or np.isnan(self.O4363.n) or np.isnan(self.O5007.n) or np.isnan(self.Hb.n):
+            self.status |= status_flags['missing_line']
 
-        try:
-            self.O4959  = data_dict['O4959']
-        except:
-            self.O4959  = ufloat(np.nan, np.nan)
+        # the print_progress messages are logged at the info level, the rest at the debug level
+        level = logging.INFO if print_progress else logging.DEBUG
 
-        try:
-            self.O5007  = data_dict['O5007']
-        except:
-            self.O5007  = ufloat(np.nan, np.nan)
+        #----------------------------------------------------#
+        #---- the (cached) atom objects for OII and OIII ----#
+        #----------------------------------------------------#
 
-        try:
-            self.O7320  = data_dict['OII7320']
-        except:
-            self.O7320  = ufloat(np.nan, np.nan)
+        O2 = get_engine_atom('O', '2', global_den, engine=emissivity_engine)
+        O3 = get_engine_atom('O', '3', global_den, engine=emissivity_engine)
 
         #--------------------------------------#
         #---- calculating the Te_OII_O7320 ----#
         #--------------------------------------#
 
         self.Te_OII            = ufloat(np.nan, np.nan)
+        self.Te_OIII           = ufloat(np.nan, np.nan)
+        self.metallicity       = ufloat(np.nan, np.nan)
         self.Te_OII_Izotov     = ufloat(np.nan, np.nan)
         self.Te_OII_Langeroodi = ufloat(np.nan, np.nan)
         self.Te_OII_O7320      = ufloat(np.nan, np.nan)
 
-        try:
-            O2           = pn.Atom('O', '2')
+        # the marginal posterior of Te_OII_Langeroodi (if posterior=True)
+        self.Te_OII_Langeroodi_posterior = None
 
-            OII_ratio    = (self.O3727+self.O3729) / self.O7320
-            OII_ratio    = np.array([OII_ratio.n-OII_ratio.s, OII_ratio.n, OII_ratio.n+OII_ratio.s])
-            Te_OII_O7320 = O2.getTemDen(OII_ratio, wave1=3727, wave2=7320, den=global_den)
-            Te_OII_O7320 = ufloat(min(Te_OII_O7320[1], 3e+4), np.abs(np.mean(np.diff(Te_OII_O7320))))
+        # whether Te_OII_O7320 (or its upper error) is clipped at 3e4 K
+        O7320_clipped = False
 
-            if (Te_OII_O7320.n + Te_OII_O7320.s) > 3e+4:
-                Te_OII_O7320 = ufloat(Te_OII_O7320.n, 3e+4-Te_OII_O7320.n)
+        with profile_stage(profiler, 'Te_OII_O7320'):
 
-            self.Te_OII_O7320 = Te_OII_O7320
-        except:
-            self.Te_OII_O7320 = ufloat(np.nan, np.nan)
+            # without [OII]7320 (nan or zero) there is no ratio to measure
+            if (self.O7320.n != 0) and not np.isnan(self.O7320.n):
 
-        #----------------------------------------------------------------#
-        #---- function for calculating the direct method metallicity ----#
-        #----------------------------------------------------------------#
+                OII_ratio    = (self.O3727+self.O3729) / self.O7320
+                OII_ratio    = np.array([OII_ratio.n-OII_ratio.s, OII_ratio.n, OII_ratio.n+OII_ratio.s])
+                Te_OII_O7320 = O2.getTemDen(OII_ratio, wave1=3727, wave2=7320, den=global_den)
 
-        def calculate_direct_metallicity(branch):
+                O7320_clipped = Te_OII_O7320[1] > 3e+4
 
-            #---- create atom objects for OII and OIII ----#
+                Te_OII_O7320 = ufloat(min(Te_OII_O7320[1], 3e+4), np.abs(np.mean(np.diff(Te_OII_O7320))))
 
-            O2 = pn.Atom('O', '2')
-            O3 = pn.Atom('O', '3')
+                if (Te_OII_O7320.n + Te_OII_O7320.s) > 3e+4:
+                    Te_OII_O7320  = ufloat(Te_OII_O7320.n, 3e+4-Te_OII_O7320.n)
+                    O7320_clipped = True
+
+                self.Te_OII_O7320 = Te_OII_O7320
+
+        #---------------------------------------------------------------------#
+        #---- functions for calculating the branch-independent quantities ----#
+        #---------------------------------------------------------------------#
+
+        # returns None where Te(OIII) is undefined (a negative uncertainty, once clipped at 3e4 K)
+        def calculate_Te_OIII():
 
             #---- calculate Te(OIII) ----#
 
@@ -103,37 +164,18 @@ class METALLICITY:
             OIII_ratio = np.array([OIII_ratio.n-OIII_ratio.s, OIII_ratio.n, OIII_ratio.n+OIII_ratio.s])
             OIII_ratio = np.clip(OIII_ratio, a_min=None, a_max=0.0465)
             Te_OIII    = O3.getTemDen(OIII_ratio, wave1=4363, wave2=5007, den=global_den)
-            Te_OIII    = ufloat(Te_OIII[1], np.mean(np.diff(Te_OIII)))
-
-            if (Te_OIII.n + Te_OIII.s) > 3e+4:
-                Te_OIII = ufloat(Te_OIII.n, 3e+4-Te_OIII.n)
-
-            #---- calculate Te(OII) (Izotov+2006) ----#
-
-            def calculate_Te_OII(Te_OIII, branch):
-
-                t = 1e-4 * Te_OIII
-
-                if branch == 'low_Z':
-                    t_OII = -0.577 + t * (2.065 - 0.498*t)
-
-                if branch == 'intermediate_Z':
-                    t_OII = -0.744 + t * (2.338 - 0.610*t)
+            Te_OIII    = (Te_OIII[1], np.mean(np.diff(Te_OIII)))
 
-                if branch == 'high_Z':
-                    t_OII = 2.967 + t * (-4.797 + 2.827*t)
+            if (Te_OIII[0] + Te_OIII[1]) > 3e+4:
+                Te_OIII = (Te_OIII[0], 3e+4-Te_OIII[0])
+                self.status |= status_flags['Te_OIII_clipped']
 
-                Te_OII = 1e+4 * t_OII
-                return Te_OII
+            if Te_OIII[1] < 0:
+                return None
+            return ufloat(*Te_OIII)
 
-            Te_OII_Izotov = calculate_Te_OII(Te_OIII, branch)
-
-            if Te_OII_Izotov.n > 3e+4:
-                Te_OII_Izotov = ufloat(3e+4, 0)
-            if (Te_OII_Izotov.n + Te_OII_Izotov.s) > 3e+4:
-                Te_OII_Izotov = ufloat(Te_OII_Izotov.n, 3e+4-Te_OII_Izotov.n)
-
-            self.Te_OII_Izotov = Te_OII_Izotov
+        # returns None where the grid of the t2 posterior cannot be built
+        def calculate_Te_OII_Langeroodi_and_OPP(Te_OIII):
 
             #---- calculate Te(OII) (Langeroodi+2024) ----#
 
@@ -146,216 +188,403 @@ class METALLICITY:
             O2_ratio         = unp.log10([O2_ratio])[0]
             O3_ratio         = unp.log10([O3_ratio])[0]
 
-            Te_OII_Langeroodi = measure_temperature(O2_ratio.n, O2_ratio.s,
-                                                    O3_ratio.n, O3_ratio.s,
-                                                    Te_OIII.n/1e+4, Te_OIII.s/1e+4)
+            inputs = (O2_ratio.n, O2_ratio.s, O3_ratio.n, O3_ratio.s, Te_OIII.n/1e+4, Te_OIII.s/1e+4)
+
+            if not valid_grid_inputs(*inputs, length=grid_length):
+                return None
+
+            with profile_stage(profiler, 't2_estimation'):
+                Te_OII_Langeroodi = measure_temperature(*inputs, length=grid_length, engine=kernel_engine,
+                                                        grid=grid, resolution=grid_resolution, posterior=posterior)
+            if posterior:
+                Te_OII_Langeroodi, t2_posterior  = Te_OII_Langeroodi
+                self.Te_OII_Langeroodi_posterior = t2_posterior.rescale(1e+4)
             Te_OII_Langeroodi = 1e+4 * Te_OII_Langeroodi
             self.Te_OII_Langeroodi = Te_OII_Langeroodi
 
+            #---- measuring the O++ abundances ----#
+
+            with profile_stage(profiler, 'abundance'):
+
+                OIII4959_ratio    = self.O4959 / self.Hb
+                OIII4959_ratio    = np.array([OIII4959_ratio.n-OIII4959_ratio.s, OIII4959_ratio.n, OIII4959_ratio.n+OIII4959_ratio.s])
+                OPP4959_abundance = O3.getIonAbundance(OIII4959_ratio, tem=[Te_OIII.n-Te_OIII.s, Te_OIII.n, Te_OIII.n+Te_OIII.s], den=[global_den,global_den,global_den], wave=4959, Hbeta=1)
+                OPP4959_abundance = ufloat(OPP4959_abundance[1], np.mean(np.abs(np.diff(OPP4959_abundance))))
+
+                OIII5007_ratio    = self.O5007 / self.Hb
+                OIII5007_ratio    = np.array([OIII5007_ratio.n-OIII5007_ratio.s, OIII5007_ratio.n, OIII5007_ratio.n+OIII5007_ratio.s])
+                OPP5007_abundance = O3.getIonAbundance(OIII5007_ratio, tem=[Te_OIII.n-Te_OIII.s, Te_OIII.n, Te_OIII.n+Te_OIII.s], den=[global_den,global_den,global_den], wave=5007, Hbeta=1)
+                OPP5007_abundance = ufloat(OPP5007_abundance[1], np.mean(np.abs(np.diff(OPP5007_abundance))))
+
+            return OPP4959_abundance, OPP5007_abundance
+
+        #----------------------------------------------------------------#
+        #---- function for calculating the direct method metallicity ----#
+        #----------------------------------------------------------------#
+
+        def calculate_direct_metallicity(branch, Te_OIII, OPP5007_abundance):
+
+            #---- calculate Te(OII) (Izotov+2006) ----#
+
+            Te_OII_Izotov = izotov_Te_OII(Te_OIII, branch)
+
+            Izotov_clipped = (Te_OII_Izotov.n > 3e+4) or ((Te_OII_Izotov.n + Te_OII_Izotov.s) > 3e+4)
+
+            if Te_OII_Izotov.n > 3e+4:
+                Te_OII_Izotov = ufloat(3e+4, 0)
+            if (Te_OII_Izotov.n + Te_OII_Izotov.s) > 3e+4:
+                Te_OII_Izotov = ufloat(Te_OII_Izotov.n, 3e+4-Te_OII_Izotov.n)
+
+            self.Te_OII_Izotov = Te_OII_Izotov
+
             #---- choosing a Te(OII) measurement ----#
 
             if ~np.isnan(self.Te_OII_O7320.n):
-                Te_OII = deepcopy(self.Te_OII_O7320)
+                Te_OII         = deepcopy(self.Te_OII_O7320)
+                Te_OII_clipped = O7320_clipped
 
             if np.isnan(self.Te_OII_O7320.n):
 
                 if (t2_calibration == 'L24') and (8500 < Te_OIII.n < 14000):
-                    Te_OII = deepcopy(self.Te_OII_Langeroodi)
+                    Te_OII         = deepcopy(self.Te_OII_Langeroodi)
+                    Te_OII_clipped = False
 
                 else:
-                    Te_OII = deepcopy(self.Te_OII_Izotov)
-
-            #---- measuring the abundances ----#
+                    Te_OII         = deepcopy(self.Te_OII_Izotov)
+                    Te_OII_clipped = Izotov_clipped
 
-            OIII4959_ratio    = self.O4959 / self.Hb
-            OIII4959_ratio    = np.array([OIII4959_ratio.n-OIII4959_ratio.s, OIII4959_ratio.n, OIII4959_ratio.n+OIII4959_ratio.s])
-            OPP4959_abundance = O3.getIonAbundance(OIII4959_ratio, tem=[Te_OIII.n-Te_OIII.s, Te_OIII.n, Te_OIII.n+Te_OIII.s], den=[global_den,global_den,global_den], wave=4959, Hbeta=1)
-            OPP4959_abundance = ufloat(OPP4959_abundance[1], np.mean(np.abs(np.diff(OPP4959_abundance))))
+            #---- measuring the O+ abundances ----#
 
-            OIII5007_ratio    = self.O5007 / self.Hb
-            OIII5007_ratio    = np.array([OIII5007_ratio.n-OIII5007_ratio.s, OIII5007_ratio.n, OIII5007_ratio.n+OIII5007_ratio.s])
-            OPP5007_abundance = O3.getIonAbundance(OIII5007_ratio, tem=[Te_OIII.n-Te_OIII.s, Te_OIII.n, Te_OIII.n+Te_OIII.s], den=[global_den,global_den,global_den], wave=5007, Hbeta=1)
-            OPP5007_abundance = ufloat(OPP5007_abundance[1], np.mean(np.abs(np.diff(OPP5007_abundance))))
+            with profile_stage(profiler, 'abundance'):
 
-            OII3727_ratio     = self.O3727 / self.Hb
-            OII3727_ratio     = np.array([OII3727_ratio.n-OII3727_ratio.s, OII3727_ratio.n, OII3727_ratio.n+OII3727_ratio.s])
-            OP3727_abundance  = O2.getIonAbundance(OII3727_ratio, tem=[Te_OII.n-Te_OII.s, Te_OII.n, Te_OII.n+Te_OII.s], den=[global_den,global_den,global_den], wave=3727, Hbeta=1)
-            OP3727_abundance  = ufloat(OP3727_abundance[1], np.mean(np.abs(np.diff(OP3727_abundance))))
+                OII3727_ratio     = self.O3727 / self.Hb
+                OII3727_ratio     = np.array([OII3727_ratio.n-OII3727_ratio.s, OII3727_ratio.n, OII3727_ratio.n+OII3727_ratio.s])
+                OP3727_abundance  = O2.getIonAbundance(OII3727_ratio, tem=[Te_OII.n-Te_OII.s, Te_OII.n, Te_OII.n+Te_OII.s], den=[global_den,global_den,global_den], wave=3727, Hbeta=1)
+                OP3727_abundance  = ufloat(OP3727_abundance[1], np.mean(np.abs(np.diff(OP3727_abundance))))
 
-            OII3729_ratio     = self.O3729 / self.Hb
-            OII3729_ratio     = np.array([OII3729_ratio.n-OII3729_ratio.s, OII3729_ratio.n, OII3729_ratio.n+OII3729_ratio.s])
-            OP3729_abundance  = O2.getIonAbundance(OII3729_ratio, tem=[Te_OII.n-Te_OII.s, Te_OII.n, Te_OII.n+Te_OII.s], den=[global_den,global_den,global_den], wave=3729, Hbeta=1)
-            OP3729_abundance  = ufloat(OP3729_abundance[1], np.mean(np.abs(np.diff(OP3729_abundance))))
+                OII3729_ratio     = self.O3729 / self.Hb
+                OII3729_ratio     = np.array([OII3729_ratio.n-OII3729_ratio.s, OII3729_ratio.n, OII3729_ratio.n+OII3729_ratio.s])
+                OP3729_abundance  = O2.getIonAbundance(OII3729_ratio, tem=[Te_OII.n-Te_OII.s, Te_OII.n, Te_OII.n+Te_OII.s], den=[global_den,global_den,global_den], wave=3729, Hbeta=1)
+                OP3729_abundance  = ufloat(OP3729_abundance[1], np.mean(np.abs(np.diff(OP3729_abundance))))
 
             # O_abundance = (OPP4959_abundance + OPP5007_abundance + OP3727_abundance + OP3729_abundance)/2
             O_abundance = OPP5007_abundance + (OP3727_abundance + OP3729_abundance)/2
 
             Z = 12 + unp.log10(O_abundance)
 
-            # for debugging
-            if False:
-                print('---')
-                print(' -> branch %s' %branch)
-                print(Te_OII, Te_OIII, OP3727_abundance, OPP5007_abundance, Z)
+            logger.debug('object %s, branch %s: Te(OII) = %s, Te(OIII) = %s, O+ = %s, O++ = %s, 12 + log(O/H) = %s', object, branch, Te_OII, Te_OIII, OP3727_abundance, OPP5007_abundance, Z)
 
-            return Z, Te_OII, Te_OIII
+            return Z, Te_OII, Te_OII_clipped
 
         #----------------------------------------------------------------------------------------------#
         #---- function for checking if the returned metallicity and the used branch are consistent ----#
         #----------------------------------------------------------------------------------------------#
 
+        # the number of (branch, tolerance) checks, up to 9
+        self.branch_attempts = 0
+
+        # the Izotov+2006 branch the metallicity is measured with (None where there is no metallicity)
+        self.branch = None
+
         def check_branch(Z, Te_OIII, branch, tolerate='no'):
 
-            #---- do NOT account for Z uncertainties in determining the branch ----#
-
-            if tolerate not in ['unc', 'max']:
-
-                if (Z < 7.4) and (branch == 'low_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : low_Z')
-                    return True
-
-                if (7.4 <= Z < 7.9) and (branch == 'intermediate_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : intermediate_Z')
-                    return True
-
-                if (7.9 <= Z) and (branch == 'high_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : high_Z')
-                    return True
-
-            #---- account for Z uncertainties in determining the branch ----#
-
-            if tolerate in ['unc', 'max']:
-
-                Z_tolerance = min(Z.s, 0.15)
-                if tolerate == 'max': Z_tolerance = 0.15
-
-                if ((Z-Z_tolerance) < 7.4) and (branch == 'low_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : low_Z')
-                    return True
-
-                if (7.4 <= (Z-Z_tolerance) < 7.9) and (branch == 'intermediate_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : intermediate_Z')
-                    return True
-
-                if (7.4 <= (Z+Z_tolerance) < 7.9) and (branch == 'intermediate_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : intermediate_Z')
-                    return True
-
-                if (7.9 <= (Z+Z_tolerance)) and (branch == 'high_Z'):
-                    if print_progress:
-                        print('--------------------------------------------------')
-                        print(' + object %s' %object)
-                        print('---------------')
-                        print('Te([OIII])    = %.1f +/- %.1f' %(Te_OIII.n/1000, Te_OIII.s/1000))
-                        print('12 + log(O/H) = %.2f +/- %.2f' %(Z.n, Z.s))
-                        print('branch        : high_Z')
-                    return True
-
-            return False
+            self.branch_attempts += 1
+
+            with profile_stage(profiler, 'branch_selection'):
+                consistent = consistent_branch(Z.n, Z.s, branch, tolerate=tolerate)
+
+            if consistent and logger.isEnabledFor(level):
+                logger.log(level, 'object %s: Te([OIII]) = %.1f +/- %.1f, 12 + log(O/H) = %.2f +/- %.2f, branch %s (tolerance \'%s\')',
+                           object, Te_OIII.n/1000, Te_OIII.s/1000, Z.n, Z.s, branch, tolerate)
+
+            return consistent
 
         #------------------------------------------------#
         #---- function to iterate over the above two ----#
         #------------------------------------------------#
 
+        # each branch is solved at most once; the later tolerance levels only re-check the solutions;
+        # returns None (and sets the status flags) where there is no consistent branch
         def iterate():
 
-            branch = 'low_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'intermediate_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'high_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'low_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='unc'):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'intermediate_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='unc'):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'high_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='unc'):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'low_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='max'):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'intermediate_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='max'):
-                return Z, Te_OII, Te_OIII
-
-            branch = 'high_Z'
-            Z, Te_OII, Te_OIII = calculate_direct_metallicity(branch)
-            if check_branch(Z, Te_OIII, branch, tolerate='max'):
-                return Z, Te_OII, Te_OIII
-
-            raise Exception('no metallicty to return!')
-            return
+            #---- the branch-independent quantities, and the lines they divide by ----#
+
+            if (self.O5007.n == 0) or (self.Hb.n == 0):
+                self.status |= status_flags['invalid_lines']
+                return None
+
+            with profile_stage(profiler, 'Te_OIII'):
+                Te_OIII = calculate_Te_OIII()
+
+            if Te_OIII is None:
+                self.status |= status_flags['invalid_lines']
+                return None
+
+            # METALLICITY measures t2 for every object, even where the Te(OII) is not the Langeroodi+2024 one
+            OPP = calculate_Te_OII_Langeroodi_and_OPP(Te_OIII)
+
+            if OPP is None:
+                self.status |= status_flags['t2_grid_failed']
+                return None
+
+            OPP4959_abundance, OPP5007_abundance = OPP
+
+            #---- the first consistent branch ----#
+
+            solutions = {}
+
+            def solve(branch):
+                if branch not in solutions:
+                    solutions[branch] = (calculate_direct_metallicity(branch, Te_OIII, OPP5007_abundance), self.Te_OII_Izotov)
+                (Z, Te_OII, Te_OII_clipped), self.Te_OII_Izotov = solutions[branch]
+                return Z, Te_OII, Te_OII_clipped
+
+            for tolerate in ['no', 'unc', 'max']:
+                for branch in ['low_Z', 'intermediate_Z', 'high_Z']:
+                    Z, Te_OII, Te_OII_clipped = solve(branch)
+                    if check_branch(Z, Te_OIII, branch, tolerate=tolerate):
+                        self.branch  = branch
+                        self.status |= tolerance_flags[tolerate]
+                        if Te_OII_clipped:
+                            self.status |= status_flags['Te_OII_clipped']
+                        return Z, Te_OII, Te_OIII
+
+            self.status |= status_flags['no_branch']
+            return None
 
         #---- calculating the metallicity ----#
 
+        # anything raised here is unexpected: it is logged, and the object is flagged instead of failing
         try:
-            Z, Te_OII, Te_OIII = iterate()
+            solution = iterate()
+        except Exception:
+            logger.warning('object %s: the direct-method measurement failed', object, exc_info=True)
+            self.status |= status_flags['error']
+            solution     = None
+
+        if solution is not None:
+            Z, Te_OII, Te_OIII = solution
             if (Te_OII.n > -np.inf) and (Te_OIII.n < np.inf):
                 self.Te_OII      = Te_OII
                 self.Te_OIII     = Te_OIII
                 self.metallicity = Z
             else:
-                self.Te_OII      = ufloat(np.nan, np.nan)
-                self.Te_OIII     = ufloat(np.nan, np.nan)
-                self.metallicity = ufloat(np.nan, np.nan)
-        except:
-            self.Te_OII      = ufloat(np.nan, np.nan)
-            self.Te_OIII     = ufloat(np.nan, np.nan)
-            self.metallicity = ufloat(np.nan, np.nan)
+                self.branch  = None
+                self.status |= status_flags['invalid_lines']
+
+        if profiler is not None:
+            profiler.count_branches(self.branch_attempts)
+
+##############################
+# Direct Method for Catalogs #
+##############################
+
+#---- the values at -1, 0 and +1 sigma, where METALLICITY evaluates PyNeb, as (N, 3) arrays ----#
+
+def sigma_points(value, sigma):
+
+    return np.stack([value-sigma, value, value+sigma], axis=-1)
+
+#---- ratio of two independent lines given as (flux, err), with its linear uncertainty ----#
+
+def line_ratio(line_a, line_b):
+
+    ratio     = line_a[0]/line_b[0]
+    ratio_unc = np.sqrt(np.square(line_a[1]/line_b[0]) + np.square(line_a[0]/np.square(line_b[0])*line_b[1]))
+    return ratio, ratio_unc
+
+#---- all the objects at once ----#
+
+# lines maps the line names to the (flux, err) arrays of the reddening-corrected lines, as in measure_catalog;
+# the temperatures, abundances, branches and status flags follow METALLICITY, object by object, using masks
+# instead of scalars (and nan where METALLICITY gives up)
+def measure_direct_batch(lines, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                         profiler=None):
+
+    O2 = get_engine_atom('O', '2', global_den, engine=emissivity_engine)
+    O3 = get_engine_atom('O', '3', global_den, engine=emissivity_engine)
+
+    OII, OII7320, O4363, O5007, Hb = [tuple(np.asarray(column, dtype=float) for column in lines[line]) for line in ['OII', 'OII7320', 'O4363', 'O5007', 'Hbeta']]
+    size = len(Hb[0])
+
+    output = {}
+    for column in ['metallicity', 'metallicity_err', 'Te_OII', 'Te_OII_err', 'Te_OIII', 'Te_OIII_err']:
+        output[column] = np.full(size, np.nan)
+    output['status'] = np.zeros(size, dtype=int)
+
+    # the marginal posterior of t2 where it comes from the Langeroodi+2024 calibration
+    if posterior:
+        output['t2_pdf'] = np.full((size, len(temperature_axis(grid_resolution))), np.nan)
+
+    if size == 0:
+        return output
+
+    #---- PyNeb at the (N, 3) sigma points ----#
+
+    def tem_den(atom, ratio, wave1, wave2):
+
+        tem  = np.full(ratio.shape, np.nan)
+        rows = np.any(np.isfinite(ratio), axis=1)
+        if np.any(rows):
+            tem[rows] = np.asarray(atom.getTemDen(ratio[rows].reshape(-1), wave1=wave1, wave2=wave2, den=global_den)).reshape(-1, 3)
+        return tem
+
+    def ion_abundance(atom, ratio, tem, wave):
+
+        abundance = np.asarray(atom.getIonAbundance(ratio.reshape(-1), tem=tem.reshape(-1), den=np.full(ratio.size, global_den), wave=wave, Hbeta=1)).reshape(-1, 3)
+        return abundance[:, 1], np.mean(np.abs(np.diff(abundance, axis=1)), axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        status = output['status']
+        status[np.isnan(OII[0]) | np.isnan(O4363[0]) | np.isnan(O5007[0]) | np.isnan(Hb[0])] |= status_flags['missing_line']
+
+        # the divisions by zero that make METALLICITY return nan
+        invalid = (O5007[0] == 0) | (Hb[0] == 0)
+
+        #---- Te(OII) from [OII]7320 ----#
+
+        with profile_stage(profiler, 'Te_OII_O7320'):
+            tem = tem_den(O2, sigma_points(*line_ratio(OII, OII7320)), 3727, 7320)
+
+        Te_OII_O7320     = np.where(OII7320[0] == 0, np.nan, np.minimum(tem[:, 1], 3e+4))
+        Te_OII_O7320_unc = np.abs(np.mean(np.diff(tem, axis=1), axis=1))
+        O7320_clipped    = (tem[:, 1] > 3e+4) | ((Te_OII_O7320 + Te_OII_O7320_unc) > 3e+4)
+        Te_OII_O7320_unc = np.where((Te_OII_O7320 + Te_OII_O7320_unc) > 3e+4, 3e+4-Te_OII_O7320, Te_OII_O7320_unc)
+
+        #---- Te(OIII) ----#
+
+        with profile_stage(profiler, 'Te_OIII'):
+            tem = tem_den(O3, np.clip(sigma_points(*line_ratio(O4363, O5007)), a_min=None, a_max=0.0465), 4363, 5007)
+
+        Te_OIII     = tem[:, 1]
+        Te_OIII_unc = np.mean(np.diff(tem, axis=1), axis=1)
+
+        status[~invalid & ((Te_OIII + Te_OIII_unc) > 3e+4)] |= status_flags['Te_OIII_clipped']
+
+        Te_OIII_unc = np.where((Te_OIII + Te_OIII_unc) > 3e+4, 3e+4-Te_OIII, Te_OIII_unc)
+
+        # a negative uncertainty leaves Te(OIII) undefined for METALLICITY
+        invalid |= Te_OIII_unc < 0
+
+        status[invalid] |= status_flags['invalid_lines']
+
+        #---- Te(OII) (Langeroodi+2024) ----#
+
+        O2_ratio, O2_ratio_unc = line_ratio(OII, Hb)
+        O3_ratio, O3_ratio_unc = line_ratio(O5007, Hb)
+
+        log_O2     = np.log10(O2_ratio)
+        log_O2_unc = O2_ratio_unc/(np.abs(O2_ratio)*np.log(10))
+        log_O3     = np.log10(O3_ratio)
+        log_O3_unc = O3_ratio_unc/(np.abs(O3_ratio)*np.log(10))
+
+        Langeroodi            = np.isnan(Te_OII_O7320) & (t2_calibration == 'L24') & (8500 < Te_OIII) & (Te_OIII < 14000)
+        Te_OII_Langeroodi     = np.full(size, np.nan)
+        Te_OII_Langeroodi_unc = np.full(size, np.nan)
+
+        # METALLICITY measures t2 for every object, and gives up on those whose grid cannot be built;
+        # the kernel itself is only evaluated where t2 is used
+        grid_failed = ~invalid & ~valid_grid_inputs(log_O2, log_O2_unc, log_O3, log_O3_unc, Te_OIII/1e+4, Te_OIII_unc/1e+4, length=grid_length)
+
+        status[grid_failed] |= status_flags['t2_grid_failed']
+        invalid             |= grid_failed
+
+        with profile_stage(profiler, 't2_estimation'):
+
+            for index in np.where(~invalid & Langeroodi)[0]:
+
+                inputs = (log_O2[index], log_O2_unc[index], log_O3[index], log_O3_unc[index], Te_OIII[index]/1e+4, Te_OIII_unc[index]/1e+4)
+
+                t2 = measure_temperature(*inputs, length=grid_length, engine=kernel_engine,
+                                         grid=grid, resolution=grid_resolution, posterior=posterior)
+
+                if posterior:
+                    t2, t2_posterior         = t2
+                    output['t2_pdf'][index] = t2_posterior.pdf
+
+                Te_OII_Langeroodi[index], Te_OII_Langeroodi_unc[index] = 1e+4*t2.n, 1e+4*t2.s
+
+        with profile_stage(profiler, 'abundance'):
+
+            #---- the O++ abundance ----#
+
+            OPP5007_abundance, OPP5007_abundance_unc = ion_abundance(O3, sigma_points(O3_ratio, O3_ratio_unc), sigma_points(Te_OIII, Te_OIII_unc), 5007)
+
+            #---- the metallicity of each branch ----#
+
+            O3727_ratio, O3727_ratio_unc = line_ratio((OII[0]/2, OII[1]/2), Hb)
+
+            solutions = {}
+
+            for branch in ['low_Z', 'intermediate_Z', 'high_Z']:
+
+                Te_OII_Izotov     = izotov_Te_OII(Te_OIII, branch)
+                Te_OII_Izotov_unc = np.abs(izotov_slope(Te_OIII, branch))*Te_OIII_unc
+                Izotov_clipped    = (Te_OII_Izotov > 3e+4) | ((Te_OII_Izotov + Te_OII_Izotov_unc) > 3e+4)
+                Te_OII_Izotov_unc = np.where(Te_OII_Izotov > 3e+4, 0.0, Te_OII_Izotov_unc)
+                Te_OII_Izotov     = np.minimum(Te_OII_Izotov, 3e+4)
+                Te_OII_Izotov_unc = np.where((Te_OII_Izotov + Te_OII_Izotov_unc) > 3e+4, 3e+4-Te_OII_Izotov, Te_OII_Izotov_unc)
+
+                #---- choosing a Te(OII) measurement ----#
+
+                O7320      = ~np.isnan(Te_OII_O7320)
+                Te_OII     = np.where(O7320, Te_OII_O7320, np.where(Langeroodi, Te_OII_Langeroodi, Te_OII_Izotov))
+                Te_OII_unc = np.where(O7320, Te_OII_O7320_unc, np.where(Langeroodi, Te_OII_Langeroodi_unc, Te_OII_Izotov_unc))
+                clipped    = np.where(O7320, O7320_clipped, ~Langeroodi & Izotov_clipped)
+
+                #---- the O+ abundances ----#
+
+                OP3727_abundance, OP3727_abundance_unc = ion_abundance(O2, sigma_points(O3727_ratio, O3727_ratio_unc), sigma_points(Te_OII, Te_OII_unc), 3727)
+                OP3729_abundance, OP3729_abundance_unc = ion_abundance(O2, sigma_points(O3727_ratio, O3727_ratio_unc), sigma_points(Te_OII, Te_OII_unc), 3729)
+
+                O_abundance     = OPP5007_abundance + (OP3727_abundance + OP3729_abundance)/2
+                O_abundance_unc = np.sqrt(np.square(OPP5007_abundance_unc) + np.square(OP3727_abundance_unc/2) + np.square(OP3729_abundance_unc/2))
+
+                Z     = 12 + np.log10(O_abundance)
+                Z_unc = O_abundance_unc/(np.abs(O_abundance)*np.log(10))
+
+                solutions[branch] = Z, Z_unc, Te_OII, Te_OII_unc, clipped
+
+    #---- the first branch consistent with its metallicity ----#
+
+    chosen = np.zeros(size, dtype=bool)
+
+    # the number of (branch, tolerance) checks of each object, as counted by METALLICITY (which checks none
+    # for the invalid objects)
+    attempts = np.zeros(size, dtype=int)
+
+    with profile_stage(profiler, 'branch_selection'):
+        for tolerate in ['no', 'unc', 'max']:
+            for branch in ['low_Z', 'intermediate_Z', 'high_Z']:
+
+                Z, Z_unc, Te_OII, Te_OII_unc, clipped = solutions[branch]
+                select                                = ~chosen & consistent_branch(Z, Z_unc, branch, tolerate=tolerate)
+
+                output['metallicity'][select], output['metallicity_err'][select] = Z[select], Z_unc[select]
+                output['Te_OII'][select], output['Te_OII_err'][select]           = Te_OII[select], Te_OII_unc[select]
+                output['Te_OIII'][select], output['Te_OIII_err'][select]         = Te_OIII[select], Te_OIII_unc[select]
+
+                status[select & ~invalid]           |= tolerance_flags[tolerate]
+                status[select & ~invalid & clipped] |= status_flags['Te_OII_clipped']
+
+                attempts[~invalid & ~chosen] += 1
+                chosen            |= select
+
+    if profiler is not None:
+        profiler.count_branches(attempts)
+
+    #---- nan where METALLICITY gives up ----#
+
+    valid = chosen & ~invalid & (output['Te_OII'] > -np.inf) & (output['Te_OIII'] < np.inf)
+
+    status[~chosen & ~invalid]         |= status_flags['no_branch']
+    status[chosen & ~invalid & ~valid] |= status_flags['invalid_lines']
+
+    for column in ['metallicity', 'metallicity_err', 'Te_OII', 'Te_OII_err', 'Te_OIII', 'Te_OIII_err']:
+        output[column] = np.where(valid, output[column], np.nan)
+
+    if posterior:
+        output['t2_pdf'][~(valid & Langeroodi)] = np.nan
+
+    return output
@@ -0,0 +1,163 @@
+import zlib
+import numpy as np
+from uncertainties import ufloat
+
+from ..posteriors import percentile_16, percentile_84
+from ..temperature.temperature_estimator import conditional_temperature
+from ..kernel.posterior_grid import valid_grid_inputs
+from ..diagnostics import status_flags, tolerance_flags
+from .atomic_data import get_engine_atom
+from .direct_method import izotov_Te_OII, consistent_branch
+
+##########
+# Config #
+##########
+
+# number of flux realizations per object
+default_n_samples = 1000
+
+# the Te(OIII) percentiles the Langeroodi+2024 t2 posterior is conditioned on (each realization takes the nearest)
+conditional_percentiles = [2.5, 16, 50, 84, 97.5]
+
+# the realizations without a metallicity (e.g. negative [OIII]4363 or [OII] draws) are dropped from the percentiles,
+# which cuts off the low-flux tail; the measurement is flagged when fewer than this fraction of them are left
+default_min_valid_fraction = 0.95
+
+###########
+# Samples #
+###########
+
+#---- one generator per object, so that its draws do not depend on the rest of the catalog ----#
+
+def object_rng(seed, object):
+
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(str(object).encode())])
+
+#---- gaussian realizations of the lines: lines maps the line names to (flux, err) ----#
+
+def draw_lines(lines, n_samples, rng):
+
+    return {line: flux + err*rng.standard_normal(n_samples) for line, (flux, err) in lines.items()}
+
+#---- the 16th, 50th and 84th percentiles of the finite samples (nan if there are none) ----#
+
+def sample_percentiles(samples):
+
+    samples = np.asarray(samples, dtype=float)
+    samples = samples[np.isfinite(samples)]
+
+    if len(samples) == 0:
+        return np.full(3, np.nan)
+    return np.percentile(samples, [100*percentile_16, 50, 100*percentile_84])
+
+# the fraction of the realizations that are finite in all the samples (those sample_percentiles keeps)
+def finite_fraction(*samples):
+
+    finite = np.all([np.isfinite(values) for values in samples], axis=0)
+    return np.mean(finite) if finite.size > 0 else np.nan
+
+# the median, with half the 16th-84th percentile range as uncertainty
+def sample_ufloat(samples):
+
+    p16, median, p84 = sample_percentiles(samples)
+    return ufloat(median, (p84-p16)/2)
+
+#############################
+# Direct-method Metallicity #
+#############################
+
+# samples maps the (dereddened) lines to arrays of realizations; returns the samples of the metallicity,
+# Te(OII) and Te(OIII), making the same choices as METALLICITY on the percentiles of the samples, and the
+# status flags of the branch selection (nan samples where it gives up)
+def direct_samples(samples, rng, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3):
+
+    O2 = get_engine_atom('O', '2', global_den, engine=emissivity_engine)
+    O3 = get_engine_atom('O', '3', global_den, engine=emissivity_engine)
+
+    n_samples = len(samples['Hbeta'])
+    den       = np.full(n_samples, float(global_den))
+    missing   = np.full(n_samples, np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        O3727 = samples['OII']/2
+        O3729 = samples['OII']/2
+        O5007 = samples['O5007']
+        Hb    = samples['Hbeta']
+
+        #---- Te(OIII) ----#
+
+        OIII_ratio = np.clip(samples['O4363']/O5007, a_min=None, a_max=0.0465)
+        Te_OIII    = O3.getTemDen(OIII_ratio, wave1=4363, wave2=5007, den=global_den)
+
+        #---- Te(OII) from [OII]7320, or the Langeroodi+2024 calibration, or Izotov+2006 for each branch ----#
+
+        Te_OII = None
+
+        if np.any(np.isfinite(samples['OII7320'])):
+            Te_OII_O7320 = np.minimum(O2.getTemDen(samples['OII']/samples['OII7320'], wave1=3727, wave2=7320, den=global_den), 3e+4)
+            if np.isfinite(sample_percentiles(Te_OII_O7320)[1]):
+                Te_OII = Te_OII_O7320
+
+        if (Te_OII is None) and (t2_calibration == 'L24') and (8500 < sample_percentiles(Te_OIII)[1] < 14000):
+
+            # the t2 posterior of the kernel, given the percentiles of its inputs
+            inputs = []
+            for values in [np.log10(samples['OII']/Hb), np.log10(O5007/Hb), Te_OIII/1e+4]:
+                p16, median, p84 = sample_percentiles(values)
+                inputs += [median, (p84-p16)/2]
+
+            if not valid_grid_inputs(*inputs, length=grid_length):
+                return missing, missing, missing, status_flags['t2_grid_failed']
+
+            # is sampled given the Te(OIII) of each realization (at the nearest of a few of its percentiles, on the
+            # full grid), so that t2 and t3, and with them the O+ and O++ abundances, stay correlated
+            finite   = np.isfinite(Te_OIII)
+            T3_nodes = np.unique(np.percentile(Te_OIII[finite]/1e+4, conditional_percentiles))
+            node     = np.argmin(np.abs(np.where(finite, Te_OIII, 0)[:, None]/1e+4 - T3_nodes[None, :]), axis=1)
+
+            t2, t2_pdf = conditional_temperature(*inputs, T3_nodes, length=grid_length, engine=kernel_engine, resolution=grid_resolution)
+
+            draws  = rng.random(n_samples)
+            Te_OII = np.full(n_samples, np.nan)
+
+            for index in range(len(T3_nodes)):
+                rows         = finite & (node == index)
+                Te_OII[rows] = 1e+4 * np.interp(draws[rows], np.cumsum(t2_pdf[index]), t2)
+
+        #---- the O++ abundance ----#
+
+        OPP5007_abundance = O3.getIonAbundance(O5007/Hb, tem=Te_OIII, den=den, wave=5007, Hbeta=1)
+
+        #---- the metallicity of each branch ----#
+
+        def calculate_direct_metallicity(branch):
+
+            Te_OII_branch = Te_OII
+            if Te_OII_branch is None:
+                Te_OII_branch = np.minimum(izotov_Te_OII(Te_OIII, branch), 3e+4)
+
+            OP3727_abundance = O2.getIonAbundance(O3727/Hb, tem=Te_OII_branch, den=den, wave=3727, Hbeta=1)
+            OP3729_abundance = O2.getIonAbundance(O3729/Hb, tem=Te_OII_branch, den=den, wave=3729, Hbeta=1)
+
+            Z = 12 + np.log10(OPP5007_abundance + (OP3727_abundance+OP3729_abundance)/2)
+            return Z, Te_OII_branch
+
+        #---- the first branch consistent with its metallicity, as in METALLICITY ----#
+
+        solutions = {}
+
+        for tolerate in ['no', 'unc', 'max']:
+            for branch in ['low_Z', 'intermediate_Z', 'high_Z']:
+
+                if branch not in solutions:
+                    solutions[branch] = calculate_direct_metallicity(branch)
+                Z, Te_OII_branch = solutions[branch]
+
+                p16, median, p84 = sample_percentiles(Z)
+                if consistent_branch(median, (p84-p16)/2, branch, tolerate=tolerate):
+                    return Z, Te_OII_branch, Te_OIII, tolerance_flags[tolerate]
+
+    return missing, missing, missing, status_flags['no_branch']
@@ -1,16 +1,21 @@
 import os
 import warnings
 import numpy as np
-import pickle as pkl
-from scipy import stats
 from uncertainties import ufloat
 
+from ..kernel.gaussian_kernel import load_kernel
+from ..kernel.posterior_grid import marginalize_grid, grid_window, valid_grid_inputs
+from ..kernel.tabulated_kernel import get_table, table_version
+from ..kernel.truncated_kernel import TRUNCATED_KERNEL
+from ..posteriors import POSTERIOR, marginal_pdf
+
 warnings.filterwarnings("ignore", message="divide by zero encountered in scalar divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in scalar multiply")
 warnings.filterwarnings("ignore", message="invalid value encountered in scalar divide")
 
 dimensions = 3
-percentile = stats.chi2.cdf(1, df=dimensions)
+# stats.chi2.cdf(1, df=dimensions), hard-coded so that importing the package does not import scipy.stats
+percentile = 0.19874804309879915
 
 ##########
 # Config #
@@ -23,25 +28,69 @@ test          = False
 # Making the Kernel #
 #####################
 
-if load_presaved:
+genesis_metallicity_base_path = os.path.dirname(__file__)
+genesis_metallicity_base_path = os.path.dirname(genesis_metallicity_base_path)
+kernel_metallicity_path       = os.path.join(genesis_metallicity_base_path, 'data', 'kernel_metallicity.npz')
+
+# the kernel is only loaded (memory-mapped, so shared between processes) the first time it is needed
+kernel_metallicity = None
+
+def load_kernel_metallicity():
+
+    global kernel_metallicity
+
+    if kernel_metallicity is None:
+        if not load_presaved:
+            raise ImportError('the presaved metallicity kernel is disabled (load_presaved = False)')
+        kernel_metallicity = load_kernel(kernel_metallicity_path)
+    return kernel_metallicity
+
+#---- tabulated kernel (built on first use and stored next to the kernel) ----#
+
+kernel_metallicity_table_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'kernel_metallicity_table_v%i.npz' %table_version)
+kernel_metallicity_table      = None
+
+#---- truncated kernel (only sums the training points within a few bandwidths of each grid point) ----#
 
-    genesis_metallicity_base_path = os.path.dirname(__file__)
-    genesis_metallicity_base_path = os.path.dirname(genesis_metallicity_base_path)
-    kernel_metallicity_path       = os.path.join(genesis_metallicity_base_path, 'data', 'kernel_metallicity.pkl')
+kernel_metallicity_truncated = None
 
-    with open(kernel_metallicity_path, 'rb') as handle:
-        kernel_metallicity = pkl.load(handle)
+def get_kernel_metallicity(engine='exact'):
+
+    global kernel_metallicity_table, kernel_metallicity_truncated
+
+    if engine == 'exact':
+        return load_kernel_metallicity()
+
+    if engine == 'tabulated':
+        if kernel_metallicity_table is None:
+            kernel_metallicity_table = get_table(kernel_metallicity_table_path, load_kernel_metallicity(), last_axis_range=(6.00, 10.00))
+        return kernel_metallicity_table
+
+    if engine == 'truncated':
+        if kernel_metallicity_truncated is None:
+            kernel_metallicity_truncated = TRUNCATED_KERNEL(load_kernel_metallicity())
+        return kernel_metallicity_truncated
+
+    raise ValueError('unknown kernel engine \'%s\'; choose between \'exact\', \'tabulated\' and \'truncated\'' %engine)
 
 ##########################################
 # Function for Measuring the Metallicity #
 ##########################################
 
-def measure_metallicity(O2, O2_unc,
-                        O3, O3_unc,
-                        Hbeta_EW, Hbeta_EW_unc,
-                        length=3):
+#---- the Z axis of the posterior grid ----#
+
+def metallicity_axis(resolution=0.01):
+
+    return np.arange(6.00, 10.01, resolution)
+
+#---- making the O2, O3, EW(Hb), Z axes and the weights of the grid they span ----#
 
-    #---- making the O2, O3, EW(Hb), Z matrix ----#
+def metallicity_axes(O2, O2_unc,
+                     O3, O3_unc,
+                     Hbeta_EW, Hbeta_EW_unc,
+                     length=3, resolution=0.01):
+
+    #---- making the O2, O3, EW(Hb), Z axes ----#
 
     o2_top = np.linspace(O2, O2+O2_unc, length)
     o2_bot = np.linspace(O2, O2-O2_unc, length)
@@ -58,15 +107,13 @@ def measure_metallicity(O2, O2_unc,
     hb     = np.concatenate((hb_bot, hb_top))
     hb     = np.unique(hb)
 
-    z      = np.arange(6.00, 10.01, 0.01)
-
-    o2o2, o3o3, hbhb, zz = np.meshgrid(o2, o3, hb, z, indexing='ij')
-    grid_array           = np.stack([o2o2, o3o3, hbhb, zz], axis=-1)
-    grid_array           = grid_array.reshape(-1, 4)
-    grid_array           = grid_array.T
+    z      = metallicity_axis(resolution)
 
     #---- making the weights matrix ----#
 
+    # imported here, as scipy.stats takes most of the import time of the package
+    from scipy import stats
+
     o2_wht = stats.norm.pdf(o2, loc=O2, scale=O2_unc)
     o2_wht = o2_wht/o2_wht[length-1]
 
@@ -76,42 +123,138 @@ def measure_metallicity(O2, O2_unc,
     hb_wht = stats.norm.pdf(hb, loc=Hbeta_EW, scale=Hbeta_EW_unc)
     hb_wht = hb_wht/hb_wht[length-1]
 
-    z_wht  = np.ones(len(z))
+    # the weights are flat along Z, so only the (o2, o3, hb) part is stored
+    weight_array = (o2_wht[:, None, None]*o3_wht[None, :, None])*hb_wht[None, None, :]
 
-    o2o2_wht, o3o3_wht, hbhb_wht, zz_wht = np.meshgrid(o2_wht, o3_wht, hb_wht, z_wht, indexing='ij')
-    weight_array = np.stack([o2o2_wht, o3o3_wht, hbhb_wht, zz_wht], axis=-1)
-    weight_array = np.prod(weight_array, axis=-1)
-    weight_array = weight_array.reshape(-1)
+    return (o2, o3, hb, z), weight_array
 
-    #---- calculating the PDF ----#
+#---- marginalizing the PDF onto the metallicity axis ----#
 
-    pdf = kernel_metallicity.evaluate(grid_array)
-    pdf = pdf * weight_array
+def marginalize_metallicity(z, pdf, window=None):
 
-    #---- marginalization ----#
+    output_array       = marginalize_grid(z, pdf, percentile, window=window)
+    output_metallicity = ufloat(output_array[1], np.mean(np.diff(output_array)))
+    return output_metallicity
 
-    metallicity_array  = grid_array[-1,:]
-    sorted_indices     = np.argsort(metallicity_array)
+#---- (o2, o3, hb, z) posterior, without building the 4-D grid of points ----#
 
-    metallicity_array  = metallicity_array[sorted_indices]
-    pdf                = pdf[sorted_indices]
+def metallicity_posterior(kernel, grid_axes, weight_array):
 
-    pdf_normalized     = pdf / np.sum(pdf)
-    pdf_metallicity    = metallicity_array
+    pdf  = kernel.evaluate_grid(*grid_axes)
+    pdf *= weight_array[..., None]
+    return pdf
 
-    #---- maximum likelihood value ----#
+#---- the metallicity on the full grid, or on the part of the Z axis where the posterior has mass ----#
 
-    ml_index           = np.argmax(pdf_normalized)
-    ml_metallicity     = pdf_metallicity[ml_index]
+def grid_metallicity(kernel, grid_axes, weight_array, grid='full', posterior=False):
 
-    #---- 50th percentile value ----#
+    window    = grid_window(kernel, grid_axes, weight_array, load_kernel_metallicity, grid=grid)
+    fine_axes = grid_axes if window is None else tuple(grid_axes[:-1]) + (grid_axes[-1][window],)
+    pdf       = metallicity_posterior(kernel, fine_axes, weight_array)
+    output    = marginalize_metallicity(grid_axes[-1], pdf, window=window)
 
-    cdf                = np.cumsum(pdf_normalized)
-    ml_cdf             = cdf[ml_index]
+    # the marginal posterior on the full Z axis as well
+    if posterior:
+        return output, POSTERIOR(grid_axes[-1], marginal_pdf(grid_axes[-1], pdf, window=window))
+    return output
 
-    lo_index           = np.argmin(np.abs(cdf-(ml_cdf-percentile/2)))
-    up_index           = np.argmin(np.abs(cdf-(ml_cdf+percentile/2)))
+#---- single object ----#
 
-    output_array       = [pdf_metallicity[lo_index], ml_metallicity, pdf_metallicity[up_index]]
-    output_metallicity = ufloat(ml_metallicity, np.mean(np.diff(output_array)))
-    return output_metallicity
+def measure_metallicity(O2, O2_unc,
+                        O3, O3_unc,
+                        Hbeta_EW, Hbeta_EW_unc,
+                        length=3, engine='exact', grid='full', resolution=0.01, posterior=False):
+
+    kernel = get_kernel_metallicity(engine)
+
+    grid_axes, weight_array = metallicity_axes(O2, O2_unc, O3, O3_unc, Hbeta_EW, Hbeta_EW_unc, length=length, resolution=resolution)
+
+    return grid_metallicity(kernel, grid_axes, weight_array, grid=grid, posterior=posterior)
+
+#---- arrays of objects ----#
+
+def measure_metallicity_batch(O2, O2_unc,
+                              O3, O3_unc,
+                              Hbeta_EW, Hbeta_EW_unc,
+                              length=3, engine='exact', grid='full', resolution=0.01, posterior=False):
+
+    kernel = get_kernel_metallicity(engine)
+
+    inputs = np.broadcast_arrays(*[np.asarray(x, dtype=float) for x in [O2, O2_unc, O3, O3_unc, Hbeta_EW, Hbeta_EW_unc]])
+    inputs = np.stack([x.reshape(-1) for x in inputs], axis=-1)
+
+    metallicity     = np.full(len(inputs), np.nan)
+    metallicity_unc = np.full(len(inputs), np.nan)
+
+    # one marginal posterior (on the full Z axis) per object
+    if posterior:
+        metallicity_pdf = np.full((len(inputs), len(metallicity_axis(resolution))), np.nan)
+
+    # the objects whose grid cannot be built (non-finite inputs, zero uncertainties) are left nan
+    for index in np.where(valid_grid_inputs(*inputs.T, length=length))[0]:
+
+        grid_axes, weight_array = metallicity_axes(*inputs[index], length=length, resolution=resolution)
+        output_metallicity      = grid_metallicity(kernel, grid_axes, weight_array, grid=grid, posterior=posterior)
+
+        if posterior:
+            output_metallicity, output_posterior = output_metallicity
+            metallicity_pdf[index]               = output_posterior.pdf
+
+        metallicity[index]     = output_metallicity.n
+        metallicity_unc[index] = output_metallicity.s
+
+    if posterior:
+        return metallicity, metallicity_unc, metallicity_pdf
+    return metallicity, metallicity_unc
+
+#---- arrays of objects, integrated over their Av ----#
+
+# inputs has shape (objects, nodes, 6): the grid inputs of each object with its lines dereddened at each Av node,
+# and weights (objects, nodes) the weight of each node; the posterior grids of the nodes, each normalized and
+# scaled by its weight, are stacked as one more nuisance axis, so the metallicity is marginalized over Av as over
+# the line ratios (and the calibration sample does not refit Av); the objects with no valid node are left nan
+def measure_metallicity_joint(inputs, weights, length=3, engine='exact', grid='full', resolution=0.01, posterior=False):
+
+    kernel = get_kernel_metallicity(engine)
+    z      = metallicity_axis(resolution)
+
+    inputs  = np.asarray(inputs, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    valid   = valid_grid_inputs(*np.moveaxis(inputs, -1, 0), length=length)
+
+    metallicity     = np.full(len(inputs), np.nan)
+    metallicity_unc = np.full(len(inputs), np.nan)
+
+    if posterior:
+        metallicity_pdf = np.full((len(inputs), len(z)), np.nan)
+
+    for index in np.where(np.any(valid, axis=1))[0]:
+
+        #---- the (nuisance points, Z) posterior of each node, on the full Z axis ----#
+
+        pdfs = []
+
+        for node in np.where(valid[index])[0]:
+
+            grid_axes, weight_array = metallicity_axes(*inputs[index, node], length=length, resolution=resolution)
+
+            window    = grid_window(kernel, grid_axes, weight_array, load_kernel_metallicity, grid=grid)
+            fine_axes = grid_axes if window is None else tuple(grid_axes[:-1]) + (grid_axes[-1][window],)
+            pdf       = metallicity_posterior(kernel, fine_axes, weight_array)
+
+            node_pdf = np.zeros((pdf.size//pdf.shape[-1], len(z)))
+            node_pdf[:, slice(None) if window is None else window] = weights[index, node]*pdf.reshape(-1, pdf.shape[-1])/np.sum(pdf)
+            pdfs.append(node_pdf)
+
+        pdf = np.concatenate(pdfs)
+
+        output_array           = marginalize_grid(z, pdf, percentile)
+        metallicity[index]     = output_array[1]
+        metallicity_unc[index] = np.mean(np.diff(output_array))
+
+        if posterior:
+            metallicity_pdf[index] = marginal_pdf(z, pdf)
+
+    if posterior:
+        return metallicity, metallicity_unc, metallicity_pdf
+    return metallicity, metallicity_unc
@@ -0,0 +1,181 @@
+import os
+import time
+import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from .data.lines import lines_dict
+from .genesis_metallicity import measure_catalog, read_line, preload, posterior_axes
+from .metallicity.monte_carlo import default_n_samples
+from .diagnostics import status_flags
+from .profiler import PROFILER
+
+logger = logging.getLogger(__name__)
+
+##################
+# Catalog Chunks #
+##################
+
+#---- reading all the line columns into the [flux_array, err_array] format ----#
+
+def read_catalog(catalog):
+
+    columns = {}
+    for line in lines_dict.keys():
+        column = read_line(catalog, line)
+        if column is not None:
+            columns[line] = column
+    return columns
+
+def select_rows(columns, rows):
+
+    return {line: [column[0][rows], column[1][rows]] for line, column in columns.items()}
+
+#---- the outputs of an object that could not be measured ----#
+
+def failed_output(objects, error, settings=None):
+
+    if settings is None:
+        settings = {}
+
+    size = len(objects)
+
+    output_dict = {}
+    output_dict['object']             = objects
+    output_dict['Av']                 = np.full(size, np.nan)
+    output_dict['metallicity_method'] = np.full(size, '', dtype='<U6')
+    for column in ['metallicity', 'metallicity_err', 't2', 't2_err', 't3', 't3_err']:
+        output_dict[column] = np.full(size, np.nan)
+    output_dict['status']             = np.full(size, status_flags['error'], dtype=int)
+    if settings.get('uncertainty', 'linear') == 'montecarlo':
+        output_dict['valid_fraction'] = np.full(size, np.nan)
+    if settings.get('posterior', False):
+        for name, axis in posterior_axes(settings['grid_resolution']).items():
+            output_dict[name+'_pdf'] = np.full((size, len(axis)), np.nan)
+            for column in ['_p16', '_median', '_p84']:
+                output_dict[name+column] = np.full(size, np.nan)
+    output_dict['error']              = np.full(size, '%s: %s' %(type(error).__name__, error), dtype=object)
+    return output_dict
+
+#---- measuring one chunk; if anything fails, the objects are measured one by one ----#
+
+# returns the outputs, and the PROFILER of the chunk if profile=True (else None)
+def measure_chunk(chunk, objects, settings, profile=False):
+
+    profiler = PROFILER() if profile else None
+
+    try:
+        output_dict          = measure_catalog(chunk, objects=objects, profiler=profiler, **settings)
+        output_dict['error'] = np.full(len(objects), '', dtype=object)
+        return output_dict, profiler
+
+    # missing required lines are a problem of the whole catalog, not of the objects
+    except ImportError:
+        raise
+
+    except Exception:
+        pass
+
+    # the profile of the failed attempt is discarded
+    profiler = PROFILER() if profile else None
+    outputs  = []
+
+    for i in range(len(objects)):
+        try:
+            output_dict          = measure_catalog(select_rows(chunk, [i]), objects=objects[[i]], profiler=profiler, **settings)
+            output_dict['error'] = np.full(1, '', dtype=object)
+        except Exception as error:
+            logger.warning('object %s could not be measured: %s: %s', objects[i], type(error).__name__, error)
+            output_dict = failed_output(objects[[i]], error, settings)
+        outputs.append(output_dict)
+
+    return {column: np.concatenate([output_dict[column] for output_dict in outputs]) for column in outputs[0].keys()}, profiler
+
+########################
+# Parallel Measurement #
+########################
+
+# same inputs and outputs as measure_catalog, plus an 'error' column ('' for the objects that were measured);
+# the profiles of the workers are merged into profiler
+def run_parallel(catalog, objects=None, n_workers=None, chunk_size=64,
+                 correct_extinction=True, t2_calibration='L24', global_den=100,
+                 kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                 uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', print_progress=True, profiler=None, cache=None):
+
+    start = time.time()
+
+    #---- splitting the catalog into chunks ----#
+
+    columns = read_catalog(catalog)
+
+    if len(columns) == 0:
+        raise ImportError('none of the emission lines were found in the catalog')
+
+    size = len(next(iter(columns.values()))[0])
+
+    if objects is None:
+        objects = np.arange(size)
+    objects = np.asarray(objects)
+
+    if len(objects) != size:
+        raise ValueError('objects must have the same length as the catalog')
+
+    # an empty catalog is one empty chunk, so that the outputs have the columns of measure_catalog
+    edges  = list(range(0, max(size, 1), chunk_size)) + [size]
+    chunks = [select_rows(columns, slice(lo, hi)) for lo, hi in zip(edges[:-1], edges[1:])]
+    names  = [objects[lo:hi] for lo, hi in zip(edges[:-1], edges[1:])]
+
+    settings = {}
+    settings['correct_extinction'] = correct_extinction
+    settings['t2_calibration']     = t2_calibration
+    settings['global_den']         = global_den
+    settings['kernel_engine']      = kernel_engine
+    settings['emissivity_engine']  = emissivity_engine
+    settings['grid']               = grid
+    settings['grid_resolution']    = grid_resolution
+    settings['grid_length']        = grid_length
+    settings['posterior']          = posterior
+    settings['uncertainty']        = uncertainty
+    settings['n_samples']          = n_samples
+    settings['seed']               = seed
+    settings['extinction']         = extinction
+    settings['cache']              = cache
+
+    #---- measuring the chunks (in the input order) ----#
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    # done here first so that the workers do not build (and save) the same tabulated kernels at once
+    preload(kernel_engine, emissivity_engine, global_den)
+
+    profile = profiler is not None
+
+    if n_workers <= 1:
+        results = [measure_chunk(chunk, chunk_objects, settings, profile) for chunk, chunk_objects in zip(chunks, names)]
+
+    else:
+        # the kernels and the PyNeb atoms are loaded once per worker
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=preload,
+                                 initargs=(kernel_engine, emissivity_engine, global_den)) as executor:
+            results = list(executor.map(measure_chunk, chunks, names, [settings]*len(chunks), [profile]*len(chunks)))
+
+    outputs     = [chunk_output for chunk_output, chunk_profiler in results]
+    output_dict = {column: np.concatenate([chunk_output[column] for chunk_output in outputs]) for column in outputs[0].keys()}
+
+    if profile:
+        for chunk_output, chunk_profiler in results:
+            profiler.merge(chunk_profiler)
+
+    #---- throughput ----#
+
+    # logged at the info level (print_progress=False only keeps the warning about the failed objects)
+    elapsed = time.time() - start
+    failed  = np.sum(output_dict['error'] != '')
+
+    if print_progress:
+        logger.info('measured %i objects with %i workers in %.1f s (%.1f objects/s)', size, n_workers, elapsed, size/elapsed)
+    if failed > 0:
+        logger.warning('%i objects failed; see the \'error\' column', failed)
+
+    return output_dict
@@ -0,0 +1,192 @@
+import numpy as np
+from math import erf, sqrt
+
+##########
+# Config #
+##########
+
+# bump whenever the layout of the posterior files changes
+posterior_format_version = 1
+
+# the gaussian 1-sigma percentiles, reported as the 16th and 84th
+percentile_16 = 0.5*(1+erf(-1/sqrt(2)))
+percentile_84 = 0.5*(1+erf(+1/sqrt(2)))
+
+# number of levels of the quantized pdfs (as fractions of the peak of each pdf)
+quantization_levels = {'uint16': 2**16-1, 'uint8': 2**8-1}
+
+######################
+# Marginal Posterior #
+######################
+
+# the (nuisance axes..., last axis) posterior summed onto the full last axis (zero outside the window of a
+# refined grid) and normalized to unit sum, i.e. the probability of each grid point; nan if it has no mass
+def marginal_pdf(last_axis, pdf, window=None):
+
+    marginal = np.zeros(len(last_axis))
+    marginal[slice(None) if window is None else window] = np.sum(pdf.reshape(-1, pdf.shape[-1]), axis=0)
+
+    total = np.sum(marginal)
+    if not (total > 0):
+        return np.full(len(last_axis), np.nan)
+    return marginal/total
+
+# the axis values where the cdf of each (..., n) pdf reaches the percentiles, interpolated between the grid points
+def posterior_percentiles(axis, pdf, percentiles=(percentile_16, 0.5, percentile_84)):
+
+    axis = np.asarray(axis, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf  = np.cumsum(pdf, axis=-1)
+        cdf /= cdf[..., -1:]
+
+    valid  = np.all(np.isfinite(cdf), axis=-1)
+    output = np.full(cdf.shape[:-1] + (len(percentiles),), np.nan)
+
+    for i, percentile in enumerate(percentiles):
+
+        upper  = np.argmax(cdf >= percentile, axis=-1)
+        lower  = np.maximum(upper-1, 0)
+        cdf_up = np.take_along_axis(cdf, upper[..., None], axis=-1)[..., 0]
+        cdf_lo = np.take_along_axis(cdf, lower[..., None], axis=-1)[..., 0]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fraction = np.where(cdf_up > cdf_lo, (percentile-cdf_lo)/(cdf_up-cdf_lo), 0.0)
+
+        output[..., i] = np.where(valid, axis[lower] + fraction*(axis[upper]-axis[lower]), np.nan)
+
+    return output
+
+###################
+# Posterior Class #
+###################
+
+# the marginal posterior of one object on its grid axis, with its percentile summaries
+class POSTERIOR:
+
+    def __init__(self, axis, pdf):
+
+        self.axis = np.asarray(axis, dtype=float)
+        self.pdf  = np.asarray(pdf, dtype=float)
+
+        self.p16, self.median, self.p84 = posterior_percentiles(self.axis, self.pdf)
+
+        # asymmetric errors around the median
+        self.lower_err = self.median - self.p16
+        self.upper_err = self.p84 - self.median
+
+    # the same posterior on a rescaled axis (e.g. t2 from 1e4 K to K)
+    def rescale(self, factor):
+
+        return POSTERIOR(factor*self.axis, self.pdf)
+
+    # random draws, by inverting the cdf interpolated between the grid points
+    def sample(self, n_samples, rng):
+
+        return np.interp(rng.random(n_samples), np.cumsum(self.pdf), self.axis)
+
+####################
+# Saving & Loading #
+####################
+
+#---- quantizing the (n_objects, n_axis) pdfs ----#
+
+def quantize(pdf, quantization='uint16'):
+
+    pdf = np.asarray(pdf, dtype=float)
+
+    if quantization == 'float16':
+        return pdf.astype(np.float16), None
+
+    if quantization in quantization_levels:
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            peak   = np.max(pdf, axis=-1)
+            values = np.rint(pdf/peak[:, None]*quantization_levels[quantization])
+
+        # clipped, as the (tiny) negative values of interpolated kernels would wrap around
+        values = np.clip(np.where(np.isfinite(values), values, 0), 0, quantization_levels[quantization])
+        return values.astype(quantization), peak.astype(np.float32)
+
+    raise ValueError('unknown quantization \'%s\'; choose between \'uint16\', \'uint8\' and \'float16\'' %quantization)
+
+def dequantize(values, peak, quantization='uint16'):
+
+    if quantization == 'float16':
+        pdf = np.asarray(values, dtype=float)
+    else:
+        pdf = np.asarray(values, dtype=float) * (np.asarray(peak, dtype=float)/quantization_levels[quantization])[:, None]
+
+    # back to unit sum (quantization does not keep it)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return pdf/np.sum(pdf, axis=-1, keepdims=True)
+
+#---- HDF5 files: the object column, and per quantity (e.g. 'metallicity') its axis, stored once, and its pdfs ----#
+
+# output_dict holds the '<name>_pdf' columns of measure_catalog(..., posterior=True),
+# axes the grid axis of each of them (see posterior_axes)
+def save_posteriors(path, output_dict, axes, quantization='uint16', compression='gzip'):
+
+    import h5py
+
+    objects = np.asarray(output_dict['object'])
+
+    with h5py.File(path, 'w') as handle:
+
+        handle.attrs['version']      = posterior_format_version
+        handle.attrs['quantization'] = quantization
+
+        if objects.dtype.kind in 'UO':
+            handle.create_dataset('object', data=objects.astype(str).astype(object), dtype=h5py.string_dtype())
+        else:
+            handle.create_dataset('object', data=objects)
+
+        for name, axis in axes.items():
+
+            pdf = np.asarray(output_dict[name+'_pdf'])
+
+            if pdf.shape != (len(objects), len(axis)):
+                raise ValueError('the \'%s_pdf\' column has shape %s, but (%i, %i) is expected from the objects and the axis' %(name, pdf.shape, len(objects), len(axis)))
+
+            values, peak = quantize(pdf, quantization)
+
+            group = handle.create_group(name)
+            group.create_dataset('axis', data=np.asarray(axis, dtype=float))
+            group.create_dataset('pdf', data=values, chunks=(max(1, min(len(objects), 1024)), max(1, len(axis))),
+                                 compression=compression, shuffle=compression is not None)
+            if peak is not None:
+                group.create_dataset('peak', data=peak)
+
+# returns the object column and, per quantity, the '<name>_axis' and '<name>_pdf' arrays
+def load_posteriors(path):
+
+    import h5py
+
+    output_dict = {}
+
+    with h5py.File(path, 'r') as handle:
+
+        if int(handle.attrs['version']) != posterior_format_version:
+            raise ValueError('%s was saved with posterior format version %i, but version %i is expected' %(path, int(handle.attrs['version']), posterior_format_version))
+
+        quantization = handle.attrs['quantization']
+        if isinstance(quantization, bytes):
+            quantization = quantization.decode()
+
+        if h5py.check_string_dtype(handle['object'].dtype) is not None:
+            output_dict['object'] = np.asarray(handle['object'].asstr()[()], dtype=str)
+        else:
+            output_dict['object'] = handle['object'][()]
+
+        for name in handle.keys():
+
+            if name == 'object':
+                continue
+
+            group = handle[name]
+            peak  = group['peak'][()] if 'peak' in group else None
+
+            output_dict[name+'_axis'] = group['axis'][()]
+            output_dict[name+'_pdf']  = dequantize(group['pdf'][()], peak, quantization)
+
+    return output_dict
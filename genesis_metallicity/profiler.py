@@ -0,0 +1,125 @@
+import time
+import numpy as np
+from contextlib import contextmanager, nullcontext
+
+##########
+# Config #
+##########
+
+# the pipeline stages, in the order they run; the stages with a parent are timed inside it
+profiler_stages = ['input_validation', 'dust_fit', 'dereddening',
+                   'direct_method', 'Te_OII_O7320', 'Te_OIII', 't2_estimation', 'abundance', 'branch_selection',
+                   'strong_line_kde', 'monte_carlo', 'cache']
+
+stage_parents = {}
+for stage in ['Te_OII_O7320', 'Te_OIII', 't2_estimation', 'abundance', 'branch_selection']:
+    stage_parents[stage] = 'direct_method'
+
+# the most branch attempts an object can take (3 branches x 3 tolerance levels)
+max_branch_attempts = 9
+
+##################
+# Profiler Class #
+##################
+
+# wall times and call counts per stage, the number of objects, and the number of branch attempts
+# of each direct-method object; pass one to genesis_metallicity, measure_catalog or run_parallel
+class PROFILER:
+
+    def __init__(self):
+
+        self.times           = {}
+        self.calls           = {}
+        self.objects         = 0
+        self.branch_attempts = []
+
+    #---- recording ----#
+
+    @contextmanager
+    def stage(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter()-start)
+
+    def add(self, name, elapsed, calls=1):
+
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    def count_objects(self, n_objects=1):
+
+        self.objects += int(n_objects)
+
+    # attempts is the number of (branch, tolerance) checks of one object, or an array of them
+    def count_branches(self, attempts):
+
+        self.branch_attempts += [int(n) for n in np.atleast_1d(attempts)]
+
+    # adding up the profiles of several runs (e.g. of the run_parallel workers)
+    def merge(self, other):
+
+        for name in other.times.keys():
+            self.add(name, other.times[name], other.calls[name])
+        self.objects         += other.objects
+        self.branch_attempts += other.branch_attempts
+
+    #---- reporting ----#
+
+    def summary(self):
+
+        names = [name for name in profiler_stages if name in self.times] + sorted(name for name in self.times if name not in profiler_stages)
+
+        stages = {}
+        for name in names:
+            stages[name] = {}
+            stages[name]['time']            = self.times[name]
+            stages[name]['calls']           = self.calls[name]
+            stages[name]['time_per_object'] = self.times[name]/self.objects if self.objects > 0 else np.nan
+            stages[name]['parent']          = stage_parents.get(name)
+
+        attempts = np.asarray(self.branch_attempts, dtype=int)
+
+        branches = {}
+        branches['objects']   = len(attempts)
+        branches['mean']      = np.mean(attempts) if len(attempts) > 0 else np.nan
+        branches['histogram'] = np.bincount(attempts, minlength=max_branch_attempts+1)
+
+        summary = {}
+        summary['objects']         = self.objects
+        summary['stages']          = stages
+        summary['branch_attempts'] = branches
+        return summary
+
+    def print_summary(self):
+
+        summary = self.summary()
+
+        print('--------------------------------------------------')
+        print(' -> profile of %i objects' %summary['objects'])
+        print('--------------------------------------------------')
+        print('%-20s %10s %10s %14s' %('stage', 'time [s]', 'calls', 'ms/object'))
+
+        for name, stage in summary['stages'].items():
+            label = name if stage['parent'] is None else '  '+name
+            print('%-20s %10.3f %10i %14.3f' %(label, stage['time'], stage['calls'], 1e+3*stage['time_per_object']))
+
+        branches = summary['branch_attempts']
+        if branches['objects'] > 0:
+            print('--------------------------------------------------')
+            print(' -> branch attempts of %i direct-method objects (mean %.2f)' %(branches['objects'], branches['mean']))
+            for attempts, count in enumerate(branches['histogram']):
+                if count > 0:
+                    print('%3i attempts: %i objects' %(attempts, count))
+
+#---- a stage timer that does nothing without a profiler ----#
+
+no_profiling = nullcontext()
+
+def profile_stage(profiler, name):
+
+    if profiler is None:
+        return no_profiling
+    return profiler.stage(name)
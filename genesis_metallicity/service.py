@@ -0,0 +1,400 @@
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import Future
+from urllib.request import Request, urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .data.lines import lines_dict
+from .diagnostics import status_names
+from .genesis_metallicity import preload
+from .metallicity.monte_carlo import default_n_samples
+from .parallel import measure_chunk
+
+logger = logging.getLogger(__name__)
+
+##########
+# Config #
+##########
+
+default_host = '127.0.0.1'
+default_port = 8080
+
+# how long the first request of a batch waits for others to join it (s), and the most objects in a batch
+default_batch_window   = 0.005
+default_max_batch_size = 1024
+
+# the latencies of the last latency_window requests are kept for the percentiles of the metrics
+latency_window = 10000
+
+# how long a request waits for its measurement (s)
+request_timeout = 600
+
+# the connections waiting to be accepted (the many concurrent clients the batching is for)
+listen_backlog = 128
+
+########################
+# Payloads and Outputs #
+########################
+
+#---- the input_dicts of a request: one input_dict, a list of them, or {'objects': [...]} ----#
+
+def read_payload(payload):
+
+    if isinstance(payload, dict) and ('objects' in payload.keys()):
+        payload = payload['objects']
+    if isinstance(payload, dict):
+        payload = [payload]
+
+    if (not isinstance(payload, list)) or (len(payload) == 0) or any(not isinstance(input_dict, dict) for input_dict in payload):
+        raise ValueError('the payload must be an input_dict, a list of input_dicts, or {"objects": [input_dicts]}')
+
+    # as the genesis_metallicity class, only the lines of data/lines.py are read ('object' names the output)
+    input_dicts = []
+    for input_dict in payload:
+        lines = {}
+        for line in lines_dict.keys():
+            if line in input_dict.keys():
+                value = input_dict[line]
+                if (not isinstance(value, (list, tuple))) or (len(value) != 2):
+                    raise ValueError('\'%s\' must be given as [flux, err]' %line)
+                lines[line] = (float(value[0] if value[0] is not None else np.nan), float(value[1] if value[1] is not None else np.nan))
+        input_dicts.append({'object': input_dict.get('object', 'default'), 'lines': lines})
+
+    return input_dicts
+
+#---- one output row as json (nan becomes null) ----#
+
+def json_value(value):
+
+    value = np.asarray(value)
+    if value.dtype.kind == 'f':
+        return [None if np.isnan(x) else float(x) for x in value] if value.ndim > 0 else (None if np.isnan(value) else float(value))
+    return value.tolist()
+
+def output_row(output_dict, index, object):
+
+    row = {column: json_value(values[index]) for column, values in output_dict.items()}
+    row['object']       = object
+    row['status_names'] = status_names(row['status'])
+    return row
+
+#################
+# Service Class #
+#################
+
+# a local HTTP/JSON server that keeps the kernels and the PyNeb atoms loaded; the objects of the requests that
+# arrive within batch_window of each other are measured together by measure_catalog (grouped by the lines they
+# provide), with the settings given here; POST /measure takes the input_dicts, GET /metrics returns the
+# latency and throughput, GET /health returns {"status": "ok"}
+class ESTIMATOR_SERVICE:
+
+    def __init__(self, host=default_host, port=default_port, batch_window=default_batch_window, max_batch_size=default_max_batch_size,
+                 correct_extinction=True, t2_calibration='L24', global_den=100, kernel_engine='exact', emissivity_engine='exact', grid='full', grid_resolution=0.01, grid_length=3, posterior=False,
+                 uncertainty='linear', n_samples=default_n_samples, seed=None, extinction='fixed', cache=None):
+
+        self.settings = {}
+        self.settings['correct_extinction'] = correct_extinction
+        self.settings['t2_calibration']     = t2_calibration
+        self.settings['global_den']         = global_den
+        self.settings['kernel_engine']      = kernel_engine
+        self.settings['emissivity_engine']  = emissivity_engine
+        self.settings['grid']               = grid
+        self.settings['grid_resolution']    = grid_resolution
+        self.settings['grid_length']        = grid_length
+        self.settings['posterior']          = posterior
+        self.settings['uncertainty']        = uncertainty
+        self.settings['n_samples']          = n_samples
+        self.settings['seed']               = seed
+        self.settings['extinction']         = extinction
+        self.settings['cache']              = cache
+
+        self.batch_window   = batch_window
+        self.max_batch_size = max_batch_size
+
+        self.requests = queue.Queue()
+        self.batcher  = None
+        self.thread   = None
+
+        self.server         = HTTP_SERVER((host, port), REQUEST_HANDLER)
+        self.server.service = self
+        self.address        = self.server.server_address
+
+        #---- metrics ----#
+
+        self.lock         = threading.Lock()
+        self.started      = time.time()
+        self.n_requests   = 0
+        self.n_objects    = 0
+        self.n_failed     = 0
+        self.n_batches    = 0
+        self.measure_time = 0.0
+        self.latencies    = deque(maxlen=latency_window)
+
+    #---- running ----#
+
+    def start_batcher(self):
+
+        preload(self.settings['kernel_engine'], self.settings['emissivity_engine'], self.settings['global_den'])
+
+        self.batcher = threading.Thread(target=self.batch_loop, daemon=True)
+        self.batcher.start()
+
+        logger.info('serving on http://%s:%i', *self.address)
+
+    # blocks until interrupted
+    def serve_forever(self):
+
+        self.start_batcher()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stop()
+
+    # serves from a background thread (e.g. for tests)
+    def start(self):
+
+        self.start_batcher()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+
+        if self.batcher is not None:
+            self.requests.put(None)
+            self.batcher.join()
+            self.batcher = None
+
+    def __enter__(self):
+
+        return self.start()
+
+    def __exit__(self, *exc):
+
+        self.stop()
+
+    #---- measuring ----#
+
+    # returns the output rows of the input_dicts (read_payload), in their order
+    def measure(self, input_dicts):
+
+        start  = time.perf_counter()
+        future = Future()
+        self.requests.put((input_dicts, future))
+        rows   = future.result(timeout=request_timeout)
+
+        with self.lock:
+            self.n_requests += 1
+            self.latencies.append(time.perf_counter()-start)
+
+        return rows
+
+    def batch_loop(self):
+
+        while True:
+
+            request = self.requests.get()
+            if request is None:
+                return
+
+            #---- the requests that arrive within batch_window join the batch ----#
+
+            batch    = [request]
+            size     = len(request[0])
+            deadline = time.perf_counter() + self.batch_window
+            stop     = False
+
+            while size < self.max_batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline-time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    stop = True
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            self.measure_batch(batch)
+
+            if stop:
+                return
+
+    def measure_batch(self, batch):
+
+        start = time.perf_counter()
+
+        try:
+            rows = [[None]*len(input_dicts) for input_dicts, future in batch]
+
+            # the objects with the same lines are measured together, so that each group is the catalog of
+            # its objects (a line missing from one object does not become a nan line of the others)
+            groups = {}
+            for i, (input_dicts, future) in enumerate(batch):
+                for j, input_dict in enumerate(input_dicts):
+                    groups.setdefault(tuple(sorted(input_dict['lines'].keys())), []).append((i, j))
+
+            failed = 0
+
+            for lines, members in groups.items():
+
+                group   = [batch[i][0][j] for i, j in members]
+                catalog = {line: [np.array([input_dict['lines'][line][k] for input_dict in group]) for k in range(2)] for line in lines}
+                objects = np.array([str(input_dict['object']) for input_dict in group])
+
+                # missing lines fail the whole group (the other errors only their objects)
+                try:
+                    output_dict, _ = measure_chunk(catalog, objects, self.settings)
+                except ImportError as error:
+                    output_dict = {'error': np.full(len(group), '%s: %s' %(type(error).__name__, error), dtype=object)}
+
+                for index, ((i, j), input_dict) in enumerate(zip(members, group)):
+                    if 'object' in output_dict.keys():
+                        rows[i][j] = output_row(output_dict, index, input_dict['object'])
+                    else:
+                        rows[i][j] = {'object': input_dict['object'], 'error': output_dict['error'][index]}
+
+                failed += int(np.sum(output_dict['error'] != ''))
+
+            for (input_dicts, future), request_rows in zip(batch, rows):
+                future.set_result(request_rows)
+
+        except Exception as error:
+            logger.exception('a batch of %i requests failed', len(batch))
+            for input_dicts, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            failed = sum(len(input_dicts) for input_dicts, future in batch)
+
+        with self.lock:
+            self.n_batches    += 1
+            self.n_objects    += sum(len(input_dicts) for input_dicts, future in batch)
+            self.n_failed     += failed
+            self.measure_time += time.perf_counter()-start
+
+    #---- metrics ----#
+
+    def metrics(self):
+
+        with self.lock:
+
+            uptime    = time.time() - self.started
+            latencies = np.array(self.latencies)
+
+            metrics = {}
+            metrics['uptime']           = uptime
+            metrics['requests']         = self.n_requests
+            metrics['objects']          = self.n_objects
+            metrics['failed_objects']   = self.n_failed
+            metrics['batches']          = self.n_batches
+            metrics['mean_batch_size']  = self.n_objects/self.n_batches if self.n_batches > 0 else None
+            metrics['queued_requests']  = self.requests.qsize()
+            metrics['requests_per_s']   = self.n_requests/uptime
+            metrics['objects_per_s']    = self.n_objects/uptime
+
+            # while measuring, i.e. the throughput the service could sustain
+            metrics['busy_objects_per_s'] = self.n_objects/self.measure_time if self.measure_time > 0 else None
+
+            for name, q in [('p50', 50), ('p95', 95), ('p99', 99)]:
+                metrics['latency_'+name] = float(np.percentile(latencies, q)) if len(latencies) > 0 else None
+            metrics['latency_mean'] = float(np.mean(latencies)) if len(latencies) > 0 else None
+
+        metrics['settings'] = {name: value for name, value in self.settings.items() if name != 'cache'}
+        return metrics
+
+###############
+# HTTP Server #
+###############
+
+class HTTP_SERVER(ThreadingHTTPServer):
+
+    daemon_threads     = True
+    request_queue_size = listen_backlog
+
+###################
+# Request Handler #
+###################
+
+class REQUEST_HANDLER(BaseHTTPRequestHandler):
+
+    def send_json(self, code, content):
+
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+
+        if self.path == '/metrics':
+            self.send_json(200, self.server.service.metrics())
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'unknown path \'%s\'; choose between \'/measure\', \'/metrics\' and \'/health\'' %self.path})
+
+    def do_POST(self):
+
+        if self.path != '/measure':
+            self.send_json(404, {'error': 'unknown path \'%s\'; choose between \'/measure\', \'/metrics\' and \'/health\'' %self.path})
+            return
+
+        try:
+            length      = int(self.headers.get('Content-Length', 0))
+            input_dicts = read_payload(json.loads(self.rfile.read(length)))
+        except (ValueError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+
+        try:
+            rows = self.server.service.measure(input_dicts)
+        except Exception as error:
+            self.send_json(500, {'error': '%s: %s' %(type(error).__name__, error)})
+            return
+
+        self.send_json(200, {'results': rows})
+
+    # the requests are logged at the debug level instead of printed
+    def log_message(self, format, *args):
+
+        logger.debug('%s - %s', self.address_string(), format %args)
+
+##########
+# Client #
+##########
+
+#---- measuring input_dicts on a running service ----#
+
+def measure_remote(input_dicts, url='http://%s:%i' %(default_host, default_port), timeout=request_timeout):
+
+    request = Request(url.rstrip('/')+'/measure', data=json.dumps(input_dicts).encode(), headers={'Content-Type': 'application/json'})
+    with urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())['results']
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 4:
+        sys.exit('usage: python -m genesis_metallicity.service [<port>] [<kernel engine>] [<emissivity engine>] (engines: \'exact\' by default, or \'tabulated\')')
+
+    port              = int(sys.argv[1]) if len(sys.argv) > 1 else default_port
+    kernel_engine     = sys.argv[2] if len(sys.argv) > 2 else 'exact'
+    emissivity_engine = sys.argv[3] if len(sys.argv) > 3 else 'exact'
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    logger.info('kernel engine: %s, emissivity engine: %s', kernel_engine, emissivity_engine)
+
+    ESTIMATOR_SERVICE(port=port, kernel_engine=kernel_engine, emissivity_engine=emissivity_engine).serve_forever()
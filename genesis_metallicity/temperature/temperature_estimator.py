@@ -1,16 +1,21 @@
 import os
 import warnings
 import numpy as np
-import pickle as pkl
-from scipy import stats
 from uncertainties import ufloat
 
+from ..kernel.gaussian_kernel import load_kernel
+from ..kernel.posterior_grid import marginalize_grid, grid_window
+from ..kernel.tabulated_kernel import get_table, table_version
+from ..kernel.truncated_kernel import TRUNCATED_KERNEL
+from ..posteriors import POSTERIOR, marginal_pdf
+
 warnings.filterwarnings("ignore", message="divide by zero encountered in scalar divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in scalar multiply")
 warnings.filterwarnings("ignore", message="invalid value encountered in scalar divide")
 
 dimensions = 3
-percentile = stats.chi2.cdf(1, df=dimensions)
+# stats.chi2.cdf(1, df=dimensions), hard-coded so that importing the package does not import scipy.stats
+percentile = 0.19874804309879915
 
 ##########
 # Config #
@@ -23,25 +28,69 @@ test          = False
 # Making the Kernel #
 #####################
 
-if load_presaved:
+genesis_metallicity_base_path = os.path.dirname(__file__)
+genesis_metallicity_base_path = os.path.dirname(genesis_metallicity_base_path)
+kernel_temperature_path       = os.path.join(genesis_metallicity_base_path, 'data', 'kernel_temperature.npz')
+
+# the kernel is only loaded (memory-mapped, so shared between processes) the first time it is needed
+kernel_temperature = None
+
+def load_kernel_temperature():
+
+    global kernel_temperature
+
+    if kernel_temperature is None:
+        if not load_presaved:
+            raise ImportError('the presaved temperature kernel is disabled (load_presaved = False)')
+        kernel_temperature = load_kernel(kernel_temperature_path)
+    return kernel_temperature
+
+#---- tabulated kernel (built on first use and stored next to the kernel) ----#
+
+kernel_temperature_table_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'kernel_temperature_table_v%i.npz' %table_version)
+kernel_temperature_table      = None
+
+#---- truncated kernel (only sums the training points within a few bandwidths of each grid point) ----#
+
+kernel_temperature_truncated = None
+
+def get_kernel_temperature(engine='exact'):
 
-    genesis_metallicity_base_path = os.path.dirname(__file__)
-    genesis_metallicity_base_path = os.path.dirname(genesis_metallicity_base_path)
-    kernel_temperature_path       = os.path.join(genesis_metallicity_base_path, 'data', 'kernel_temperature.pkl')
+    global kernel_temperature_table, kernel_temperature_truncated
 
-    with open(kernel_temperature_path, 'rb') as handle:
-        kernel_temperature = pkl.load(handle)
+    if engine == 'exact':
+        return load_kernel_temperature()
+
+    if engine == 'tabulated':
+        if kernel_temperature_table is None:
+            kernel_temperature_table = get_table(kernel_temperature_table_path, load_kernel_temperature(), last_axis_range=(0.6, 2.3))
+        return kernel_temperature_table
+
+    if engine == 'truncated':
+        if kernel_temperature_truncated is None:
+            kernel_temperature_truncated = TRUNCATED_KERNEL(load_kernel_temperature())
+        return kernel_temperature_truncated
+
+    raise ValueError('unknown kernel engine \'%s\'; choose between \'exact\', \'tabulated\' and \'truncated\'' %engine)
 
 ##################################
 # Function for Estimating the T2 #
 ##################################
 
-def measure_temperature(O2, O2_unc,
-                        O3, O3_unc,
-                        T3, T3_unc,
-                        length=3):
+#---- the t2 axis of the posterior grid ----#
+
+def temperature_axis(resolution=0.01):
+
+    return np.arange(0.6, 2.3, resolution)
+
+#---- making the O2, O3, t3, t2 axes and the weights of the grid they span ----#
 
-    #---- making the O2, O3, t3, t2 matrix ----#
+def temperature_axes(O2, O2_unc,
+                     O3, O3_unc,
+                     T3, T3_unc,
+                     length=3, resolution=0.01):
+
+    #---- making the O2, O3, t3, t2 axes ----#
 
     o2_top = np.linspace(O2, O2+O2_unc, length)
     o2_bot = np.linspace(O2, O2-O2_unc, length)
@@ -58,15 +107,13 @@ def measure_temperature(O2, O2_unc,
     t3     = np.concatenate((t3_bot, t3_top))
     t3     = np.unique(t3)
 
-    t2     = np.arange(0.6, 2.3, 0.01)
-
-    o2o2, o3o3, t3t3, t2t2 = np.meshgrid(o2, o3, t3, t2, indexing='ij')
-    grid_array             = np.stack([o2o2, o3o3, t3t3, t2t2], axis=-1)
-    grid_array             = grid_array.reshape(-1, 4)
-    grid_array             = grid_array.T
+    t2     = temperature_axis(resolution)
 
     #---- making the weights matrix ----#
 
+    # imported here, as scipy.stats takes most of the import time of the package
+    from scipy import stats
+
     o2_wht = stats.norm.pdf(o2, loc=O2, scale=O2_unc)
     o2_wht = o2_wht/o2_wht[length-1]
 
@@ -76,42 +123,70 @@ def measure_temperature(O2, O2_unc,
     t3_wht = stats.norm.pdf(t3, loc=T3, scale=T3_unc)
     t3_wht = t3_wht/t3_wht[length-1]
 
-    t2_wht = np.ones(len(t2))
+    # the weights are flat along t2, so only the (o2, o3, t3) part is stored
+    weight_array = (o2_wht[:, None, None]*o3_wht[None, :, None])*t3_wht[None, None, :]
 
-    o2o2_wht, o3o3_wht, t3t3_wht, t2t2_wht = np.meshgrid(o2_wht, o3_wht, t3_wht, t2_wht, indexing='ij')
-    weight_array = np.stack([o2o2_wht, o3o3_wht, t3t3_wht, t2t2_wht], axis=-1)
-    weight_array = np.prod(weight_array, axis=-1)
-    weight_array = weight_array.reshape(-1)
+    return (o2, o3, t3, t2), weight_array
 
-    #---- calculating the PDF ----#
+#---- marginalizing the PDF onto the t2 axis ----#
 
-    pdf = kernel_temperature.evaluate(grid_array)
-    pdf = pdf * weight_array
+def marginalize_temperature(t2, pdf, window=None):
 
-    #---- marginalization ----#
+    output_array = marginalize_grid(t2, pdf, percentile, window=window)
+    output_t2    = ufloat(output_array[1], np.mean(np.diff(output_array)))
+    return output_t2
 
-    t2_array       = grid_array[-1,:]
-    sorted_indices = np.argsort(t2_array)
+#---- (o2, o3, t3, t2) posterior, without building the 4-D grid of points ----#
 
-    t2_array       = t2_array[sorted_indices]
-    pdf            = pdf[sorted_indices]
+def temperature_posterior(kernel, grid_axes, weight_array):
 
-    pdf_normalized = pdf / np.sum(pdf)
-    pdf_t2         = t2_array
+    pdf  = kernel.evaluate_grid(*grid_axes)
+    pdf *= weight_array[..., None]
+    return pdf
 
-    #---- maximum likelihood value ----#
+#---- t2 on the full grid, or on the part of the t2 axis where the posterior has mass ----#
 
-    ml_index       = np.argmax(pdf_normalized)
-    ml_t2          = pdf_t2[ml_index]
+def grid_temperature(kernel, grid_axes, weight_array, grid='full', posterior=False):
 
-    #---- 50th percentile value ----#
+    window    = grid_window(kernel, grid_axes, weight_array, load_kernel_temperature, grid=grid)
+    fine_axes = grid_axes if window is None else tuple(grid_axes[:-1]) + (grid_axes[-1][window],)
+    pdf       = temperature_posterior(kernel, fine_axes, weight_array)
+    output    = marginalize_temperature(grid_axes[-1], pdf, window=window)
 
-    cdf               = np.cumsum(pdf_normalized)
-    ml_cdf            = cdf[ml_index]
+    # the marginal posterior on the full t2 axis as well
+    if posterior:
+        return output, POSTERIOR(grid_axes[-1], marginal_pdf(grid_axes[-1], pdf, window=window))
+    return output
 
-    lo_index          = np.argmin(np.abs(cdf-(ml_cdf-percentile/2)))
-    up_index          = np.argmin(np.abs(cdf-(ml_cdf+percentile/2)))
+#---- the t2 posterior given each of several t3 values (for drawing t2 along with t3) ----#
 
-    output_array      = [pdf_t2[lo_index], ml_t2, pdf_t2[up_index]]
-    output_t2         = ufloat(ml_t2, np.mean(np.diff(output_array)))
-    return output_t2
+# marginalized over O2 and O3 only; returns the t2 axis and the (len(T3_nodes), len(t2 axis)) pdfs, normalized along t2
+def conditional_temperature(O2, O2_unc,
+                            O3, O3_unc,
+                            T3, T3_unc, T3_nodes,
+                            length=3, engine='exact', resolution=0.01):
+
+    kernel = get_kernel_temperature(engine)
+
+    (o2, o3, t3, t2), weight_array = temperature_axes(O2, O2_unc, O3, O3_unc, T3, T3_unc, length=length, resolution=resolution)
+
+    # the O2 and O3 weights (those of t3 are one at T3), the same at every t3 node
+    weight_array = np.repeat(weight_array[:, :, [length-1]], len(T3_nodes), axis=2)
+
+    pdf = np.sum(temperature_posterior(kernel, (o2, o3, np.asarray(T3_nodes, dtype=float), t2), weight_array), axis=(0, 1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return t2, pdf/np.sum(pdf, axis=-1, keepdims=True)
+
+#---- single object ----#
+
+def measure_temperature(O2, O2_unc,
+                        O3, O3_unc,
+                        T3, T3_unc,
+                        length=3, engine='exact', grid='full', resolution=0.01, posterior=False):
+
+    kernel = get_kernel_temperature(engine)
+
+    grid_axes, weight_array = temperature_axes(O2, O2_unc, O3, O3_unc, T3, T3_unc, length=length, resolution=resolution)
+
+    return grid_temperature(kernel, grid_axes, weight_array, grid=grid, posterior=posterior)
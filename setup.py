@@ -21,9 +21,10 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent'],
     include_package_data=True,
-    package_data={'genesis_metallicity': ['data/*.pkl']},
+    package_data={'genesis_metallicity': ['data/kernel_metallicity.npz', 'data/kernel_temperature.npz', 'data/kernel_*_table_v*.npz']},
     python_requires='>=3.6',
     install_requires=required,
+    entry_points={'console_scripts': ['genesis-metallicity=genesis_metallicity.cli:main']},
     license='MIT',
     license_files=('LICENSE',),
 )
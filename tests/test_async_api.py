@@ -0,0 +1,159 @@
+import time
+import asyncio
+import threading
+import contextlib
+import numpy as np
+
+from genesis_metallicity import async_api
+from genesis_metallicity.async_api import ASYNC_ESTIMATOR
+from genesis_metallicity.parallel import measure_chunk
+from genesis_metallicity.genesis_metallicity import measure_catalog
+
+##########
+# Config #
+##########
+
+n_objects  = 12
+chunk_size = 2
+n_chunks   = n_objects//chunk_size
+
+settings = {'executor': 'thread', 'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# line fluxes around those of the README object
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+
+objects = np.array(['obj%02i' %i for i in range(n_objects)])
+
+def catalog():
+
+    rng = np.random.default_rng(0)
+
+    columns = {}
+    for line, flux in line_fluxes.items():
+        values        = flux*10**rng.normal(0, 0.15, n_objects)
+        columns[line] = (values, values*rng.uniform(0.02, 0.3, n_objects))
+    columns['Hbeta_EW'] = (rng.uniform(50, 300, n_objects), rng.uniform(5, 30, n_objects))
+
+    return columns
+
+# the chunks of iterate_chunks, counting those read
+class CHUNKS:
+
+    def __init__(self):
+
+        self.n_read = 0
+
+    def __iter__(self):
+
+        columns = catalog()
+        for lo in range(0, n_objects, chunk_size):
+            self.n_read += 1
+            yield objects[lo:lo+chunk_size], {line: [flux[lo:lo+chunk_size], fluxerr[lo:lo+chunk_size]] for line, (flux, fluxerr) in columns.items()}
+
+# measure_chunk in the workers, recording the chunks that started (by index) and the most that ran at once;
+# delay(index) is slept before measuring, and the chunks after the first wait for gate if given
+class RECORDER:
+
+    def __init__(self, delay=lambda index: 0, gate=None):
+
+        self.delay   = delay
+        self.gate    = gate
+        self.lock    = threading.Lock()
+        self.started = []
+        self.running = 0
+        self.most    = 0
+
+    def __call__(self, chunk, chunk_objects, settings):
+
+        index = int(np.flatnonzero(objects == chunk_objects[0])[0])//chunk_size
+
+        with self.lock:
+            self.started.append(index)
+            self.running += 1
+            self.most     = max(self.most, self.running)
+
+        try:
+            if (self.gate is not None) and (index > 0):
+                self.gate.wait()
+            time.sleep(self.delay(index))
+            return measure_chunk(chunk, chunk_objects, settings)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+#########
+# Order #
+#########
+
+# the first chunks take the longest, so that the later ones finish first
+def test_outputs_are_in_order(monkeypatch):
+
+    recorder = RECORDER(delay=lambda index: 0.05*(n_chunks-index))
+    monkeypatch.setattr(async_api, 'measure_chunk', recorder)
+
+    async def run():
+        async with ASYNC_ESTIMATOR(n_workers=3, max_pending=n_chunks, **settings) as estimator:
+            return [output_dict async for output_dict in estimator.iterate_chunks(CHUNKS())]
+
+    outputs  = asyncio.run(run())
+    expected = measure_catalog(catalog(), objects=objects, kernel_engine='tabulated', emissivity_engine='tabulated')
+
+    assert recorder.most > 1
+    assert len(outputs) == n_chunks
+    np.testing.assert_array_equal(np.concatenate([output_dict['object'] for output_dict in outputs]), objects)
+    np.testing.assert_array_equal(np.concatenate([output_dict['metallicity'] for output_dict in outputs]), expected['metallicity'])
+
+################
+# Backpressure #
+################
+
+# with more workers than max_pending and a slow caller, no more than max_pending chunks are read ahead or measured at once
+def test_pending_chunks_are_bounded(monkeypatch):
+
+    max_pending = 2
+
+    recorder = RECORDER(delay=lambda index: 0.02)
+    monkeypatch.setattr(async_api, 'measure_chunk', recorder)
+
+    chunks = CHUNKS()
+
+    async def run():
+        n_yielded = 0
+        async with ASYNC_ESTIMATOR(n_workers=4, max_pending=max_pending, **settings) as estimator:
+            async for output_dict in estimator.iterate_chunks(chunks):
+                n_yielded += 1
+                assert chunks.n_read <= n_yielded + max_pending
+                await asyncio.sleep(0.05)
+        return n_yielded
+
+    assert asyncio.run(run()) == n_chunks
+    assert recorder.most == max_pending
+    assert sorted(recorder.started) == list(range(n_chunks))
+
+##############
+# Early Stop #
+##############
+
+# the caller stops after the first chunk: the pending chunks queued behind the (gated) second one are cancelled, so
+# that they never start once the gate opens (the second may or may not have been picked up by the worker already)
+def test_early_break_cancels_pending(monkeypatch):
+
+    gate     = threading.Event()
+    recorder = RECORDER(gate=gate)
+    monkeypatch.setattr(async_api, 'measure_chunk', recorder)
+
+    chunks = CHUNKS()
+
+    async def run():
+        async with ASYNC_ESTIMATOR(n_workers=1, max_pending=4, **settings) as estimator:
+            async with contextlib.aclosing(estimator.iterate_chunks(chunks)) as outputs:
+                async for output_dict in outputs:
+                    break
+            gate.set()
+        return output_dict
+
+    output_dict = asyncio.run(run())
+
+    np.testing.assert_array_equal(output_dict['object'], objects[:chunk_size])
+    assert chunks.n_read == 4
+    assert recorder.started in [[0], [0, 1]]
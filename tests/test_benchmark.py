@@ -0,0 +1,61 @@
+import json
+import pytest
+
+from genesis_metallicity import benchmark
+
+##########
+# Config #
+##########
+
+# single-object catalogs with the tabulated engines, so that a run takes a few seconds
+arguments = ['--sizes', '1', '--kernel-engine', 'tabulated', '--emissivity-engine', 'tabulated']
+
+def scaled_baseline(path, output_path, factor):
+
+    with open(path, 'r') as handle:
+        baseline = json.load(handle)
+
+    for result in baseline['results']:
+        result['latency']     *= factor
+        result['peak_memory'] *= factor
+
+    with open(output_path, 'w') as handle:
+        json.dump(baseline, handle)
+
+################
+# Command Line #
+################
+
+def test_sizes_follow_the_engines():
+
+    assert benchmark.parse_arguments(['out.json'])[2] == benchmark.default_sizes
+    assert benchmark.parse_arguments(['out.json', '--kernel-engine', 'exact'])[2] == benchmark.exact_sizes
+    assert benchmark.parse_arguments(['out.json', '--emissivity-engine', 'exact', '--sizes', '1,5'])[2] == (1, 5)
+
+    with pytest.raises(ValueError, match='unknown option'):
+        benchmark.parse_arguments(['out.json', '--engine', 'exact'])
+
+# a run against a much slower baseline has no regressions, and against a much faster one only regressions
+def test_benchmark_against_baselines(tmp_path):
+
+    results = str(tmp_path / 'results.json')
+    assert benchmark.main([results] + arguments) == 0
+
+    saved = benchmark.load_baseline(results)
+    assert saved['metadata']['kernel_engine'] == 'tabulated'
+    assert {result['scenario'] for result in saved['results']} == {'import'} | set(benchmark.scenario_lines.keys())
+
+    scaled_baseline(results, str(tmp_path / 'slow.json'), 100)
+    scaled_baseline(results, str(tmp_path / 'fast.json'), 1e-6)
+
+    assert benchmark.main([str(tmp_path / 'again.json'), str(tmp_path / 'slow.json')] + arguments) == 0
+    assert benchmark.main([str(tmp_path / 'again.json'), str(tmp_path / 'fast.json')] + arguments) == 1
+
+# baselines of other engines are not comparable
+def test_engines_must_match(tmp_path):
+
+    results = str(tmp_path / 'results.json')
+    benchmark.save_baseline(results, [], benchmark.benchmark_metadata(kernel_engine='exact', emissivity_engine='exact'))
+
+    with pytest.raises(ValueError, match='kernel_engine'):
+        benchmark.compare_benchmark([], benchmark.load_baseline(results), benchmark.benchmark_metadata(kernel_engine='tabulated'))
@@ -0,0 +1,135 @@
+import os
+import shutil
+import itertools
+import numpy as np
+
+from genesis_metallicity import cache
+from genesis_metallicity.cache import RESULT_CACHE
+from genesis_metallicity.genesis_metallicity import measure_catalog
+
+##########
+# Config #
+##########
+
+n_objects = 12
+
+settings = {'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# line fluxes around those of the README object
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+
+# direct-method and strong-line objects
+def catalog(rows=slice(None)):
+
+    rng = np.random.default_rng(0)
+
+    columns = {}
+    for line, flux in line_fluxes.items():
+        values          = flux*10**rng.normal(0, 0.15, n_objects)
+        columns[line]   = (values, values*rng.uniform(0.02, 0.3, n_objects))
+    columns['Hbeta_EW'] = (rng.uniform(50, 300, n_objects), rng.uniform(5, 30, n_objects))
+    columns['O4363'][0][::3] = np.nan
+
+    return {line: (flux[rows], fluxerr[rows]) for line, (flux, fluxerr) in columns.items()}
+
+def assert_outputs_equal(output, expected):
+
+    assert list(output.keys()) == list(expected.keys())
+    for column in expected.keys():
+        assert output[column].dtype == expected[column].dtype
+        np.testing.assert_array_equal(output[column], expected[column])
+
+################
+# Partial Hits #
+################
+
+# the cached and the measured objects are merged back in the catalog order
+def test_partial_hits_are_merged(tmp_path):
+
+    objects  = np.array(['obj%02i' %i for i in range(n_objects)])
+    expected = measure_catalog(catalog(), objects=objects, **settings)
+
+    result_cache = RESULT_CACHE(tmp_path / 'cache.sqlite')
+
+    cached = np.arange(n_objects) % 3 == 1
+    measure_catalog(catalog(cached), objects=objects[cached], cache=result_cache, **settings)
+
+    output = measure_catalog(catalog(), objects=objects, cache=result_cache, **settings)
+    assert_outputs_equal(output, expected)
+
+    stats = result_cache.stats()
+    assert stats['hits'] == np.sum(cached)
+    assert stats['misses'] == n_objects
+    assert stats['entries'] == n_objects
+
+    # and all of them from the cache
+    assert_outputs_equal(measure_catalog(catalog(), objects=objects, cache=result_cache, **settings), expected)
+    assert result_cache.stats()['hits'] == np.sum(cached) + n_objects
+
+############
+# Eviction #
+############
+
+def test_least_recently_used_are_evicted(tmp_path, monkeypatch):
+
+    # a clock that always moves forward
+    clock = itertools.count()
+    monkeypatch.setattr(cache.time, 'time', lambda: float(next(clock)))
+
+    def output(n):
+        return {'object': np.arange(n), 'metallicity_method': np.full(n, 'strong'), 'metallicity': np.full(n, 8.0)}
+
+    keys = np.array(['%064i' %i for i in range(4)])
+
+    # room for three entries
+    entry_size   = len(keys[0]) + 8
+    result_cache = RESULT_CACHE(tmp_path / 'cache.sqlite', max_size=3*entry_size)
+
+    for key in keys[:3]:
+        result_cache.put('fingerprint', np.array([key]), output(1))
+
+    # the first is used again, so the second is now the least recently used
+    found, cached = result_cache.get('fingerprint', keys[:1])
+    assert found[0]
+
+    result_cache.put('fingerprint', keys[3:], output(1))
+
+    found, cached = result_cache.get('fingerprint', keys)
+    np.testing.assert_array_equal(found, [True, False, True, True])
+
+    stats = result_cache.stats()
+    assert stats['evictions'] == 1
+    assert stats['entries'] == 3
+    assert stats['size'] <= stats['max_size']
+
+###############
+# Fingerprint #
+###############
+
+# only the code that measures the objects is fingerprinted
+def test_fingerprint_ignores_the_interfaces(tmp_path, monkeypatch):
+
+    package = tmp_path / 'genesis_metallicity'
+    shutil.copytree(os.path.dirname(cache.__file__), package, ignore=shutil.ignore_patterns('__pycache__', '*_table_v*.npz'))
+
+    monkeypatch.setattr(cache, 'package_path', str(package))
+
+    def fingerprint():
+        monkeypatch.setattr(cache, 'code_fingerprint', None)
+        return cache.get_code_fingerprint()
+
+    reference = fingerprint()
+
+    for path in ['cli.py', 'service.py', 'benchmark.py', 'async_api.py', 'parallel.py', 'catalog_io.py']:
+        with open(package / path, 'a') as handle:
+            handle.write('\n# edited\n')
+        assert fingerprint() == reference
+
+    for path in ['genesis_metallicity.py', os.path.join('metallicity', 'strong_method.py'), os.path.join('dust', 'attenuation.py')]:
+        original = (package / path).read_text()
+        with open(package / path, 'a') as handle:
+            handle.write('\n# edited\n')
+        assert fingerprint() != reference
+        (package / path).write_text(original)
+
+    assert fingerprint() == reference
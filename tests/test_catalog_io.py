@@ -0,0 +1,149 @@
+import csv
+import gzip
+import shutil
+import numpy as np
+import pytest
+
+from genesis_metallicity.catalog_io import CSV_WRITER, HDF5_WRITER, FITS_WRITER, measure_file, read_chunks
+from genesis_metallicity.genesis_metallicity import measure_catalog
+
+##########
+# Config #
+##########
+
+n_objects  = 10
+chunk_size = 4
+
+settings = {'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# line fluxes around those of the README object
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+
+writers    = {'fits': FITS_WRITER, 'hdf5': HDF5_WRITER, 'csv': CSV_WRITER}
+extensions = {'fits': '.fits', 'hdf5': '.h5', 'csv': '.csv'}
+
+objects = np.array(['obj%02i' %i for i in range(n_objects)])
+
+# direct-method and strong-line objects, as catalog columns
+def catalog_columns():
+
+    rng = np.random.default_rng(0)
+
+    columns = {'ID': objects}
+    for line, flux in list(line_fluxes.items()) + [('Hbeta_EW', 150.0)]:
+        values               = flux*10**rng.normal(0, 0.15, n_objects)
+        columns[line]        = values
+        columns[line+'_err'] = values*rng.uniform(0.02, 0.3, n_objects)
+    columns['O4363'][::3] = np.nan
+
+    return columns
+
+# written chunk by chunk, as measure_file does (so that the NAXIS2 of the FITS tables is patched on close)
+def write_catalog(path, format, columns):
+
+    with writers[format](str(path)) as writer:
+        for lo in range(0, n_objects, chunk_size):
+            writer.write({name: column[lo:lo+chunk_size] for name, column in columns.items()})
+        return writer.rows
+
+#---- reading back all the columns of a written catalog ----#
+
+def read_fits(path):
+
+    from astropy.io import fits
+
+    with fits.open(path) as handle:
+        handle.verify('exception')
+        assert handle[1].header['NAXIS2'] == len(handle[1].data)
+        return {name: np.array(handle[1].data[name]) for name in handle[1].columns.names}
+
+def read_hdf5(path):
+
+    import h5py
+
+    with h5py.File(path, 'r') as handle:
+        return {name: handle[name][:] for name in handle.keys()}
+
+def read_csv(path):
+
+    with open(path, newline='') as handle:
+        rows = list(csv.reader(handle))
+    return {name: np.array([row[i] for row in rows[1:]]) for i, name in enumerate(rows[0])}
+
+readers = {'fits': read_fits, 'hdf5': read_hdf5, 'csv': read_csv}
+
+# the values read back, in the dtype of the expected column
+def assert_column_equal(values, expected):
+
+    if expected.dtype.kind in 'UOS':
+        values = np.char.decode(values) if values.dtype.kind == 'S' else values.astype(str)
+        np.testing.assert_array_equal(values, expected.astype(str))
+    else:
+        np.testing.assert_array_equal(values.astype(expected.dtype), expected)
+
+##############
+# Round Trip #
+##############
+
+# each format written by its writer, measured by measure_file into the same format, and read back
+@pytest.mark.parametrize('format', ['fits', 'hdf5', 'csv'])
+def test_round_trip(tmp_path, format):
+
+    columns = catalog_columns()
+
+    input_path  = tmp_path / ('input'+extensions[format])
+    output_path = tmp_path / ('output'+extensions[format])
+
+    assert write_catalog(input_path, format, columns) == n_objects
+
+    written = readers[format](str(input_path))
+    for name, column in columns.items():
+        assert_column_equal(written[name], column)
+
+    assert measure_file(str(input_path), str(output_path), object_column='ID', chunk_size=chunk_size, **settings) == n_objects
+
+    catalog  = {line: (columns[line], columns[line+'_err']) for line in list(line_fluxes) + ['Hbeta_EW']}
+    expected = measure_catalog(catalog, objects=objects, **settings)
+    output   = readers[format](str(output_path))
+
+    # (h5py lists the datasets in alphabetical order)
+    assert sorted(output.keys()) == sorted(expected.keys())
+    for name, column in expected.items():
+        assert_column_equal(output[name], column)
+
+# the 2D posterior columns of the FITS tables (left out of the CSV files)
+def test_fits_posteriors(tmp_path):
+
+    columns = catalog_columns()
+    write_catalog(tmp_path / 'input.fits', 'fits', columns)
+
+    measure_file(str(tmp_path / 'input.fits'), str(tmp_path / 'output.fits'), object_column='ID', chunk_size=chunk_size, posterior=True, **settings)
+
+    catalog  = {line: (columns[line], columns[line+'_err']) for line in list(line_fluxes) + ['Hbeta_EW']}
+    expected = measure_catalog(catalog, objects=objects, posterior=True, **settings)
+    output   = read_fits(str(tmp_path / 'output.fits'))
+
+    for name in ['metallicity_pdf', 't2_pdf']:
+        assert output[name].shape == expected[name].shape
+        assert_column_equal(output[name], expected[name])
+
+###############
+# Compression #
+###############
+
+# gzipped FITS catalogs are read, but not written
+def test_gzipped_fits(tmp_path):
+
+    columns = catalog_columns()
+    write_catalog(tmp_path / 'input.fits', 'fits', columns)
+
+    with open(tmp_path / 'input.fits', 'rb') as source, gzip.open(tmp_path / 'input.fits.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+
+    read = list(read_chunks(str(tmp_path / 'input.fits.gz'), object_column='ID', chunk_size=chunk_size))
+    assert_column_equal(np.concatenate([chunk['O5007'] for objects, chunk in read]), columns['O5007'])
+
+    with pytest.raises(ValueError, match='compressed'):
+        measure_file(str(tmp_path / 'input.fits'), str(tmp_path / 'output.fits.gz'), object_column='ID', **settings)
+
+    assert not (tmp_path / 'output.fits.gz').exists()
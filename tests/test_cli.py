@@ -0,0 +1,194 @@
+import os
+import csv
+import json
+import time
+import logging
+import numpy as np
+import pytest
+
+from genesis_metallicity import cli
+from genesis_metallicity.cache import RESULT_CACHE
+from genesis_metallicity.parallel import measure_chunk
+
+##########
+# Config #
+##########
+
+# a small catalog: 4 chunks of 6 objects, measured by 2 workers with the tabulated engines
+n_objects  = 24
+chunk_size = 6
+
+settings = {'chunk_size': chunk_size, 'object_column': 'ID', 'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# line fluxes around those of the README object
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+
+def write_catalog(path, objects):
+
+    rng = np.random.default_rng(0)
+
+    columns = {}
+    for line, flux in line_fluxes.items():
+        columns[line]        = flux*10**rng.normal(0, 0.15, len(objects))
+        columns[line+'_err'] = columns[line]*rng.uniform(0.02, 0.3, len(objects))
+    columns['Hbeta_EW']     = rng.uniform(50, 300, len(objects))
+    columns['Hbeta_EW_err'] = rng.uniform(5, 30, len(objects))
+
+    # both methods, and objects without Halpha
+    columns['O4363'][::3]  = np.nan
+    columns['Halpha'][1::4] = np.nan
+
+    with open(path, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['ID'] + list(columns.keys()))
+        for i, object in enumerate(objects):
+            writer.writerow([object] + [columns[name][i] for name in columns.keys()])
+
+def read_output(path):
+
+    with open(path, 'r') as handle:
+        return handle.read()
+
+#---- the first chunk finishes last, so that the parts complete out of order ----#
+
+def slow_first_chunk(chunk, objects, settings, profile=False):
+
+    if objects[0] == 'obj000':
+        time.sleep(2)
+    return measure_chunk(chunk, objects, settings, profile)
+
+class STOP(Exception):
+    pass
+
+############
+# Resuming #
+############
+
+def test_resumed_run_matches_uninterrupted(tmp_path, monkeypatch):
+
+    catalog = str(tmp_path / 'catalog.csv')
+    write_catalog(catalog, ['obj%03i' %i for i in range(n_objects)])
+
+    reference = str(tmp_path / 'reference.csv')
+    assert cli.run_batch(catalog, reference, n_workers=1, **settings) == n_objects
+
+    #---- a run stopped once its first part is saved ----#
+
+    output    = str(tmp_path / 'output.csv')
+    save_part = cli.save_part
+    saved     = []
+
+    def save_one_part(directory, first_row, output_dict):
+        if len(saved) > 0:
+            raise STOP()
+        saved.append(first_row)
+        return save_part(directory, first_row, output_dict)
+
+    monkeypatch.setattr(cli, 'measure_chunk', slow_first_chunk)
+    monkeypatch.setattr(cli, 'save_part', save_one_part)
+
+    with pytest.raises(STOP):
+        cli.run_batch(catalog, output, n_workers=2, **settings)
+
+    with open(os.path.join(cli.checkpoint_path(output), 'manifest.json'), 'r') as handle:
+        parts = json.load(handle)['parts']
+
+    # one part, which is not the first chunk of the catalog
+    assert [part['first_row'] for part in parts] == saved
+    assert saved[0] != 0
+    assert not os.path.exists(output)
+
+    #---- resumed, it only measures the other chunks (without checking the object IDs again) ----#
+
+    monkeypatch.setattr(cli, 'save_part', save_part)
+
+    def checked_again(*args, **kwargs):
+        raise AssertionError('the object IDs of a resumed run are checked again')
+
+    monkeypatch.setattr(cli, 'check_unique_objects', checked_again)
+
+    measured = []
+
+    def count_chunk(chunk, objects, settings, profile=False):
+        measured.extend(objects)
+        return measure_chunk(chunk, objects, settings, profile)
+
+    monkeypatch.setattr(cli, 'measure_chunk', count_chunk)
+
+    assert cli.run_batch(catalog, output, n_workers=1, **settings) == n_objects
+
+    assert len(measured) == n_objects - chunk_size
+    assert read_output(output) == read_output(reference)
+    assert not os.path.exists(cli.checkpoint_path(output))
+
+##############
+# Object IDs #
+##############
+
+def test_duplicate_objects_are_rejected(tmp_path):
+
+    catalog = str(tmp_path / 'catalog.csv')
+    write_catalog(catalog, ['obj%03i' %(i % (n_objects-1)) for i in range(n_objects)])
+
+    output = str(tmp_path / 'output.csv')
+
+    with pytest.raises(ValueError, match='not unique'):
+        cli.run_batch(catalog, output, n_workers=1, **settings)
+
+    assert not os.path.exists(cli.checkpoint_path(output))
+
+# the object column is all that is read (here, the flux columns cannot even be parsed)
+def test_only_objects_are_checked(tmp_path):
+
+    catalog = str(tmp_path / 'catalog.csv')
+
+    with open(catalog, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['ID', 'O5007', 'O5007_err'])
+        for i in range(n_objects):
+            writer.writerow(['obj%03i' %i, 'not a flux', ''])
+
+    cli.check_unique_objects(catalog, object_column='ID', chunk_size=chunk_size)
+
+##########
+# Output #
+##########
+
+# the output is only written at the end of the run, so a compressed one is rejected before measuring anything
+def test_compressed_output_is_rejected(tmp_path):
+
+    catalog = str(tmp_path / 'catalog.csv')
+    write_catalog(catalog, ['obj%03i' %i for i in range(n_objects)])
+
+    output = str(tmp_path / 'output.fits.gz')
+
+    with pytest.raises(ValueError, match='compressed'):
+        cli.run_batch(catalog, output, n_workers=1, **settings)
+
+    assert not os.path.exists(cli.checkpoint_path(output))
+
+#########
+# Cache #
+#########
+
+# the hits and misses of the workers' copies of the cache add up in the parent, and are logged
+def test_cache_counts_of_the_workers(tmp_path, caplog):
+
+    catalog = str(tmp_path / 'catalog.csv')
+    write_catalog(catalog, ['obj%03i' %i for i in range(n_objects)])
+
+    cache_path = str(tmp_path / 'cache.sqlite')
+
+    cache = RESULT_CACHE(cache_path)
+    cli.run_batch(catalog, str(tmp_path / 'first.csv'), n_workers=2, cache=cache, **settings)
+    assert cache.stats()['hits'] == 0
+    assert cache.stats()['misses'] == n_objects
+
+    arguments = [catalog, str(tmp_path / 'second.csv'), '--workers', '2', '--cache', cache_path, '--object-column', 'ID', '--chunk-size', str(chunk_size),
+                 '--kernel-engine', 'tabulated', '--emissivity-engine', 'tabulated']
+
+    with caplog.at_level(logging.INFO, logger='genesis_metallicity.cli'):
+        assert cli.main(arguments) == 0
+
+    assert 'cache: %i hits, 0 misses' %n_objects in caplog.text
+    assert read_output(str(tmp_path / 'second.csv')) == read_output(str(tmp_path / 'first.csv'))
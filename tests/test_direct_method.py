@@ -0,0 +1,135 @@
+import os
+import json
+import numpy as np
+import pytest
+from uncertainties import ufloat
+
+from genesis_metallicity.diagnostics import status_flags
+from genesis_metallicity.metallicity.direct_method import METALLICITY, measure_direct_batch
+from genesis_metallicity.profiler import PROFILER
+
+##########
+# Config #
+##########
+
+# the METALLICITY outputs of the baseline commit (2c85a6b, exact engines, default t2_calibration and global_den),
+# with the branch and tolerance it chose, for objects on the three branches, the three tolerances, with no
+# consistent branch, and with and without [OII]7320,30
+baseline_path = os.path.join(os.path.dirname(__file__), 'data', 'direct_method_baseline.json')
+
+with open(baseline_path, 'r') as handle:
+    baseline = json.load(handle)
+
+batch_lines = ['OII', 'OII7320', 'O4363', 'O5007', 'Hbeta']
+
+# the columns of measure_direct_batch, in the order of the baseline values
+batch_columns = ['metallicity', 'metallicity_err', 'Te_OII', 'Te_OII_err', 'Te_OIII', 'Te_OIII_err']
+
+def baseline_values(row):
+
+    return row['metallicity'] + row['Te_OII'] + row['Te_OIII']
+
+def object_id(row):
+
+    return '%s-%s-%s' %(row['branch'], row['tolerance'], 'O7320' if 'OII7320' in row['lines'] else 'no_O7320')
+
+# the tolerance of the branch, from the status flags
+def status_tolerance(status, measured):
+
+    if not measured:
+        return None
+    if status & status_flags['branch_unc']:
+        return 'unc'
+    if status & status_flags['branch_max']:
+        return 'max'
+    return 'no'
+
+############
+# Coverage #
+############
+
+def test_baseline_coverage():
+
+    cases = {(row['branch'], row['tolerance'], 'OII7320' in row['lines']) for row in baseline}
+
+    for branch in ['low_Z', 'intermediate_Z', 'high_Z']:
+        for O7320 in [False, True]:
+            assert (branch, 'no', O7320) in cases
+
+    for tolerance in ['unc', 'max']:
+        for O7320 in [False, True]:
+            assert any((case[1] == tolerance) and (case[2] == O7320) for case in cases)
+
+    for O7320 in [False, True]:
+        assert (None, None, O7320) in cases
+
+##########################
+# Per-Object Measurement #
+##########################
+
+# bit-identical to the baseline, which solved each branch once per tolerance
+@pytest.mark.parametrize('row', baseline, ids=[object_id(row) for row in baseline])
+def test_metallicity_matches_baseline(row):
+
+    direct_metallicity = METALLICITY('test', {line: ufloat(*flux) for line, flux in row['lines'].items()})
+
+    values = [direct_metallicity.metallicity.n, direct_metallicity.metallicity.s,
+              direct_metallicity.Te_OII.n, direct_metallicity.Te_OII.s,
+              direct_metallicity.Te_OIII.n, direct_metallicity.Te_OIII.s]
+
+    np.testing.assert_array_equal(values, baseline_values(row))
+
+    measured = not np.isnan(direct_metallicity.metallicity.n)
+
+    assert direct_metallicity.branch == row['branch']
+    assert status_tolerance(direct_metallicity.status, measured) == row['tolerance']
+    assert direct_metallicity.branch_attempts <= 9
+
+#######################
+# Catalog Measurement #
+#######################
+
+# the array version agrees with the baseline to rounding (its sums are ordered differently), with the same nans
+def test_direct_batch_matches_baseline():
+
+    lines = {}
+    for line in batch_lines:
+        flux   = [row['lines'].get(line, [np.nan, np.nan]) for row in baseline]
+        lines[line] = (np.array([value[0] for value in flux]), np.array([value[1] for value in flux]))
+
+    output = measure_direct_batch(lines)
+
+    values   = np.stack([output[column] for column in batch_columns], axis=-1)
+    expected = np.array([baseline_values(row) for row in baseline])
+
+    np.testing.assert_array_equal(np.isnan(values), np.isnan(expected))
+    np.testing.assert_allclose(values, expected, rtol=1e-13, atol=0)
+
+    tolerances = [status_tolerance(status, measured) for status, measured in zip(output['status'], ~np.isnan(output['metallicity']))]
+    assert tolerances == [row['tolerance'] for row in baseline]
+
+#---- the branch attempts the profiler counts are the same on both paths ----#
+
+# including the objects with zero or missing lines, for which METALLICITY checks no branch
+def test_branch_attempts_match():
+
+    rows = [row['lines'] for row in baseline]
+
+    for line, flux in [('O5007', [0.0, 1e-20]), ('Hbeta', [0.0, 1e-20]), ('O4363', [np.nan, np.nan]), ('OII', [np.nan, np.nan]), ('Hbeta', [np.nan, np.nan])]:
+        rows.append(dict(rows[0], **{line: flux}))
+
+    class_attempts = []
+    for row in rows:
+        profiler = PROFILER()
+        METALLICITY('test', {line: ufloat(*flux) for line, flux in row.items()}, kernel_engine='tabulated', emissivity_engine='tabulated', profiler=profiler)
+        class_attempts += profiler.branch_attempts
+
+    lines = {}
+    for line in batch_lines:
+        flux        = [row.get(line, [np.nan, np.nan]) for row in rows]
+        lines[line] = (np.array([value[0] for value in flux]), np.array([value[1] for value in flux]))
+
+    profiler = PROFILER()
+    measure_direct_batch(lines, kernel_engine='tabulated', emissivity_engine='tabulated', profiler=profiler)
+
+    assert profiler.branch_attempts == class_attempts
@@ -0,0 +1,68 @@
+import numpy as np
+
+from genesis_metallicity import genesis_metallicity
+from genesis_metallicity.genesis_metallicity import measure_catalog
+
+##########
+# Config #
+##########
+
+settings = {'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# the README object at 5% errors, reddened to Av ~ 1.5, as a direct-method and a strong-line (no [OIII]4363) object
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+reddening   = {'Halpha': 1.4, 'Hgamma': 0.85, 'Hdelta': 0.75}
+
+def catalog():
+
+    columns = {}
+    for line, flux in line_fluxes.items():
+        flux          = flux*reddening.get(line, 1)
+        columns[line] = (np.full(2, flux), np.full(2, 0.05*flux))
+    columns['Hbeta_EW'] = (np.full(2, 150.0), np.full(2, 10.0))
+    columns['O4363'][0][1] = np.nan
+
+    return columns
+
+# measure_extinction with its Av uncertainty scaled
+def scaled_extinction(monkeypatch, scale):
+
+    measure_extinction = genesis_metallicity.measure_extinction
+
+    def scaled(*args):
+        Av, Av_sigma = measure_extinction(*args)
+        return Av, scale*Av_sigma
+
+    monkeypatch.setattr(genesis_metallicity, 'measure_extinction', scaled)
+
+#######################
+# Marginal Extinction #
+#######################
+
+# the Av nodes collapse onto the fitted Av
+def test_marginal_without_av_uncertainty_is_fixed(monkeypatch):
+
+    for scale in [0, 1e-6]:
+
+        scaled_extinction(monkeypatch, scale)
+
+        fixed    = measure_catalog(catalog(), extinction='fixed', **settings)
+        marginal = measure_catalog(catalog(), extinction='marginal', **settings)
+
+        np.testing.assert_array_equal(marginal['metallicity_method'], fixed['metallicity_method'])
+        np.testing.assert_array_equal(marginal['status'], fixed['status'])
+
+        for column in ['Av', 'metallicity', 'metallicity_err', 't2', 't2_err', 't3', 't3_err']:
+            np.testing.assert_allclose(marginal[column], fixed[column], rtol=1e-6)
+
+# the uncertainty of Av widens (never narrows) the metallicity of a dusty object
+def test_marginal_error_is_not_smaller():
+
+    fixed    = measure_catalog(catalog(), extinction='fixed', **settings)
+    marginal = measure_catalog(catalog(), extinction='marginal', **settings)
+
+    assert np.all(fixed['Av'] > 1)
+    np.testing.assert_array_equal(marginal['metallicity_method'], ['direct', 'strong'])
+
+    assert np.all(marginal['metallicity_err'] >= fixed['metallicity_err'])
+    assert marginal['metallicity_err'][0] > fixed['metallicity_err'][0]
@@ -0,0 +1,35 @@
+import sys
+import subprocess
+from scipy import stats
+
+from genesis_metallicity.benchmark import time_import, package_parent
+from genesis_metallicity.metallicity import strong_method
+from genesis_metallicity.temperature import temperature_estimator
+
+################
+# Lazy Imports #
+################
+
+# the hard-coded chi^2 percentiles are those scipy computes
+def test_percentiles_match_scipy():
+
+    for module in [strong_method, temperature_estimator]:
+        assert module.percentile == stats.chi2.cdf(1, df=module.dimensions)
+
+# neither the kernels, nor PyNeb, nor scipy.stats are imported with the package
+def test_import_is_lazy():
+
+    script = 'import sys, genesis_metallicity.genesis_metallicity; print(\' \'.join(sorted(sys.modules)))'
+    output = subprocess.run([sys.executable, '-c', script], cwd=package_parent, check=True, capture_output=True, text=True)
+    modules = output.stdout.split()
+
+    assert 'genesis_metallicity.genesis_metallicity' in modules
+    assert 'scipy.stats' not in modules
+    assert 'pyneb' not in modules
+
+def test_time_import():
+
+    elapsed, peak = time_import('genesis_metallicity.genesis_metallicity', repeat=1)
+
+    assert 0 < elapsed < 10
+    assert peak > 0
@@ -0,0 +1,52 @@
+import numpy as np
+
+from genesis_metallicity.genesis_metallicity import genesis_metallicity, measure_catalog
+from genesis_metallicity.diagnostics import has_flag
+from genesis_metallicity.metallicity.monte_carlo import default_min_valid_fraction
+
+##########
+# Config #
+##########
+
+settings = {'uncertainty': 'montecarlo', 'seed': 1, 'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# a direct-method object at 5% errors, with [OIII]4363 at S/N 1.5 (many negative draws) and 10
+line_fluxes = {'OII': 7.27e-19, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 4.5e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+O4363_snr   = np.array([1.5, 10])
+
+def catalog():
+
+    columns = {line: (np.full(2, flux), np.full(2, 0.05*flux)) for line, flux in line_fluxes.items()}
+    columns['O4363']    = (np.full(2, line_fluxes['O4363']), line_fluxes['O4363']/O4363_snr)
+    columns['Hbeta_EW'] = (np.full(2, 150.0), np.full(2, 10.0))
+    return columns
+
+########################
+# Dropped Realizations #
+########################
+
+def test_few_samples_are_flagged():
+
+    output = measure_catalog(catalog(), **settings)
+
+    assert np.all(np.isfinite(output['metallicity']))
+    assert output['valid_fraction'][0] < default_min_valid_fraction
+    assert output['valid_fraction'][1] == 1
+    np.testing.assert_array_equal(has_flag(output['status'], 'few_samples'), [True, False])
+
+# the same realizations through the class
+def test_class_matches_catalog():
+
+    output = measure_catalog(catalog(), objects=np.array(['low_snr', 'high_snr']), **settings)
+
+    for i, object in enumerate(['low_snr', 'high_snr']):
+        input_dict = {line: [flux[i], fluxerr[i]] for line, (flux, fluxerr) in catalog().items()}
+        galaxy     = genesis_metallicity(input_dict, object=object, **settings)
+
+        assert galaxy.valid_fraction == output['valid_fraction'][i]
+        assert galaxy.status == output['status'][i]
+
+# the column only exists for the Monte Carlo measurements
+def test_linear_has_no_valid_fraction():
+
+    assert 'valid_fraction' not in measure_catalog(catalog(), kernel_engine='tabulated', emissivity_engine='tabulated')
@@ -0,0 +1,60 @@
+import json
+import numpy as np
+from urllib.request import urlopen
+
+from genesis_metallicity.service import ESTIMATOR_SERVICE, measure_remote
+from genesis_metallicity.genesis_metallicity import measure_catalog
+
+##########
+# Config #
+##########
+
+settings = {'kernel_engine': 'tabulated', 'emissivity_engine': 'tabulated'}
+
+# the README object, at 5% errors
+line_fluxes = {'OII': 7.27e-20, 'Hdelta': 1.59e-19, 'Hgamma': 2.67e-19, 'O4363': 7.1e-20, 'Hbeta': 6.45e-19, 'O4959': 1.076e-18, 'O5007': 3.06e-18, 'Halpha': 1.9e-18}
+
+def input_dict(object, missing=None):
+
+    lines = {line: [flux, 0.05*flux] for line, flux in line_fluxes.items() if line != missing}
+    lines['Hbeta_EW'] = [150.0, 10.0]
+    lines['object']   = object
+    return lines
+
+###############
+# Mixed Batch #
+###############
+
+# an object without Hbeta fails on its own, and the other one of its request is measured as by measure_catalog
+def test_only_the_bad_object_fails():
+
+    with ESTIMATOR_SERVICE(port=0, **settings) as service:
+
+        url  = 'http://%s:%i' %service.address
+        rows = measure_remote([input_dict('bad', missing='Hbeta'), input_dict('good')], url)
+
+        with urlopen(url+'/metrics') as response:
+            metrics = json.loads(response.read())
+
+    assert [row['object'] for row in rows] == ['bad', 'good']
+
+    assert 'Hbeta' in rows[0]['error']
+    assert 'metallicity' not in rows[0]
+
+    catalog  = {line: (np.array([flux]), np.array([0.05*flux])) for line, flux in line_fluxes.items()}
+    catalog['Hbeta_EW'] = (np.array([150.0]), np.array([10.0]))
+    expected = measure_catalog(catalog, objects=np.array(['good']), **settings)
+
+    assert rows[1]['error'] == ''
+    assert rows[1]['metallicity'] == expected['metallicity'][0]
+    assert rows[1]['status'] == expected['status'][0]
+
+    #---- the metrics count the request once, and both of its objects ----#
+
+    assert metrics['requests'] == 1
+    assert metrics['objects'] == 2
+    assert metrics['failed_objects'] == 1
+    assert metrics['batches'] == 1
+    assert metrics['mean_batch_size'] == 2
+    assert metrics['queued_requests'] == 0
+    assert metrics['latency_p50'] is not None
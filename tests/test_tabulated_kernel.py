@@ -0,0 +1,106 @@
+import os
+import logging
+import numpy as np
+
+from genesis_metallicity.kernel import tabulated_kernel
+from genesis_metallicity.kernel.gaussian_kernel import GAUSSIAN_KERNEL
+from genesis_metallicity.kernel.posterior_grid import sort_order, marginalize_grid
+from genesis_metallicity.metallicity.strong_method import get_kernel_metallicity, load_kernel_metallicity, metallicity_axes, metallicity_posterior, percentile
+
+##########
+# Config #
+##########
+
+# random strong-line objects scattered around the calibration sample (most of their grids reach its steep edges)
+n_objects = 100
+
+def random_grids(seed=1):
+
+    dataset = load_kernel_metallicity().dataset
+    rng     = np.random.default_rng(seed)
+
+    for i in range(n_objects):
+        j = rng.integers(dataset.shape[1])
+        yield metallicity_axes(*[value for axis in range(3) for value in (dataset[axis, j]+rng.normal(0, 0.3), 0.1)])
+
+##################
+# Positive Grids #
+##################
+
+def test_tabulated_grids_are_not_negative():
+
+    kernel = get_kernel_metallicity('tabulated')
+
+    for grid_axes, weight_array in random_grids():
+        assert np.all(kernel.evaluate_grid(*grid_axes) >= 0)
+
+# the searchsorted interval of marginalize_grid is the argmin one of the original code
+def test_interval_matches_argmin():
+
+    kernel = get_kernel_metallicity('tabulated')
+
+    for grid_axes, weight_array in random_grids():
+
+        z   = grid_axes[-1]
+        pdf = metallicity_posterior(kernel, grid_axes, weight_array)
+
+        order = sort_order(z, pdf.size//len(z))
+        pdf_normalized  = pdf.reshape(-1)[order]
+        pdf_normalized /= np.sum(pdf_normalized)
+
+        ml_index = np.argmax(pdf_normalized)
+        cdf      = np.cumsum(pdf_normalized)
+        lo_index = np.argmin(np.abs(cdf-(cdf[ml_index]-percentile/2)))
+        up_index = np.argmin(np.abs(cdf-(cdf[ml_index]+percentile/2)))
+
+        expected = z[order[[lo_index, ml_index, up_index]] % len(z)]
+
+        np.testing.assert_array_equal(marginalize_grid(z, pdf, percentile), expected)
+
+####################
+# Saving the Table #
+####################
+
+# a small 2-D kernel, which builds in a fraction of a second
+def small_kernel():
+
+    rng     = np.random.default_rng(0)
+    dataset = rng.normal(0, 1, (2, 50))
+    return GAUSSIAN_KERNEL(dataset, np.full(50, 1/50), 0.1*np.eye(2))
+
+def test_table_is_saved_next_to_the_kernel(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(tabulated_kernel, 'cache_directory', str(tmp_path / 'cache'))
+
+    path  = str(tmp_path / 'table.npz')
+    table = tabulated_kernel.get_table(path, small_kernel())
+
+    assert table.metadata['path'] == path
+    assert tabulated_kernel.get_table(path, small_kernel()).metadata['path'] == path
+    assert not os.path.exists(tmp_path / 'cache')
+
+# a data directory that cannot be written (here, a file in its place) falls back to the cache directory,
+# where the next process finds the table instead of building it again
+def test_unwritable_table_goes_to_the_cache(tmp_path, monkeypatch, caplog):
+
+    monkeypatch.setattr(tabulated_kernel, 'cache_directory', str(tmp_path / 'cache'))
+    (tmp_path / 'data').write_text('')
+
+    path  = str(tmp_path / 'data' / 'table.npz')
+    table = tabulated_kernel.get_table(path, small_kernel())
+
+    assert table.metadata['path'] == str(tmp_path / 'cache' / 'table.npz')
+
+    monkeypatch.setattr(tabulated_kernel, 'build_table', None)
+    assert tabulated_kernel.get_table(path, small_kernel()).metadata['path'] == table.metadata['path']
+
+    #---- nowhere to save it: a warning, and the table is still returned ----#
+
+    monkeypatch.undo()
+    monkeypatch.setattr(tabulated_kernel, 'cache_directory', str(tmp_path / 'data' / 'cache'))
+
+    with caplog.at_level(logging.WARNING, logger='genesis_metallicity.kernel.tabulated_kernel'):
+        table = tabulated_kernel.get_table(path, small_kernel())
+
+    assert table.metadata['path'] is None
+    assert 'could not be saved' in caplog.text